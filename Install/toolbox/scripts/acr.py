@@ -1,180 +1,550 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
-import arcpy
-from arcpy import Raster
+import functools
 import numpy as np
 import os
 import sys
 
 from . import utils
+from . import focal
+from . import memory
+from .pipeline import pipeline
+from .surface_area_to_planar_area import surface_areas, scales_overlap
 from .tempdir import TempDir
 
 # force all to str
 if sys.version_info < (3, 0):
     str = unicode
 
-arcpy.env.overwriteOutput = True
-arcpy.CheckOutExtension("Spatial")
-arcpy.CheckOutExtension("3D")
-arcpy.CheckOutExtension("GeoStats")
+# the fields added to the areas of interest
+ACR_FIELDS = ["Surf_Area", "Plan_Area", "Rugosity", "Slope", "Aspect"]
+
+
+def rasterize(rings, georef):
+    """
+    Cells of georef whose centers fall inside the polygon of rings, a
+    list of (n, 2) coordinate arrays, by the even-odd rule, so interior
+    rings are left out. Every edge crossing the row of a cell center is
+    found at once, and the crossings to the left of each cell counted
+    with a cumulative sum along its row.
+    """
+    (nrows, ncols) = georef.shape
+    crossings = np.zeros((nrows, ncols + 1), dtype=np.int32)
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)
+        # vertices in cell units, where cell centers are whole numbers
+        col0 = (ring[:, 0] - georef.x_min) / georef.cell_width - 0.5
+        row0 = (georef.y_max - ring[:, 1]) / georef.cell_height - 0.5
+        (col1, row1) = (np.roll(col0, -1), np.roll(row0, -1))
+        # each edge crosses the cell center rows in [low, high)
+        first = np.maximum(np.ceil(np.minimum(row0, row1)), 0)
+        last = np.minimum(np.ceil(np.maximum(row0, row1)) - 1, nrows - 1)
+        counts = np.maximum(last - first + 1, 0).astype(np.int64)
+        edge = np.repeat(np.arange(len(ring)), counts)
+        rows = np.repeat(first, counts) + (
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                counts))
+        cols = col0[edge] + (rows - row0[edge]) / (
+            row1[edge] - row0[edge]) * (col1[edge] - col0[edge])
+        # the first cell whose center is right of the crossing
+        cols = np.clip(np.ceil(cols), 0, ncols).astype(np.int64)
+        np.add.at(crossings, (rows.astype(np.int64), cols), 1)
+    return (np.cumsum(crossings, axis=1)[:, :ncols] % 2) == 1
+
+
+def boundary_cells(mask):
+    """Cells outside mask which touch it, along an edge or a corner."""
+    (nrows, ncols) = mask.shape
+    padded = np.zeros((nrows + 2, ncols + 2), dtype=bool)
+    padded[1:-1, 1:-1] = mask
+    grown = np.zeros(mask.shape, dtype=bool)
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            grown |= padded[dy:dy + nrows, dx:dx + ncols]
+    return grown & ~mask
+
+
+def fit_plane(x, y, z):
+    """
+    Least squares plane z = intercept + dz_dx * x + dz_dy * y through
+    points. Returns (dz_dx, dz_dy, intercept), with y increasing north.
+    The coordinates are centered for the fit, so map coordinates keep
+    their precision.
+    """
+    (x_mean, y_mean) = (np.mean(x), np.mean(y))
+    design = np.column_stack([x - x_mean, y - y_mean, np.ones(len(x))])
+    ((dz_dx, dz_dy, mean), _, _, _) = np.linalg.lstsq(design, z, rcond=None)
+    return (dz_dx, dz_dy, mean - dz_dx * x_mean - dz_dy * y_mean)
+
+
+def plane_slope_aspect(dz_dx, dz_dy):
+    """
+    Slope and aspect in degrees of a plane with gradient (dz_dx, dz_dy),
+    y increasing north, as the Slope and Aspect tools find them on a
+    raster of the plane.
+    """
+    # rasters have rows increasing south
+    (dz_dx, dz_dy) = (np.atleast_1d(dz_dx), -np.atleast_1d(dz_dy))
+    return (focal.slope_from_gradient(dz_dx, dz_dy),
+            focal.aspect_from_gradient(dz_dx, dz_dy))
+
+
+def area_acr(bathy, mask, georef):
+    """
+    Arc-chord ratio of the cells of mask: the surface area of the
+    bathymetry, triangulated from the cell grid as in
+    surface_area_to_planar_area, over the area of the plane of best fit
+    to the boundary cells just outside mask. bathy must hold a cell
+    beyond the boundary cells. Cells whose surface area is NoData are
+    left out of both areas.
+
+    Returns (surface area, planar area, (dz_dx, dz_dy, intercept)),
+    with NaN areas where no cells or too few boundary cells are valid.
+    """
+    bathy = np.asarray(bathy, dtype=np.float64)
+    areas = np.full(bathy.shape, np.nan, dtype=np.float32)
+    areas[1:-1, 1:-1] = surface_areas(bathy, georef.cell_width,
+                                      georef.cell_height, False)[0]
+    cells = mask & ~np.isnan(areas)
+
+    edge = boundary_cells(mask) & ~np.isnan(bathy)
+    if not cells.any() or edge.sum() < 3:
+        return (np.nan, np.nan, (np.nan, np.nan, np.nan))
+    (rows, cols) = np.nonzero(edge)
+    plane = fit_plane(georef.x_min + (cols + 0.5) * georef.cell_width,
+                      georef.y_max - (rows + 0.5) * georef.cell_height,
+                      bathy[rows, cols])
+    surface_area = float(np.sum(areas[cells], dtype=np.float64))
+    planar_area = float(cells.sum() * georef.cell_size**2 *
+                        np.sqrt(1 + plane[0]**2 + plane[1]**2))
+    return (surface_area, planar_area, plane)
+
+
+def area_window(rings, georef, margin=2):
+    """
+    The (row, col, nrows, ncols) window of georef holding the polygon of
+    rings and margin cells around it, clipped to the raster.
+    """
+    points = np.concatenate([np.asarray(ring)[:, :2] for ring in rings])
+    (x_min, y_min) = points.min(axis=0)
+    (x_max, y_max) = points.max(axis=0)
+    top = max(int((georef.y_max - y_max) // georef.cell_height) - margin, 0)
+    left = max(int((x_min - georef.x_min) // georef.cell_width) - margin, 0)
+    bottom = min(int((georef.y_max - y_min) // georef.cell_height) +
+                 margin + 1, georef.nrows)
+    right = min(int((x_max - georef.x_min) // georef.cell_width) +
+                margin + 1, georef.ncols)
+    return (top, left, max(bottom - top, 0), max(right - left, 0))
+
+
+def label_areas(areas, georef, store):
+    """
+    Rasterize each area of areas, a list of polygon rings, into the
+    integer TileStore store as its index plus one. Areas overlapping an
+    earlier area are left out, so each labeled cell has one area, and
+    their indexes returned.
+    """
+    overlapping = []
+    for (i, rings) in enumerate(areas):
+        window = area_window(rings, georef)
+        if window[2] < 3 or window[3] < 3:
+            continue
+        mask = rasterize(rings, georef.window(*window))
+        block = store.read(window)
+        if (block[mask] > 0).any():
+            overlapping.append(i)
+            continue
+        block[mask] = i + 1
+        store.write(window[0], window[1], block)
+    return overlapping
+
+
+def label_moments(bathy, labels, georef, centers, count):
+    """
+    Sums over the labeled areas of a block of bathymetry and its labels,
+    both with a one cell halo, for count areas: the number of cells and
+    their surface area, then the number, sums and cross products of the
+    x, y and z of the boundary cells of each area, centered on the
+    (x, y) of centers. Each sum is a np.bincount over the labels, so all
+    the areas are reduced at once. georef locates the block, less its
+    halo. Returns an (11, count + 1) array, row 0 for unlabeled cells.
+    """
+    (nrows, ncols) = georef.shape
+    inner = labels[1:-1, 1:-1]
+    areas = surface_areas(bathy, georef.cell_width, georef.cell_height,
+                          False)[0]
+    cells = (inner > 0) & ~np.isnan(areas)
+    sums = np.zeros((11, count + 1))
+    sums[0] = np.bincount(inner[cells], minlength=count + 1)
+    sums[1] = np.bincount(inner[cells], weights=areas[cells],
+                          minlength=count + 1)
+
+    # a cell is on the boundary of each other area one of its eight
+    # neighbors is in, counted once however many neighbors are
+    z = bathy[1:-1, 1:-1]
+    valid = ~np.isnan(z)
+    index = np.arange(nrows * ncols).reshape(nrows, ncols)
+    keys = []
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            neighbor = labels[dy:dy + nrows, dx:dx + ncols]
+            edge = (neighbor > 0) & (neighbor != inner) & valid
+            keys.append(neighbor[edge] * (nrows * ncols) + index[edge])
+    keys = np.unique(np.concatenate(keys))
+    (label, cell) = (keys // (nrows * ncols), keys % (nrows * ncols))
+    (row, col) = (cell // ncols, cell % ncols)
+    x = georef.x_min + (col + 0.5) * georef.cell_width - centers[label, 0]
+    y = georef.y_max - (row + 0.5) * georef.cell_height - centers[label, 1]
+    z = z[row, col]
+    for (i, weights) in enumerate((None, x, y, z, x * x, x * y, y * y,
+                                   x * z, y * z), start=2):
+        sums[i] = np.bincount(label, weights=weights, minlength=count + 1)
+    return sums
+
+
+def solve_planes(sums, centers):
+    """
+    Planes of best fit of each area from the boundary sums of
+    label_moments, as (dz_dx, dz_dy, intercept) arrays in map
+    coordinates. Areas with fewer than three boundary cells, or all
+    in a line, are NaN.
+    """
+    (n, sx, sy, sz, sxx, sxy, syy, sxz, syz) = sums[2:]
+    normal = np.array([[sxx, sxy, sx], [sxy, syy, sy], [sx, sy, n]])
+    normal = np.moveaxis(normal, -1, 0)
+    rhs = np.stack([sxz, syz, sz], axis=-1)
+    det = np.linalg.det(normal)
+    solvable = (n >= 3) & (np.abs(det) > 1e-9 * np.abs(sxx * syy * n))
+    planes = np.full(rhs.shape, np.nan)
+    if solvable.any():
+        planes[solvable] = np.linalg.solve(
+            normal[solvable], rhs[solvable][..., np.newaxis])[..., 0]
+    (dz_dx, dz_dy, mean) = planes.T
+    return (dz_dx, dz_dy,
+            mean - dz_dx * centers[:, 0] - dz_dy * centers[:, 1])
+
+
+def batch_acr(in_raster, areas, georef, labels, memory_budget=None):
+    """
+    Surface area, planar area and plane of best fit of every area of
+    areas, whose cells are labeled in the TileStore labels, from one
+    tiled pass over the bathymetry. Tiles with no labeled cells are
+    skipped. Returns a list of (surface area, planar area, plane).
+    """
+    be = utils.backend()
+    count = len(areas)
+    centers = np.zeros((count + 1, 2))
+    for (i, rings) in enumerate(areas, start=1):
+        points = np.concatenate([np.asarray(ring)[:, :2] for ring in rings])
+        centers[i] = (points.min(axis=0) + points.max(axis=0)) / 2.0
+
+    (tile, _) = memory.tile_size(memory.KERNEL_COSTS['acr'], 3, 1,
+                                 budget=memory_budget)
+    windows = [(row, col, min(tile, georef.nrows - row),
+                min(tile, georef.ncols - col))
+               for row in range(0, georef.nrows, tile)
+               for col in range(0, georef.ncols, tile)]
+    sums = np.zeros((11, count + 1))
+
+    def read(window):
+        # the window with its one cell halo, padded past the raster edge
+        (row, col, nrows, ncols) = window
+        (top, left) = (max(row - 1, 0), max(col - 1, 0))
+        bottom = min(row + nrows + 1, georef.nrows)
+        right = min(col + ncols + 1, georef.ncols)
+        halo = (window, (top, left, bottom - top, right - left))
+        block_labels = labels.read(halo[1])
+        if not (block_labels > 0).any():
+            return None
+        pad = ((1 - (row - top), 1 - (bottom - row - nrows)),
+               (1 - (col - left), 1 - (right - col - ncols)))
+        block_labels = np.pad(block_labels.astype(np.int64), pad,
+                              mode='constant')
+        bathy = np.pad(np.asarray(be.read_array(in_raster, halo[1]),
+                                  dtype=np.float64), pad, mode='constant',
+                       constant_values=np.nan)
+        return (bathy, block_labels)
+
+    def compute(window, blocks):
+        if blocks is None:
+            return None
+        return label_moments(blocks[0], blocks[1], georef.window(*window),
+                             centers, count)
+
+    def write(window, block_sums):
+        if block_sums is not None:
+            sums[:] += block_sums
+
+    pipeline(windows, read, compute, write, threaded=be.threadsafe_io)
+    planes = solve_planes(sums, centers)
+    results = []
+    for i in range(1, count + 1):
+        plane = (planes[0][i], planes[1][i], planes[2][i])
+        if sums[0][i] == 0 or np.isnan(plane[0]):
+            results.append((np.nan, np.nan, (np.nan, np.nan, np.nan)))
+            continue
+        planar_area = float(sums[0][i] * georef.cell_size**2 *
+                            np.sqrt(1 + plane[0]**2 + plane[1]**2))
+        results.append((float(sums[1][i]), planar_area, plane))
+    return results
+
+
+def window_acr_block(in_array, halo, sizes, cell_width, cell_height):
+    """
+    Arc-chord ratio over the size x size window of each cell, for each of
+    sizes, with the block's (above, below, left, right) halo removed: the
+    ACR of area_acr, with the window as the area and the ring of cells
+    around it as its boundary. Integral images of the per cell surface
+    areas, and of the moments of the boundary cells' plane fit, are built
+    once, so each window's plane is solved from a few lookups. NoData
+    cells are NoData.
+    """
+    # pad blocks on the raster edge out to the full halo with NoData
+    overlap = scales_overlap(sizes)
+    (above, below, left, right) = halo
+    bathy = np.pad(np.asarray(in_array, dtype=np.float64),
+                   ((overlap - above, overlap - below),
+                    (overlap - left, overlap - right)),
+                   mode='constant', constant_values=np.nan)
+    (nrows, ncols) = bathy.shape
+    areas = np.full(bathy.shape, np.nan)
+    areas[1:-1, 1:-1] = surface_areas(bathy, cell_width, cell_height,
+                                      False)[0]
+    valid = ~np.isnan(areas)
+    integrals = [focal.integral_image(valid),
+                 focal.integral_image(np.where(valid, areas, 0))]
+    del areas
+
+    # plane fit moments in cells from the block's center, which as whole
+    # numbers sum exactly, and depths from their mean
+    (rows, cols) = np.mgrid[0:nrows, 0:ncols]
+    (rows, cols) = (rows - nrows // 2, cols - ncols // 2)
+    points = ~np.isnan(bathy)
+    (x, y) = (np.where(points, cols, 0), np.where(points, rows, 0))
+    mean = np.mean(bathy[points]) if points.any() else 0.0
+    z = np.where(points, bathy - mean, 0)
+    for moment in (points, x, y, x * x, x * y, y * y, z, x * z, y * z):
+        integrals.append(focal.integral_image(moment))
+    del x, y, z
+
+    crop = overlap
+    (cx, cy) = (cols[crop:nrows - crop, crop:ncols - crop],
+                rows[crop:nrows - crop, crop:ncols - crop])
+    nodata = ~points[crop:nrows - crop, crop:ncols - crop]
+    cell_area = ((cell_width + cell_height) / 2.0)**2
+
+    def window_sum(integral, extent):
+        # as focal.window_sum, for the cells inside the halo only, whose
+        # windows need no clipping, so are plain slices
+        (above, below, left, right) = extent
+        top = slice(crop - above, nrows - crop - above)
+        bottom = slice(crop + below + 1, nrows - crop + below + 1)
+        first = slice(crop - left, ncols - crop - left)
+        last = slice(crop + right + 1, ncols - crop + right + 1)
+        return (integral[bottom, last] - integral[top, last] -
+                integral[bottom, first] + integral[top, first])
+
+    results = []
+    for size in sizes:
+        extent = focal.Neighborhood.rectangle(size).extent
+        grown = [width + 1 for width in extent]
+        (cells, surface) = (window_sum(integrals[0], extent),
+                            window_sum(integrals[1], extent))
+        (n, sx, sy, sxx, sxy, syy, sz, sxz, syz) = [
+            window_sum(integral, grown) - window_sum(integral, extent)
+            for integral in integrals[2:]]
+        # center on the window's cell, then on the boundary's mean
+        (sxx, sxy, syy) = (sxx - 2 * cx * sx + n * cx * cx,
+                           sxy - cx * sy - cy * sx + n * cx * cy,
+                           syy - 2 * cy * sy + n * cy * cy)
+        (sx, sy) = (sx - n * cx, sy - n * cy)
+        (sxz, syz) = (sxz - cx * sz, syz - cy * sz)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            (cxx, cxy, cyy) = (sxx - sx * sx / n, sxy - sx * sy / n,
+                               syy - sy * sy / n)
+            (cxz, cyz) = (sxz - sx * sz / n, syz - sy * sz / n)
+            det = cxx * cyy - cxy * cxy
+            # the gradient per cell, along columns and down rows
+            dz_dcol = (cyy * cxz - cxy * cyz) / det
+            dz_drow = (cxx * cyz - cxy * cxz) / det
+            planar = cells * cell_area * np.sqrt(
+                1 + (dz_dcol / cell_width)**2 + (dz_drow / cell_height)**2)
+            result = surface / planar
+        result[(n < 3) | ~(det > 1e-9 * cxx * cyy) | (cells == 0) |
+               nodata] = np.nan
+        results.append(result.astype(np.float32))
+    return results
+
+
+def multiple_scales(in_raster=None, neighborhood_sizes=None,
+                    out_rasters=None, memory_budget=None):
+    """
+    Compute the arc-chord ratio over square windows of each of
+    neighborhood_sizes, saving each to the matching raster of
+    out_rasters: the surface area of the cells of each window, over the
+    area of the plane of best fit to the cells around it, as main()
+    finds for a polygon. The raster is read a tile at a time, and the
+    sums each window needs are shared by all the sizes.
+    """
+    sizes = [int(size) for size in neighborhood_sizes]
+    be = utils.backend()
+    be.env.overwriteOutput = True
+    be.env.rasterStatistics = "STATISTICS"
+    be.env.compression = "LZW"
+
+    try:
+        out_rasters = [utils.validate_path(path) for path in out_rasters]
+        utils.msg("Calculating ACR Rugosity for neighborhood sizes "
+                  "{}...".format(", ".join(str(size) for size in sizes)))
+        bp = utils.BlockProcessor(in_raster)
+        overlap = scales_overlap(sizes)
+        cost = memory.KERNEL_COSTS['acr_scales'].for_outputs(len(sizes))
+        (blocksize, _) = bp.blockSize(cost, max(sizes), overlap,
+                                      memory_budget)
+        kernel = functools.partial(
+            window_acr_block, sizes=sizes,
+            cell_width=bp.georef.cell_width,
+            cell_height=bp.georef.cell_height)
+        bp.computeBlockStatistics(kernel, blocksize, out_rasters, overlap,
+                                  edges=True)
+        for path in out_rasters:
+            utils.msg("Saved output as {}".format(path))
+
+    except Exception as e:
+        utils.msg(e, mtype='error')
 
 
 def main(in_raster=None, areaOfInterest=None, saveTINs=False,
-         out_workspace=None):
+         out_workspace=None, memory_budget=None):
+    """
+    Arc-chord ratio (Model 2) of Du Preez (2014) for each polygon of
+    areaOfInterest: the surface area of the bathymetry within it, over
+    the area of the plane of best fit to the bathymetry on its boundary,
+    with the slope and aspect of that plane. The results are added to
+    areaOfInterest as the fields of ACR_FIELDS.
+
+    The polygons are rasterized onto the bathymetry grid as one grid of
+    labels, and the areas and plane fits of all of them summed in a
+    single pass over the bathymetry; only a lone polygon, or one
+    overlapping another, is computed alone, from the window of cells
+    around it. The surface area is triangulated from the cell grid, and
+    the plane fit by least squares to the cells just outside the polygon,
+    so neither TINs nor the 3D, Geostatistical or Spatial Analyst
+    extensions are needed.
 
+    TINs are no longer built, so with saveTINs, the planes of best fit
+    over each polygon are saved to <raster>_planar.tif in out_workspace
+    instead, or beside areaOfInterest.
+    """
     if isinstance(saveTINs, str) and saveTINs.lower() == 'false':
         saveTINs = False
     if isinstance(saveTINs, str) and saveTINs.lower() == 'true':
         saveTINs = True
 
-    rastName = os.path.splitext(os.path.split(in_raster)[1])[0]
-    bathyRaster = Raster(in_raster)
-    cellSize = bathyRaster.meanCellHeight
+    be = utils.backend()
+    try:
+        rastName = os.path.splitext(os.path.split(in_raster)[1])[0]
+        georef = be.describe(in_raster)
 
-    with TempDir() as d:
         # Check if multipart polygon and convert to singlepart if true
-        with arcpy.da.SearchCursor(areaOfInterest, ["SHAPE@"]) as cursor:
-            for row in cursor:
-                geometry = row[0]
-                if geometry.isMultipart is True:
-                    utils.msg("Converting multipart geometry to single parts...")
-                    singlepart = os.path.join(d, 'singlepart.shp')
-                    arcpy.MultipartToSinglepart_management(areaOfInterest,
-                                                           singlepart)
-                    arcpy.CopyFeatures_management(singlepart, areaOfInterest)
-
-        # Name temporary files
-        elevationTIN = os.path.join(d, 'elevationTIN')
-        boundaryBuffer = os.path.join(d, 'bnd_buf.shp')
-        boundaryRaster = os.path.join(d, 'bnd_rast.tif')
-        boundaryPoints = os.path.join(d, 'bnd_pts.shp')
-        pobfRaster = os.path.join(d, 'pobf_rast.tif')
-
-        # Create elevation TIN
-        utils.msg("Creating elevation TIN...")
-        # just compute statitics
-        utils.raster_properties(bathyRaster, attribute=None)
-        zTolerance = abs((bathyRaster.maximum - bathyRaster.minimum)/10)
-        arcpy.RasterTin_3d(bathyRaster, elevationTIN, str(zTolerance))
-        arcpy.EditTin_3d(elevationTIN, ["#", "<None>", "<None>",
-                                        "hardclip", "false"])
-
-        # If more than one polygon in areaOfInterest,
-        # split into separate files to process
-        splitFiles = [areaOfInterest]
-        multiple = False
-        aoi_count = int(arcpy.GetCount_management(areaOfInterest).getOutput(0))
-        if aoi_count > 1:
-            multiple = True
-            arcpy.AddField_management(areaOfInterest, "Name", "TEXT")
-            splitFiles = []
-            with arcpy.da.UpdateCursor(areaOfInterest,
-                                       "Name") as cursor:
-                for (i, row) in enumerate(cursor):
-                    row[0] = "poly_{}".format(i)
-                    splitFiles.append("in_memory\poly_{}".format(i))
-                    cursor.updateRow(row)
-            arcpy.Split_analysis(areaOfInterest, areaOfInterest,
-                                 'Name', 'in_memory')
-
-        # grab an output directory, we may need it if TINs are being saved
-        if out_workspace is None or not os.path.exists(out_workspace):
-            # get full path for aoi
-            aoi_path = arcpy.Describe(areaOfInterest).catalogPath
-            out_dir = os.path.split(aoi_path)[0]
-        else:
-            out_dir = out_workspace
-
-        # Calculate ACR for each polygon
-        pobfs = []
-        num_polys = len(splitFiles)
-        for (i, each) in enumerate(splitFiles, start=1):
-            if num_polys == 1:
-                acr_msg = "Calculating ACR Rugosity..."
+        if any(len(parts) > 1 for parts in be.polygons(areaOfInterest)):
+            utils.msg("Converting multipart geometry to single parts...")
+            be.split_multipart(areaOfInterest)
+        areas = [parts[0] for parts in be.polygons(areaOfInterest)]
+
+        if saveTINs:
+            # grab an output directory for the planes of best fit
+            if out_workspace is None or not os.path.exists(out_workspace):
+                out_dir = os.path.dirname(be.catalog_path(areaOfInterest))
             else:
-                acr_msg = ("Calculating ACR Rugosity for Area "
-                           "{} of {}...".format(i, num_polys))
-            utils.msg(acr_msg)
-
-            # Create POBF TIN
-            arcpy.Buffer_analysis(each, boundaryBuffer,
-                                  cellSize, "OUTSIDE_ONLY")
-            arcpy.Clip_management(in_raster, '#', boundaryRaster,
-                                  boundaryBuffer, '#',
-                                  'ClippingGeometry', 'NO_MAINTAIN_EXTENT')
-            arcpy.RasterToPoint_conversion(boundaryRaster,
-                                           boundaryPoints, 'Value')
-            arcpy.GlobalPolynomialInterpolation_ga(boundaryPoints, "grid_code",
-                                                   "#", pobfRaster, cellSize)
-            arcpy.CalculateStatistics_management(pobfRaster)
-            if len(splitFiles) == 1:
-                basename = '{}_planarTIN'.format(rastName)
+                out_dir = out_workspace
+            planes = []
+
+        # Calculate ACR for each polygon; many polygons are labeled on
+        # one grid and reduced together in a single pass
+        num_polys = len(areas)
+        results = [None] * num_polys
+        windows = [area_window(rings, georef) for rings in areas]
+        if num_polys > 1:
+            utils.msg("Calculating ACR Rugosity for {} areas...".format(
+                num_polys))
+            with TempDir() as d:
+                labels = utils.TileStore(os.path.join(d, 'labels.dat'),
+                                         georef.shape, dtype=np.int32)
+                try:
+                    overlapping = label_areas(areas, georef, labels)
+                    results = batch_acr(in_raster, areas, georef, labels,
+                                        memory_budget)
+                finally:
+                    labels.close()
+            # overlapping areas share cells, so are done one at a time
+            for i in overlapping:
+                results[i] = None
+        for (i, rings) in enumerate(areas):
+            if results[i] is not None:
+                continue
+            window = windows[i]
+            if window[2] < 3 or window[3] < 3:
+                results[i] = (np.nan, np.nan, (np.nan,) * 3)
+                continue
+            if num_polys == 1:
+                utils.msg("Calculating ACR Rugosity...")
             else:
-                basename = '{}_planarTIN_{}'.format(rastName, i)
-            pobf_temp = os.path.join(d, basename)
-            pobf_perm = os.path.join(out_dir, basename)
-            pobfs.append((pobf_temp, pobf_perm))
-
-            zTolerance = abs((int(Raster(pobfRaster).maximum) -
-                              int(Raster(pobfRaster).minimum))/10)
-            arcpy.RasterTin_3d(pobfRaster, pobf_temp, str(zTolerance))
-            arcpy.EditTin_3d(pobf_temp, ["#", "<None>", "<None>",
-                                         "hardclip", "false"])
-            # Calculate Rugosity
-            arcpy.PolygonVolume_3d(elevationTIN, each, "<None>",
-                                   "BELOW", "Volume1", "Surf_Area")
-            arcpy.PolygonVolume_3d(pobf_temp, each, "<None>",
-                                   "BELOW", "Volume2", "Plan_Area")
-            arcpy.AddField_management(each, "Rugosity", "DOUBLE")
-            arcpy.CalculateField_management(each, "Rugosity",
-                                            "!Surf_Area! / !Plan_Area!",
-                                            "PYTHON_9.3")
-            arcpy.DeleteField_management(each, "Volume2;Volume1;Name")
-            # Calculate Slope and Aspect
-            arcpy.AddField_management(each, "Slope", "DOUBLE")
-            arcpy.AddField_management(each, "Aspect", "DOUBLE")
-            pobfXSize = Raster(pobfRaster).meanCellWidth
-            pobfYSize = Raster(pobfRaster).meanCellHeight
-            pobfArray = arcpy.RasterToNumPyArray(pobfRaster,
-                                                 None, 3, 3)
-            dz_dx = ((pobfArray[0, 2] + 2 * pobfArray[1, 2] +
-                      pobfArray[2, 2]) -
-                     (pobfArray[0, 0] + 2 * pobfArray[1, 0] +
-                      pobfArray[2, 0])) / (8.0 * pobfXSize)
-            dz_dy = ((pobfArray[2, 0] + 2 * pobfArray[2, 1] +
-                      pobfArray[2, 2]) -
-                     (pobfArray[0, 0] + 2 * pobfArray[0, 1] +
-                      pobfArray[0, 2])) / (8.0 * pobfYSize)
-            raw_aspect = (180 / np.pi) * np.arctan2(dz_dy, -dz_dx)
-            if np.equal(dz_dy, dz_dx) and np.equal(dz_dy, 0):
-                aspect = -1
+                utils.msg("Calculating ACR Rugosity for Area {} of {}, "
+                          "which overlaps another...".format(
+                              i + 1, num_polys))
+            area_georef = georef.window(*window)
+            results[i] = area_acr(be.read_array(in_raster, window),
+                                  rasterize(rings, area_georef),
+                                  area_georef)
+
+        rows = []
+        for (i, (surface_area, planar_area, plane)) in enumerate(results):
+            window = windows[i]
+            if window[2] < 3 or window[3] < 3:
+                utils.msg("Area {} doesn't overlap {}.".format(
+                    i + 1, in_raster), mtype='warning')
+                rows.append((None,) * len(ACR_FIELDS))
+            elif np.isnan(planar_area):
+                utils.msg("Area {} has too few cells with data to fit a "
+                          "plane.".format(i + 1), mtype='warning')
+                rows.append((None,) * len(ACR_FIELDS))
             else:
-                if np.equal(raw_aspect, 0):
-                    aspect = 90
-                elif np.equal(raw_aspect, 90):
-                    aspect = 0
-                elif raw_aspect > 90:
-                    aspect = 360.0 - raw_aspect + 90
-                else:
-                    aspect = 90.0 - raw_aspect
-            with arcpy.da.UpdateCursor(each, ["Slope", "Aspect"]) as cursor:
-                for rows in cursor:
-                    rows[0] = np.arctan(np.sqrt(dz_dx**2 +
-                                                dz_dy**2))*(180/np.pi)
-                    rows[1] = aspect
-                    cursor.updateRow(rows)
-
-        # Merge split files and save to input file location
-        if multiple:
-            arcpy.Merge_management(splitFiles, areaOfInterest)
-
-        # Save TINs if requested
+                (slope, aspect) = plane_slope_aspect(plane[0], plane[1])
+                rows.append((surface_area, planar_area,
+                             surface_area / planar_area,
+                             float(slope[0]), float(aspect[0])))
+                if saveTINs:
+                    planes.append((window, areas[i], plane))
+
+        be.add_fields(areaOfInterest, ACR_FIELDS, rows)
+
+        # Save the planes of best fit if requested
         if saveTINs:
-            utils.msg("Saving elevation and planar TINs to "
-                      "{}...".format(out_dir))
-            arcpy.CopyTin_3d(elevationTIN,
-                             os.path.join(out_dir,
-                                          '{}_elevationTIN'.format(rastName)))
-
-            for (pobf_temp, pobf_perm) in pobfs:
-                arcpy.CopyTin_3d(pobf_temp, pobf_perm)
+            planar_path = os.path.join(out_dir,
+                                       '{}_planar.tif'.format(rastName))
+            utils.msg("Saving the planes of best fit to "
+                      "{}...".format(planar_path))
+            with TempDir() as d:
+                store = utils.TileStore(os.path.join(d, 'planes.dat'),
+                                        georef.shape)
+                try:
+                    store.array[:] = np.nan
+                    for (window, rings, plane) in planes:
+                        (row, col, nrows, ncols) = window
+                        mask = rasterize(rings, georef.window(*window))
+                        block = store.read(window)
+                        (y, x) = np.mgrid[0:nrows, 0:ncols]
+                        z = (plane[2] +
+                             plane[0] * (georef.x_min + (col + x + 0.5) *
+                                         georef.cell_width) +
+                             plane[1] * (georef.y_max - (row + y + 0.5) *
+                                         georef.cell_height))
+                        block[mask] = z[mask]
+                        store.write(row, col, block)
+                    store.save(be, georef, planar_path)
+                finally:
+                    store.close()
+
+    except Exception as e:
+        utils.msg(e, mtype='error')
@@ -4,18 +4,13 @@
 
 # Import system modules
 from __future__ import absolute_import
-import arcpy
 import math
 import sys
-from arcpy.sa import Aspect, Sin, Cos
 
 # local imports
 from . import utils
 from . import config
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
-
 
 def main(bathy=None, out_sin_raster=None, out_cos_raster=None):
     """
@@ -28,25 +23,26 @@ def main(bathy=None, out_sin_raster=None, out_cos_raster=None):
     """
 
     try:
-        arcpy.env.compression = "LZW"
-        arcpy.env.rasterStatistics = "STATISTICS"
+        be = utils.backend()
+        be.env.compression = "LZW"
+        be.env.rasterStatistics = "STATISTICS"
         # Calculate the aspect of the bathymetric raster. "Aspect is expressed
         # in positive degrees from 0 to 359.9, measured clockwise from north."
         utils.msg("Calculating aspect...")
-        aspect = Aspect(bathy)
+        aspect = be.aspect(bathy)
 
         # Both the sin and cos functions here expect radians, not degrees.
         # convert our Aspect raster into radians, check that the values
         # are in range.
         aspect_rad = aspect * (math.pi / 180)
 
-        aspect_sin = Sin(aspect_rad)
-        aspect_cos = Cos(aspect_rad)
+        aspect_sin = be.sin(aspect_rad)
+        aspect_cos = be.cos(aspect_rad)
 
         out_sin_raster = utils.validate_path(out_sin_raster)
         out_cos_raster = utils.validate_path(out_cos_raster)
-        arcpy.CopyRaster_management(aspect_sin, out_sin_raster)
-        arcpy.CopyRaster_management(aspect_cos, out_cos_raster)
+        be.copy_raster(aspect_sin, out_sin_raster)
+        be.copy_raster(aspect_cos, out_cos_raster)
     except Exception as e:
         utils.msg(e, mtype='error')
 
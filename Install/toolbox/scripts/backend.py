@@ -0,0 +1,843 @@
+# backend.py
+# Description: Raster backends used by the BTM tools. The 'arcpy' backend
+#              hands work to ArcPy and Spatial Analyst, while the 'numpy'
+#              backend uses NumPy for computation and GDAL for raster I/O,
+#              so the tools can run headless without an ArcGIS install.
+#
+#              Both backends expose the same small map algebra vocabulary,
+#              so a tool is written once against `utils.backend()`.
+
+from __future__ import absolute_import
+import csv
+import json
+import os
+import re
+
+import numpy as np
+try:
+    import arcpy
+    ARCPY_EXISTS = True
+except ImportError:
+    ARCPY_EXISTS = False
+try:
+    from osgeo import gdal, ogr
+    gdal.UseExceptions()
+    ogr.UseExceptions()
+    GDAL_EXISTS = True
+except ImportError:
+    GDAL_EXISTS = False
+
+# local imports
+from . import focal
+from .pipeline import pipeline
+from .tempdir import TempDir
+
+BACKENDS = ('arcpy', 'numpy')
+
+# NoData values used when writing rasters, match the ArcGIS defaults.
+FLOAT_NODATA = -3.4028234663852886e+38
+INT_NODATA = -2147483648
+
+# rows converted at a time when writing, so large (or memory-mapped)
+# arrays are never copied whole
+WRITE_ROWS = 1024
+
+
+class GeoReference(object):
+    """
+    Georeferencing for a north-up raster: the upper left corner of the
+    raster, its cell size, dimensions, and spatial reference.
+    """
+    def __init__(self, x_min, y_max, cell_width, cell_height, nrows, ncols,
+                 projection=None, nodata=None):
+        self.x_min = x_min
+        self.y_max = y_max
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.nrows = nrows
+        self.ncols = ncols
+        self.projection = projection
+        self.nodata = nodata
+
+    @property
+    def shape(self):
+        return (self.nrows, self.ncols)
+
+    @property
+    def y_min(self):
+        return self.y_max - self.nrows * self.cell_height
+
+    @property
+    def x_max(self):
+        return self.x_min + self.ncols * self.cell_width
+
+    @property
+    def cell_size(self):
+        """Mean cell size, as used for the BTM v1 calculations."""
+        return (self.cell_width + self.cell_height) / 2.0
+
+    @property
+    def geotransform(self):
+        """GDAL style affine geotransform."""
+        return (self.x_min, self.cell_width, 0.0,
+                self.y_max, 0.0, -self.cell_height)
+
+    def window(self, row, col, nrows, ncols):
+        """Georeferencing of a subset of this raster."""
+        return GeoReference(
+            self.x_min + col * self.cell_width,
+            self.y_max - row * self.cell_height,
+            self.cell_width, self.cell_height, nrows, ncols,
+            self.projection, self.nodata)
+
+    def cell_index(self, x, y):
+        """(row, col) of the cell containing the map coordinate (x, y)."""
+        row = int((self.y_max - y) // self.cell_height)
+        col = int((x - self.x_min) // self.cell_width)
+        return (row, col)
+
+
+def nodata_strips(array, nodata, dtype, rows=WRITE_ROWS):
+    """
+    Yield (row, strip) pairs covering array, with NaN replaced by the
+    nodata value and the strip cast to dtype.
+    """
+    for row in range(0, np.shape(array)[0], rows):
+        strip = np.asarray(array[row:row + rows], dtype=np.float64)
+        yield (row, np.where(np.isnan(strip), nodata, strip).astype(dtype))
+
+
+class ZoneTable(object):
+    """
+    Attribute table of a zone raster: the count of cells with each value,
+    with its zone name, area in map units, and percent of the cells which
+    aren't NoData.
+    """
+    columns = ('Value', 'Count', 'Zone', 'Area', 'Percent')
+
+    def __init__(self, values, counts, zones, cell_area):
+        self.values = np.asarray(values, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.zones = zones
+        self.cell_area = cell_area
+
+    @classmethod
+    def from_histogram(cls, histogram, zones, cell_area, offset=0):
+        """Table of the values with cells in a bincount histogram."""
+        values = np.flatnonzero(histogram)
+        return cls(values + offset, np.asarray(histogram)[values], zones,
+                   cell_area)
+
+    @classmethod
+    def from_array(cls, array, zones, cell_area):
+        """Table of the values of a NaN for NoData array."""
+        data = np.asarray(array)
+        data = data[~np.isnan(data)].astype(np.int64)
+        offset = min(int(data.min()), 0) if data.size else 0
+        return cls.from_histogram(np.bincount(data - offset), zones,
+                                  cell_area, offset)
+
+    @property
+    def names(self):
+        return [self.zones.get(str(value), 'No Matching Zone')
+                for value in self.values]
+
+    @property
+    def areas(self):
+        return self.counts * float(self.cell_area)
+
+    @property
+    def percents(self):
+        total = self.counts.sum()
+        return self.counts * 100.0 / total if total else \
+            np.zeros(len(self.counts))
+
+    def rows(self):
+        """The table as (value, count, zone, area, percent) rows."""
+        return [(int(value), int(count), name, float(area), float(percent))
+                for (value, count, name, area, percent) in zip(
+                    self.values, self.counts, self.names, self.areas,
+                    self.percents)]
+
+    def save(self, path):
+        """Write the table as CSV when path ends in .csv, else as JSON."""
+        rows = self.rows()
+        if os.path.splitext(path)[1].lower() == '.csv':
+            with open(path, 'w') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(self.columns)
+                writer.writerows(rows)
+        else:
+            with open(path, 'w') as f:
+                json.dump([dict(zip(self.columns, row)) for row in rows], f,
+                          indent=2)
+        return path
+
+
+class GeoArray(np.ndarray):
+    """
+    A float array carrying its georeferencing, with NaN for NoData.
+    Comparisons return 1.0 / 0.0 and propagate NoData, and invalid results
+    (division by zero, and the like) become NoData, as in map algebra.
+    """
+    _comparisons = (np.less, np.less_equal, np.greater,
+                    np.greater_equal, np.equal, np.not_equal)
+
+    def __new__(cls, data, georef=None):
+        obj = np.asarray(data).view(cls)
+        obj.georef = georef
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.georef = getattr(obj, 'georef', None)
+        # integer outputs are only produced by an explicit `int_`
+        self.integer = False
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        georef = None
+        arrays = []
+        for item in inputs:
+            if isinstance(item, GeoArray):
+                georef = georef or item.georef
+                item = item.view(np.ndarray)
+            arrays.append(item)
+        if 'out' in kwargs:
+            kwargs['out'] = tuple(
+                o.view(np.ndarray) if isinstance(o, GeoArray) else o
+                for o in kwargs['out'])
+
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            result = getattr(ufunc, method)(*arrays, **kwargs)
+
+        if method != '__call__' or not isinstance(result, np.ndarray):
+            return result
+        if ufunc in self._comparisons:
+            nodata = np.zeros(result.shape, dtype=bool)
+            for item in arrays:
+                if isinstance(item, np.ndarray) and item.dtype.kind == 'f':
+                    nodata |= np.isnan(item)
+            result = result.astype(np.float64)
+            result[nodata] = np.nan
+        elif result.dtype.kind == 'f':
+            result[np.isinf(result)] = np.nan
+        result = result.view(GeoArray)
+        result.georef = georef
+        return result
+
+
+class Environment(object):
+    """Stand-in for `arcpy.env` holding the settings the NumPy backend uses."""
+    def __init__(self):
+        self.workspace = None
+        self.scratchWorkspace = None
+        self.compression = 'LZW'
+        self.rasterStatistics = 'STATISTICS'
+        self.pyramid = 'NONE'
+        self.overwriteOutput = True
+        self.outputCoordinateSystem = None
+        self.addOutputsToMap = False
+
+
+class ArcpyBackend(object):
+    """Raster operations performed with ArcPy and Spatial Analyst."""
+    name = 'arcpy'
+    # ArcObjects calls are kept on the calling thread
+    threadsafe_io = False
+
+    def __init__(self):
+        if not ARCPY_EXISTS:
+            raise ImportError("The arcpy backend requires ArcGIS.")
+        arcpy.CheckOutExtension("Spatial")
+        self.env = arcpy.env
+
+    def raster(self, path):
+        """Reference a raster for use in map algebra."""
+        if isinstance(path, arcpy.sa.Raster):
+            return path
+        return arcpy.sa.Raster(path)
+
+    def describe(self, path):
+        """GeoReference for the raster at path, without reading cells."""
+        raster = self.raster(path)
+        extent = raster.extent
+        return GeoReference(
+            extent.XMin, extent.YMax, raster.meanCellWidth,
+            raster.meanCellHeight, raster.height, raster.width,
+            raster.spatialReference, raster.noDataValue)
+
+    def read_array(self, path, window=None):
+        """
+        Read a raster as a float64 GeoArray, NoData as NaN. The optional
+        window is a (row, col, nrows, ncols) tuple.
+        """
+        raster = self.raster(path)
+        georef = self.describe(raster)
+        if window is None:
+            window = (0, 0, georef.nrows, georef.ncols)
+        georef = georef.window(*window)
+        lower_left = arcpy.Point(georef.x_min, georef.y_min)
+        (nrows, ncols) = window[2:]
+        if raster.noDataValue is not None:
+            data = arcpy.RasterToNumPyArray(
+                raster, lower_left, ncols, nrows, raster.noDataValue)
+        else:
+            data = arcpy.RasterToNumPyArray(raster, lower_left, ncols, nrows)
+        if data.ndim > 2:
+            data = np.squeeze(data[0, :, :])
+        array = data.astype(np.float64)
+        if raster.noDataValue is not None:
+            array[data == raster.noDataValue] = np.nan
+        return GeoArray(array, georef)
+
+    def write_array(self, array, georef, path, integer=False, zones=None):
+        """
+        Write a NaN for NoData array to path as a raster. Integer rasters
+        can include a zones mapping of values to names, see
+        add_zone_names(), or a ZoneTable, see add_zone_table().
+        """
+        if integer:
+            (nodata, dtype) = (INT_NODATA, np.int32)
+        else:
+            (nodata, dtype) = (FLOAT_NODATA, np.float32)
+        # NumPyArrayToRaster needs the whole array, build it a strip at a
+        # time to avoid full size temporaries
+        data = np.empty(np.shape(array), dtype=dtype)
+        for (row, strip) in nodata_strips(array, nodata, dtype):
+            data[row:row + strip.shape[0]] = strip
+        lower_left = arcpy.Point(georef.x_min, georef.y_min)
+        out = arcpy.NumPyArrayToRaster(data, lower_left, georef.cell_width,
+                                       georef.cell_height, nodata)
+        if georef.projection is not None:
+            arcpy.DefineProjection_management(out, georef.projection)
+        arcpy.CopyRaster_management(out, path)
+        if integer and isinstance(zones, ZoneTable):
+            self.add_zone_table(path, zones)
+        elif integer and zones is not None:
+            self.add_zone_names(path, zones)
+        return path
+
+    def copy_raster(self, raster, path):
+        """Persist a raster to path."""
+        if isinstance(raster, GeoArray):
+            return self.write_array(raster, raster.georef, path,
+                                    raster.integer)
+        arcpy.CopyRaster_management(raster, path)
+        return path
+
+    def save(self, raster, path):
+        """Save a map algebra result to path, and return a reference."""
+        raster.save(path)
+        return arcpy.sa.Raster(path)
+
+    def delete(self, path):
+        arcpy.Delete_management(path)
+
+    def catalog_path(self, raster):
+        """Full path of a raster, or the source of a raster layer."""
+        return arcpy.Describe(raster).catalogPath
+
+    def workspace_type(self, path):
+        return arcpy.Describe(path).workspaceType
+
+    def validate_table_name(self, name):
+        return arcpy.ValidateTableName(name)
+
+    def nbr_rectangle(self, width, height):
+        return arcpy.sa.NbrRectangle(width, height, "CELL")
+
+    def nbr_circle(self, radius):
+        return arcpy.sa.NbrCircle(radius, "CELL")
+
+    def nbr_annulus(self, inner_radius, outer_radius):
+        return arcpy.sa.NbrAnnulus(inner_radius, outer_radius, "CELL")
+
+    def focal_statistics(self, raster, neighborhood, stat, ignore_nodata=True):
+        nodata = "DATA" if ignore_nodata else "NODATA"
+        return arcpy.sa.FocalStatistics(raster, neighborhood, stat, nodata)
+
+    def focal_moments(self, raster, neighborhood, stats, ignore_nodata=True):
+        """
+        Several focal statistics, as a dict keyed by statistic. Spatial
+        Analyst has no variance statistic, so it is the squared STD.
+        """
+        results = {}
+        for stat in stats:
+            if stat == 'VARIANCE':
+                if 'STD' not in results:
+                    results['STD'] = self.focal_statistics(
+                        raster, neighborhood, 'STD', ignore_nodata)
+                results[stat] = arcpy.sa.Power(results['STD'], 2)
+            elif stat not in results:
+                results[stat] = self.focal_statistics(
+                    raster, neighborhood, stat, ignore_nodata)
+        return dict((stat, results[stat]) for stat in stats)
+
+    def con(self, condition, true_value, false_value):
+        return arcpy.sa.Con(condition, true_value, false_value)
+
+    def is_raster(self, obj):
+        return isinstance(obj, arcpy.sa.Raster)
+
+    def add_zone_names(self, raster, key):
+        """Add a Zone field to the attribute table, mapping values to names."""
+        arcpy.AddField_management(raster, 'Zone', 'TEXT')
+        cursor = arcpy.UpdateCursor(raster)
+        for row in cursor:
+            val = str(row.getValue('VALUE'))
+            if val in key:
+                row.setValue('Zone', key[val])
+                cursor.updateRow(row)
+            else:
+                row.setValue('Zone', 'No Matching Zone')
+                cursor.updateRow(row)
+        del(cursor)
+        return raster
+
+    def add_zone_table(self, raster, table):
+        """
+        Add the Zone, Area and Percent fields of a ZoneTable to the
+        attribute table, filled in one pass of a data access cursor.
+        """
+        arcpy.AddField_management(raster, 'Zone', 'TEXT')
+        arcpy.AddField_management(raster, 'Area', 'DOUBLE')
+        arcpy.AddField_management(raster, 'Percent', 'DOUBLE')
+        rows = dict((row[0], row[2:]) for row in table.rows())
+        fields = ['VALUE', 'Zone', 'Area', 'Percent']
+        with arcpy.da.UpdateCursor(raster, fields) as cursor:
+            for row in cursor:
+                (zone, area, percent) = rows.get(
+                    int(row[0]), ('No Matching Zone', None, None))
+                cursor.updateRow([row[0], zone, area, percent])
+        return raster
+
+    def polygons(self, path):
+        """
+        The parts of each polygon feature of path, in feature order: a
+        list for each feature of its parts, each a list of (n, 2) arrays
+        of ring coordinates, the exterior ring first.
+        """
+        features = []
+        with arcpy.da.SearchCursor(path, ["SHAPE@"]) as cursor:
+            for (geometry,) in cursor:
+                parts = []
+                for part in geometry:
+                    rings = [[]]
+                    for point in part:
+                        # interior rings follow a null point
+                        if point is None:
+                            rings.append([])
+                        else:
+                            rings[-1].append((point.X, point.Y))
+                    parts.append([np.array(ring) for ring in rings if ring])
+                features.append(parts)
+        return features
+
+    def split_multipart(self, path):
+        """Replace the multipart features of path with one per part."""
+        with TempDir() as d:
+            singlepart = os.path.join(d, 'singlepart.shp')
+            arcpy.MultipartToSinglepart_management(path, singlepart)
+            arcpy.CopyFeatures_management(singlepart, path)
+
+    def add_fields(self, path, names, rows):
+        """
+        Add the double fields names to the features of path, filled from
+        rows, a tuple of values for each feature in feature order. None
+        leaves a value null.
+        """
+        existing = [field.name for field in arcpy.ListFields(path)]
+        for name in names:
+            if name not in existing:
+                arcpy.AddField_management(path, name, "DOUBLE")
+        with arcpy.da.UpdateCursor(path, names) as cursor:
+            for (row, values) in zip(cursor, rows):
+                cursor.updateRow(list(values))
+
+    def slope(self, raster):
+        return arcpy.sa.Slope(raster, "DEGREE", 1)
+
+    def aspect(self, raster):
+        return arcpy.sa.Aspect(raster)
+
+    def sin(self, raster):
+        return arcpy.sa.Sin(raster)
+
+    def cos(self, raster):
+        return arcpy.sa.Cos(raster)
+
+    def int_(self, raster):
+        return arcpy.sa.Int(raster)
+
+    def shift(self, raster, x_cells, y_cells, path):
+        """Shift a raster by whole cells, saving the result to path."""
+        raster = self.raster(raster)
+        arcpy.Shift_management(raster, path, x_cells * raster.meanCellWidth,
+                               y_cells * raster.meanCellHeight)
+        return arcpy.sa.Raster(path)
+
+
+class NumpyBackend(object):
+    """
+    Raster operations performed on in-memory NumPy arrays, with GDAL
+    used for reading and writing rasters.
+    """
+    name = 'numpy'
+    # each GDAL read and write opens its own dataset handle
+    threadsafe_io = True
+
+    def __init__(self):
+        if not GDAL_EXISTS:
+            raise ImportError("The numpy backend requires the GDAL Python "
+                              "bindings (`osgeo`) for raster I/O.")
+        self.env = Environment()
+
+    def _resolve(self, path):
+        if not os.path.isabs(path) and self.env.workspace:
+            path = os.path.join(self.env.workspace, path)
+        return path
+
+    def raster(self, path):
+        """Read a raster for use in map algebra."""
+        if isinstance(path, GeoArray):
+            return path
+        return self.read_array(path)
+
+    def describe(self, path):
+        """GeoReference for the raster at path, without reading cells."""
+        if isinstance(path, GeoArray):
+            return path.georef
+        dataset = gdal.Open(self._resolve(path))
+        (x_min, cell_width, _, y_max, _, cell_height) = \
+            dataset.GetGeoTransform()
+        band = dataset.GetRasterBand(1)
+        return GeoReference(
+            x_min, y_max, cell_width, abs(cell_height), dataset.RasterYSize,
+            dataset.RasterXSize, dataset.GetProjection(),
+            band.GetNoDataValue())
+
+    def read_array(self, path, window=None):
+        """
+        Read a raster as a float64 GeoArray, NoData as NaN. The optional
+        window is a (row, col, nrows, ncols) tuple.
+        """
+        georef = self.describe(path)
+        if window is None:
+            window = (0, 0, georef.nrows, georef.ncols)
+        (row, col, nrows, ncols) = window
+        if isinstance(path, GeoArray):
+            data = path.view(np.ndarray)[row:row + nrows, col:col + ncols]
+            return GeoArray(np.array(data), georef.window(*window))
+        dataset = gdal.Open(self._resolve(path))
+        band = dataset.GetRasterBand(1)
+        data = band.ReadAsArray(col, row, ncols, nrows)
+        array = data.astype(np.float64)
+        if georef.nodata is not None:
+            array[data == georef.nodata] = np.nan
+        return GeoArray(array, georef.window(*window))
+
+    def write_array(self, array, georef, path, integer=False, zones=None):
+        """
+        Write a NaN for NoData array to path as a GeoTIFF. Integer rasters
+        can include a zones mapping of values to names, or a ZoneTable,
+        which is written as the raster attribute table.
+        """
+        path = self._resolve(path)
+        if os.path.splitext(os.path.dirname(path))[1].lower() in \
+                ('.gdb', '.mdb', '.sde'):
+            raise ValueError("Geodatabase outputs require the arcpy "
+                             "backend: {}".format(path))
+        if integer:
+            (gdal_type, nodata, dtype) = (gdal.GDT_Int32, INT_NODATA,
+                                          np.int32)
+        else:
+            (gdal_type, nodata, dtype) = (gdal.GDT_Float32, FLOAT_NODATA,
+                                          np.float32)
+        options = ['TILED=YES', 'BIGTIFF=IF_SAFER']
+        if self.env.compression and self.env.compression != 'NONE':
+            options.append('COMPRESS={}'.format(self.env.compression))
+
+        driver = gdal.GetDriverByName('GTiff')
+        (nrows, ncols) = np.shape(array)
+        dataset = driver.Create(path, ncols, nrows, 1, gdal_type, options)
+        dataset.SetGeoTransform(georef.geotransform)
+        if georef.projection:
+            dataset.SetProjection(georef.projection)
+        band = dataset.GetRasterBand(1)
+        band.SetNoDataValue(nodata)
+        # NoData is swapped into the next strip while GDAL compresses and
+        # writes the last one
+        pipeline(nodata_strips(array, nodata, dtype),
+                 lambda strip: strip[1], lambda strip, data: data,
+                 lambda strip, data: band.WriteArray(data, 0, strip[0]))
+        if integer and zones is not None:
+            if not isinstance(zones, ZoneTable):
+                zones = ZoneTable.from_array(
+                    array, zones, georef.cell_width * georef.cell_height)
+            band.SetDefaultRAT(self._zone_table(zones))
+        if self.env.rasterStatistics == 'STATISTICS':
+            band.ComputeStatistics(False)
+        band.FlushCache()
+        dataset = None
+        return path
+
+    def _zone_table(self, zones):
+        """GDAL attribute table of a ZoneTable, written a column at a time."""
+        table = gdal.RasterAttributeTable()
+        table.CreateColumn('Value', gdal.GFT_Integer, gdal.GFU_MinMax)
+        table.CreateColumn('Count', gdal.GFT_Integer, gdal.GFU_PixelCount)
+        table.CreateColumn('Zone', gdal.GFT_String, gdal.GFU_Name)
+        table.CreateColumn('Area', gdal.GFT_Real, gdal.GFU_Generic)
+        table.CreateColumn('Percent', gdal.GFT_Real, gdal.GFU_Generic)
+        table.SetRowCount(len(zones.values))
+        names = np.array([name.encode('utf-8') for name in zones.names],
+                         dtype=np.bytes_)
+        for (column, data) in enumerate((
+                zones.values.astype(np.int32), zones.counts.astype(np.int32),
+                names, zones.areas, zones.percents)):
+            table.WriteArray(data, column)
+        return table
+
+    def copy_raster(self, raster, path):
+        """Persist a raster to path."""
+        raster = self.raster(raster)
+        return self.write_array(raster, raster.georef, path, raster.integer,
+                                getattr(raster, 'zones', None))
+
+    def save(self, raster, path):
+        """Save a map algebra result to path, and return a reference."""
+        self.copy_raster(raster, path)
+        return raster
+
+    def delete(self, path):
+        path = self._resolve(path)
+        if os.path.exists(path):
+            gdal.GetDriverByName('GTiff').Delete(path)
+
+    def catalog_path(self, raster):
+        """Full path of a raster."""
+        return os.path.abspath(self._resolve(raster))
+
+    def raster_property(self, path, attribute='MEAN'):
+        """
+        Equivalent of GetRasterProperties_management. Statistics are
+        computed and stored with the raster if they don't yet exist;
+        with no attribute, only the statistics are computed.
+        """
+        if isinstance(path, GeoArray):
+            georef = path.georef
+            data = path[~np.isnan(path)].view(np.ndarray)
+            stats = [data.min(), data.max(), data.mean(), data.std()]
+        else:
+            georef = self.describe(path)
+            dataset = gdal.Open(self._resolve(path))
+            stats = dataset.GetRasterBand(1).GetStatistics(False, True)
+            dataset = None
+        if not attribute:
+            return None
+        properties = {
+            'MINIMUM': stats[0],
+            'MAXIMUM': stats[1],
+            'MEAN': stats[2],
+            'STD': stats[3],
+            'CELLSIZEX': georef.cell_width,
+            'CELLSIZEY': georef.cell_height,
+            'ROWCOUNT': georef.nrows,
+            'COLUMNCOUNT': georef.ncols,
+            'TOP': georef.y_max,
+            'BOTTOM': georef.y_min,
+            'LEFT': georef.x_min,
+            'RIGHT': georef.x_max
+        }
+        return properties[attribute.upper()]
+
+    def workspace_type(self, path):
+        if os.path.splitext(path)[1].lower() in ('.gdb', '.mdb'):
+            return 'LocalDatabase'
+        return 'FileSystem'
+
+    def validate_table_name(self, name):
+        name = re.sub(r'\W', '_', name)
+        if not re.match('[A-Za-z]', name):
+            name = 'T' + name
+        return name
+
+    def nbr_rectangle(self, width, height):
+        return focal.Neighborhood.rectangle(width, height)
+
+    def nbr_circle(self, radius):
+        return focal.Neighborhood.circle(radius)
+
+    def nbr_annulus(self, inner_radius, outer_radius):
+        return focal.Neighborhood.annulus(inner_radius, outer_radius)
+
+    def focal_statistics(self, raster, neighborhood, stat, ignore_nodata=True):
+        raster = self.raster(raster)
+        result = focal.focal_statistics(raster.view(np.ndarray), neighborhood,
+                                        stat, ignore_nodata)
+        return GeoArray(result, raster.georef)
+
+    def focal_moments(self, raster, neighborhood, stats, ignore_nodata=True):
+        """
+        Several focal statistics from one pass over the raster, as a dict
+        keyed by statistic.
+        """
+        raster = self.raster(raster)
+        results = focal.focal_moments(raster.view(np.ndarray), neighborhood,
+                                      stats, ignore_nodata)
+        return dict((stat, GeoArray(result, raster.georef))
+                    for (stat, result) in results.items())
+
+    def con(self, condition, true_value, false_value):
+        condition = self.raster(condition)
+        result = np.where(condition.view(np.ndarray) != 0,
+                          np.asarray(true_value, dtype=np.float64),
+                          np.asarray(false_value, dtype=np.float64))
+        result[np.isnan(condition.view(np.ndarray))] = np.nan
+        result = GeoArray(result, condition.georef)
+        # as in Spatial Analyst, integer inputs give an integer output
+        result.integer = all(_is_integer(value)
+                             for value in (true_value, false_value))
+        return result
+
+    def is_raster(self, obj):
+        return isinstance(obj, GeoArray)
+
+    def add_zone_names(self, raster, key):
+        """
+        Map values to zone names, written as the Zone field of the
+        attribute table when the raster is saved.
+        """
+        raster.zones = key
+        return raster
+
+    def polygons(self, path):
+        """
+        The parts of each polygon feature of path, in feature order: a
+        list for each feature of its parts, each a list of (n, 2) arrays
+        of ring coordinates, the exterior ring first.
+        """
+        dataset = ogr.Open(self._resolve(path))
+        features = []
+        for feature in dataset.GetLayer():
+            geometry = feature.GetGeometryRef()
+            if geometry.GetGeometryCount() and \
+                    geometry.GetGeometryRef(0).GetGeometryCount():
+                polygons = [geometry.GetGeometryRef(i)
+                            for i in range(geometry.GetGeometryCount())]
+            else:
+                polygons = [geometry]
+            features.append([
+                [np.array(polygon.GetGeometryRef(i).GetPoints())[:, :2]
+                 for i in range(polygon.GetGeometryCount())]
+                for polygon in polygons])
+        return features
+
+    def split_multipart(self, path):
+        """Replace the multipart features of path with one per part."""
+        dataset = ogr.Open(self._resolve(path), 1)
+        layer = dataset.GetLayer()
+        multipart = [feature.GetFID() for feature in layer
+                     if feature.GetGeometryRef().GetGeometryCount() and
+                     feature.GetGeometryRef().GetGeometryRef(0)
+                     .GetGeometryCount()]
+        for fid in multipart:
+            feature = layer.GetFeature(fid)
+            geometry = feature.GetGeometryRef()
+            for i in range(geometry.GetGeometryCount()):
+                part = feature.Clone()
+                part.SetFID(-1)
+                part.SetGeometry(geometry.GetGeometryRef(i).Clone())
+                layer.CreateFeature(part)
+            layer.DeleteFeature(fid)
+        if multipart and dataset.GetDriver().GetName() == 'ESRI Shapefile':
+            dataset.ExecuteSQL('REPACK {}'.format(layer.GetName()))
+        dataset = None
+
+    def add_fields(self, path, names, rows):
+        """
+        Add the double fields names to the features of path, filled from
+        rows, a tuple of values for each feature in feature order. None
+        leaves a value null.
+        """
+        dataset = ogr.Open(self._resolve(path), 1)
+        layer = dataset.GetLayer()
+        for name in names:
+            if layer.FindFieldIndex(name, True) < 0:
+                layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+        layer.ResetReading()
+        for (feature, values) in zip(layer, rows):
+            for (name, value) in zip(names, values):
+                if value is None:
+                    feature.SetFieldNull(name)
+                else:
+                    feature.SetField(name, float(value))
+            layer.SetFeature(feature)
+        dataset = None
+
+    def slope(self, raster):
+        raster = self.raster(raster)
+        georef = raster.georef
+        result = focal.slope(raster.view(np.ndarray), georef.cell_width,
+                             georef.cell_height)
+        return GeoArray(result, georef)
+
+    def aspect(self, raster):
+        raster = self.raster(raster)
+        georef = raster.georef
+        result = focal.aspect(raster.view(np.ndarray), georef.cell_width,
+                              georef.cell_height)
+        return GeoArray(result, georef)
+
+    def sin(self, raster):
+        return np.sin(self.raster(raster))
+
+    def cos(self, raster):
+        return np.cos(self.raster(raster))
+
+    def int_(self, raster):
+        result = np.trunc(self.raster(raster))
+        result.integer = True
+        return result
+
+    def shift(self, raster, x_cells, y_cells, path=None):
+        """
+        Shift a raster by whole cells, x to the east and y to the north.
+        Cells shifted in from outside the extent are NoData.
+        """
+        raster = self.raster(raster)
+        (nrows, ncols) = raster.shape
+        result = np.full(raster.shape, np.nan)
+        (dy, dx) = (-int(y_cells), int(x_cells))
+        src_rows = slice(max(0, -dy), min(nrows, nrows - dy))
+        dst_rows = slice(max(0, dy), min(nrows, nrows + dy))
+        src_cols = slice(max(0, -dx), min(ncols, ncols - dx))
+        dst_cols = slice(max(0, dx), min(ncols, ncols + dx))
+        result[dst_rows, dst_cols] = raster.view(np.ndarray)[src_rows,
+                                                             src_cols]
+        return GeoArray(result, raster.georef)
+
+
+def _is_integer(value):
+    """Test if a map algebra operand holds integer values."""
+    if isinstance(value, GeoArray):
+        return value.integer
+    try:
+        return float(value).is_integer()
+    except (TypeError, ValueError):
+        return False
+
+
+def get_backend(name=None):
+    """
+    Create the named backend. With no name, prefer ArcPy when it's
+    available, and fall back to NumPy otherwise.
+    """
+    if name is None:
+        name = 'arcpy' if ARCPY_EXISTS else 'numpy'
+    name = name.lower()
+    if name == 'arcpy':
+        return ArcpyBackend()
+    elif name == 'numpy':
+        return NumpyBackend()
+    raise ValueError("Unknown backend `{}`, expected one of {}".format(
+        name, ", ".join(BACKENDS)))
@@ -9,7 +9,7 @@
 #              An integrated XML-based terrain classification dictionary gives
 #              users the freedom to create their own classifications and
 #              definethe relationships that characterize them.
-# Requirements: Spatial Analyst
+# Requirements: NumPy
 # Authors: Dawn J. Wright, Emily R. Lundblad, Emily M. Larkin, Ronald W. Rinehart
 # Date: 2005
 # Converted 11/5/2010 by Emily C. Huntley of the Massachusetts Office of Coastal
@@ -18,56 +18,276 @@
 # a Python addin GUI, as a standard python script or from a toolbox.
 
 from __future__ import absolute_import
+import functools
+import os
 import sys
 
-import arcpy
-from arcpy.sa import NbrAnnulus, Int, Plus, Minus, FocalStatistics
+import numpy as np
 
 # local imports
 from . import utils
 from . import config
+from . import focal
+from . import memory
+from . import standardize_bpi_grids
+from .pipeline import pipeline
+from .tempdir import TempDir
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
+BPI_METHODS = ('direct', 'runlength', 'fft', 'auto')
+# BPI is spilled to disk as whole numbers while its moments are gathered;
+# the wider type is only used when a BPI value doesn't fit the narrower.
+SPILL_DTYPES = (np.int16, np.int32)
+
+
+def bpi_block(in_array, halo, neighborhoods, method='runlength'):
+    """
+    BPI of a block for each annulus in neighborhoods, with the block's
+    (above, below, left, right) halo removed: the depth less the mean
+    depth of the annulus, truncated to an integer as Int does, after
+    rounding by adding one half.
+    """
+    (above, below, left, right) = halo
+    (nrows, ncols) = in_array.shape
+    crop = (slice(above, nrows - below), slice(left, ncols - right))
+    return [np.trunc(in_array[crop] - mean[crop] + 0.5)
+            for mean in focal.focal_means(in_array, neighborhoods, method)]
 
 
 def main(bathy=None, inner_radius=None, outer_radius=None,
-         out_raster=None, bpi_type='broad'):
+         out_raster=None, bpi_type='broad', memory_budget=None,
+         method=None):
     """
     Create a bathymetric position index (BPI) raster, which
     measures the average value in a 'donut' of locations, excluding
     cells too close to the origin point, and outside a set distance.
+
+    method selects how the annulus mean is computed, defaulting to
+    config.bpi_method:
+        direct -- the backend's focal statistics, over the whole raster.
+        runlength -- a block at a time, from row prefix sums of the
+                     annulus' runs of cells; the cost per cell grows with
+                     the outer radius.
+        fft -- a block at a time, by FFT convolution; the cost per cell
+               grows with the log of the outer radius.
+        auto -- the faster of runlength and fft for the annulus.
+    NoData cells are left out of the mean. The memory_budget, in bytes or
+    a string such as '8GB', bounds the blocks.
     """
-    arcpy.env.compression = "LZW"
-    arcpy.env.rasterStatistics = "STATISTICS"
-    try:
-        # Create the broad-scale Bathymetric Position Index (BPI) raster
-        msg = ("Generating the {bpi_type}-scale Bathymetric"
-               "Position Index (BPI) raster...".format(bpi_type=bpi_type))
+    multiple_scales(bathy, [(inner_radius, outer_radius)], [out_raster],
+                    [bpi_type], memory_budget, method)
+
+
+def _annulus_blocks(bp, radii, memory_budget, method):
+    """
+    The neighborhoods, overlap, block size and mean method for computing
+    the BPI of each pair of radii a block at a time with bp.
+    """
+    neighborhoods = [focal.Neighborhood.annulus(inner, outer)
+                     for (inner, outer) in radii]
+    overlap = max(focal.enclosing_extent(neighborhoods))
+    window = overlap * 2 + 1
+    if method == 'auto':
+        (blocksize, _) = bp.blockSize(
+            memory.KERNEL_COSTS['annulus'].for_outputs(len(radii)),
+            window, overlap, memory_budget)
+        block_shape = (min(blocksize + overlap * 2, bp.height),
+                       min(blocksize + overlap * 2, bp.width))
+        method = focal.mean_method(neighborhoods, block_shape)
+    cost = memory.KERNEL_COSTS['annulus_fft' if method == 'fft' else 'annulus']
+    (blocksize, _) = bp.blockSize(cost.for_outputs(len(radii)),
+                                  window, overlap, memory_budget)
+    return (neighborhoods, overlap, blocksize, method)
+
+
+def strips(blocksize, nrows, ncols):
+    """
+    (row, col, nrows, ncols) windows of whole rows, each holding no more
+    cells than a blocksize x blocksize block, so wider rasters are read
+    in fewer rows at a time.
+    """
+    rows = max(1, blocksize**2 // ncols)
+    return [(row, 0, min(rows, nrows - row), ncols)
+            for row in range(0, nrows, rows)]
+
+
+def _check_method(method):
+    if method is None:
+        method = config.bpi_method
+    method = method.lower()
+    if method not in BPI_METHODS:
+        raise ValueError("Unknown BPI method `{}`, expected one of "
+                         "{}".format(method, ", ".join(BPI_METHODS)))
+    return method
 
-        utils.msg(msg)
+
+def multiple_scales(bathy=None, radii=None, out_rasters=None,
+                    bpi_types=None, memory_budget=None, method=None):
+    """
+    Create a BPI raster for each (inner radius, outer radius) pair in
+    radii, saved to the matching raster of out_rasters. Except with the
+    direct method, every block of the bathymetry is read once for all the
+    annuli, which share its row prefix sums or forward transforms, and the
+    BPI rasters are written together. bpi_types names each scale in the
+    messages, such as 'broad' or 'fine'. See main() for the methods.
+
+    The mean and standard deviation of each BPI raster are accumulated
+    as its blocks are written, and stored beside it (see utils.Moments)
+    for standardize_bpi_grids.
+    """
+    if bpi_types is None:
+        bpi_types = [None] * len(radii)
+    be = utils.backend()
+    be.env.compression = "LZW"
+    be.env.rasterStatistics = "STATISTICS"
+    try:
+        for bpi_type in bpi_types:
+            scale = "{}-scale ".format(bpi_type) if bpi_type else ""
+            utils.msg("Generating the {}Bathymetric Position Index (BPI) "
+                      "raster...".format(scale))
+        method = _check_method(method)
+        out_paths = [utils.validate_path(path) for path in out_rasters]
         utils.msg("Calculating neighborhood...")
-        neighborhood = NbrAnnulus(inner_radius, outer_radius, "CELL")
-        utils.msg("Calculating FocalStatistics for {}...".format(bathy))
-        out_focal_statistics = FocalStatistics(bathy, neighborhood, "MEAN")
-        result_raster = Int(Plus(Minus(bathy, out_focal_statistics), 0.5))
-
-        out_raster_path = utils.validate_path(out_raster)
-        arcpy.CopyRaster_management(result_raster, out_raster_path)
-        utils.msg("Saved output as {}".format(out_raster_path))
+        if method == 'direct':
+            bathy_raster = be.raster(bathy)
+            for ((inner_radius, outer_radius), out_path) in zip(radii,
+                                                                out_paths):
+                neighborhood = be.nbr_annulus(inner_radius, outer_radius)
+                utils.msg("Calculating FocalStatistics for {}...".format(
+                    bathy))
+                out_focal_statistics = be.focal_statistics(
+                    bathy_raster, neighborhood, "MEAN")
+                result_raster = be.int_(
+                    bathy_raster - out_focal_statistics + 0.5)
+                be.copy_raster(result_raster, out_path)
+                # the statistics of any earlier raster there are stale
+                utils.Moments.discard(out_path)
+        else:
+            bp = utils.BlockProcessor(bathy)
+            (neighborhoods, overlap, blocksize, method) = _annulus_blocks(
+                bp, radii, memory_budget, method)
+            utils.msg("Calculating the annulus mean for {}, using the {} "
+                      "method...".format(bathy, method))
+            moments = bp.computeBlockStatistics(
+                functools.partial(bpi_block, neighborhoods=neighborhoods,
+                                  method=method),
+                blocksize, out_paths, overlap, edges=True, integer=True,
+                moments=True)
+            for (out_path, out_moments) in zip(out_paths, moments):
+                try:
+                    out_moments.save(out_path)
+                except (IOError, OSError) as e:
+                    utils.msg("Unable to store the statistics of {}: "
+                              "{}".format(out_path, e), mtype='warning')
+        for out_path in out_paths:
+            utils.msg("Saved output as {}".format(out_path))
+    except Exception as e:
+        utils.msg(e, mtype='error')
+
+
+def standardized_scales(bathy=None, radii=None, out_rasters=None,
+                        bpi_types=None, memory_budget=None, method=None):
+    """
+    Create a standardized BPI raster for each (inner radius, outer radius)
+    pair in radii, as multiple_scales followed by standardize_bpi_grids
+    would, without saving the BPI rasters in between.
+
+    The BPI blocks are spilled to whole numbered scratch files while
+    their mean and standard deviation are gathered, then each is
+    standardized a strip of rows at a time into its output. The spills
+    are 16-bit, unless a BPI value doesn't fit, when they are computed
+    again as 32-bit. The direct method computes the BPI rasters with the
+    backend instead, into a scratch folder.
+    """
+    if bpi_types is None:
+        bpi_types = [None] * len(radii)
+    be = utils.backend()
+    be.env.compression = "LZW"
+    be.env.rasterStatistics = "STATISTICS"
+    try:
+        method = _check_method(method)
+        out_paths = [utils.validate_path(path) for path in out_rasters]
+        if method == 'direct':
+            with TempDir() as d:
+                bpi_paths = [os.path.join(d, 'bpi{}.tif'.format(i))
+                             for i in range(len(radii))]
+                multiple_scales(bathy, radii, bpi_paths, bpi_types,
+                                memory_budget, method)
+                for (bpi_path, out_path) in zip(bpi_paths, out_paths):
+                    standardize_bpi_grids.main(bpi_path, out_path)
+            return
+
+        for bpi_type in bpi_types:
+            scale = "{}-scale ".format(bpi_type) if bpi_type else ""
+            utils.msg("Generating the standardized {}Bathymetric Position "
+                      "Index (BPI) raster...".format(scale))
+        bp = utils.BlockProcessor(bathy)
+        (neighborhoods, overlap, blocksize, method) = _annulus_blocks(
+            bp, radii, memory_budget, method)
+        shape = (bp.height, bp.width)
+        utils.msg("Calculating the annulus mean for {}, using the {} "
+                  "method...".format(bathy, method))
+        with TempDir() as d:
+            for dtype in SPILL_DTYPES:
+                spills = [utils.TileStore(
+                    os.path.join(d, 'bpi{}.dat'.format(i)), shape,
+                    dtype=dtype) for i in range(len(radii))]
+                moments = bp.computeBlocks(
+                    functools.partial(bpi_block, neighborhoods=neighborhoods,
+                                      method=method),
+                    blocksize, spills, overlap, edges=True, moments=True)
+                limit = np.iinfo(dtype).max
+                if dtype == SPILL_DTYPES[-1] or all(
+                        m.count == 0 or (-limit <= m.minimum and
+                                         m.maximum <= limit)
+                        for m in moments):
+                    break
+                for spill in spills:
+                    spill.close()
+                utils.msg("BPI values exceed the range of {}, computing "
+                          "them again...".format(np.dtype(dtype).name))
+
+            # standardize a strip of rows at a time, each the size of a
+            # block, so the strips the pipeline holds fit the budget too
+            windows = strips(blocksize, bp.height, bp.width)
+            for (spill, out_moments, out_path) in zip(spills, moments,
+                                                      out_paths):
+                utils.msg("BPI raster mean: {}.".format(out_moments.mean))
+                utils.msg("BPI raster standard deviation: {}.".format(
+                    out_moments.std))
+                out_store = utils.TileStore(
+                    os.path.join(d, 'std.dat'), shape)
+                try:
+                    pipeline(
+                        windows, spill.read,
+                        lambda strip, bpi, m=out_moments: np.trunc(
+                            (bpi - m.mean) / m.std * 100 + 0.5),
+                        lambda strip, std: out_store.write(
+                            strip[0], strip[1], std))
+                    utils.msg("Saving result to {}...".format(out_path))
+                    out_store.save(be, bp.georef, out_path, integer=True)
+                finally:
+                    out_store.close()
+                    spill.close()
+        for out_path in out_paths:
+            utils.msg("Saved output as {}".format(out_path))
     except Exception as e:
         utils.msg(e, mtype='error')
 
 # when executing as a standalone script get parameters from sys
 if __name__ == '__main__':
     config.mode = 'script'
-    if len(sys.argv) == 6:
+    if len(sys.argv) >= 6:
         bpi_type = sys.argv[5]
     else:
         bpi_type = 'broad'
+    if len(sys.argv) >= 7:
+        method = sys.argv[6]
+    else:
+        method = None
     main(
         bathy=sys.argv[1],
         inner_radius=sys.argv[2],
         outer_radius=sys.argv[3],
         out_raster=sys.argv[4],
-        bpi_type=bpi_type)
+        bpi_type=bpi_type,
+        method=method)
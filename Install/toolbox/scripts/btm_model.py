@@ -11,7 +11,6 @@
 # ---------------------------------------------------------------------------
 
 from __future__ import absolute_import
-import arcpy
 import os
 import sys
 
@@ -24,61 +23,76 @@ from . import classify
 from . import slope
 from . import standardize_bpi_grids as standardize_bpi
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
-
 
 def main(out_workspace, input_bathymetry, broad_bpi_inner_radius,
          broad_bpi_outer_radius, fine_bpi_inner_radius,
-         fine_bpi_outer_radius, classification_dict, output_zones):
+         fine_bpi_outer_radius, classification_dict, output_zones,
+         keep_bpi=True):
     """
     Compute complete model. The crux of this computation maps ranges
     of values provided in the classification dictionary (a CSV or Excel
     spreadsheet) to bathymetry derivatives: standardized
     fine- and broad- scale BPI and slope.
+
+    Unless keep_bpi, the BPI rasters are standardized as they are
+    computed, and only the standardized rasters are saved.
     """
 
+    # the toolbox passes the option as text, or None when it's left unset
+    if keep_bpi is None:
+        keep_bpi = True
+    elif isinstance(keep_bpi, str) and keep_bpi.lower() == 'false':
+        keep_bpi = False
+
+    be = utils.backend()
+    # intermediates are GRIDs with ArcGIS, GeoTIFFs otherwise
+    ext = '' if be.name == 'arcpy' else '.tif'
+
     # local variables:
-    broad_bpi = os.path.join(out_workspace, "broad_bpi")
-    fine_bpi = os.path.join(out_workspace, "fine_bpi")
-    slope_rast = os.path.join(out_workspace, "slope")
-    broad_std = os.path.join(out_workspace, "broad_std")
-    fine_std = os.path.join(out_workspace, "fine_std")
+    broad_bpi = os.path.join(out_workspace, "broad_bpi" + ext)
+    fine_bpi = os.path.join(out_workspace, "fine_bpi" + ext)
+    slope_rast = os.path.join(out_workspace, "slope" + ext)
+    broad_std = os.path.join(out_workspace, "broad_std" + ext)
+    fine_std = os.path.join(out_workspace, "fine_std" + ext)
 
     utils.workspace_exists(out_workspace)
     # set geoprocessing environments
-    arcpy.env.scratchWorkspace = out_workspace
-    arcpy.env.workspace = out_workspace
+    be.env.scratchWorkspace = out_workspace
+    be.env.workspace = out_workspace
 
     # TODO: currently set to automatically overwrite, expose this as option
-    arcpy.env.overwriteOutput = True
+    be.env.overwriteOutput = True
 
     try:
-        # Process: Build Broad Scale BPI
-        utils.msg("Calculating broad-scale BPI...")
-        bpi.main(input_bathymetry, broad_bpi_inner_radius,
-                 broad_bpi_outer_radius, broad_bpi, bpi_type='broad')
-
-        # Process: Build Fine Scale BPI
-        utils.msg("Calculating fine-scale BPI...")
-        bpi.main(input_bathymetry, fine_bpi_inner_radius,
-                 fine_bpi_outer_radius, fine_bpi, bpi_type='fine')
-
-        # Process: Standardize BPIs
-        utils.msg("Standardizing BPI rasters...")
-        standardize_bpi.main(broad_bpi, broad_std)
-        standardize_bpi.main(fine_bpi, fine_std)
+        # Process: Build Broad and Fine Scale BPI, in one pass over the
+        # bathymetry
+        utils.msg("Calculating broad-scale and fine-scale BPI...")
+        radii = [(broad_bpi_inner_radius, broad_bpi_outer_radius),
+                 (fine_bpi_inner_radius, fine_bpi_outer_radius)]
+        if keep_bpi:
+            bpi.multiple_scales(input_bathymetry, radii,
+                                [broad_bpi, fine_bpi],
+                                bpi_types=['broad', 'fine'])
+
+            # Process: Standardize BPIs
+            utils.msg("Standardizing BPI rasters...")
+            standardize_bpi.main(broad_bpi, broad_std)
+            standardize_bpi.main(fine_bpi, fine_std)
+        else:
+            bpi.standardized_scales(input_bathymetry, radii,
+                                    [broad_std, fine_std],
+                                    bpi_types=['broad', 'fine'])
 
         # Process: Calculate Slope
         slope.main(input_bathymetry, slope_rast)
 
         # Process: Zone Classification Builder
-        outputs_base = arcpy.env.addOutputsToMap
-        arcpy.env.addOutputsToMap = True
+        outputs_base = be.env.addOutputsToMap
+        be.env.addOutputsToMap = True
         utils.msg("Classifying Zones...")
         classify.main(classification_dict, broad_std, fine_std,
                       slope_rast, input_bathymetry, output_zones)
-        arcpy.env.addOutputsToMap = outputs_base
+        be.env.addOutputsToMap = outputs_base
 
     except Exception as e:
         # Print error message if an error occurs
@@ -87,6 +101,10 @@ def main(out_workspace, input_bathymetry, broad_bpi_inner_radius,
 # when executing as a standalone script get parameters from sys
 if __name__ == '__main__':
     config.mode = 'script'
+    if len(sys.argv) >= 10:
+        keep_bpi = sys.argv[9]
+    else:
+        keep_bpi = True
     main(
         out_workspace=sys.argv[1],
         input_bathymetry=sys.argv[2],
@@ -95,4 +113,5 @@ if __name__ == '__main__':
         fine_bpi_inner_radius=sys.argv[5],
         fine_bpi_outer_radius=sys.argv[6],
         classification_dict=sys.argv[7],
-        output_zones=sys.argv[8])
+        output_zones=sys.argv[8],
+        keep_bpi=keep_bpi)
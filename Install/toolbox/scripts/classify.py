@@ -4,19 +4,32 @@
 
 # Import system modules
 from __future__ import absolute_import
+import hashlib
 import os
 import sys
-import textwrap
+import tempfile
 
-import arcpy
-from arcpy.sa import Con
+import numpy as np
 
 # local imports
 from . import utils
 from . import config
+from . import memory
+from .backend import ZoneTable
+from .pipeline import pipeline
+from .tempdir import TempDir
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
+# the bounds each class can test, as (input, dictionary prefix) pairs. In
+# the order Con evaluates them, outermost first, so a NoData cell in an
+# earlier input decides a class before a later input is tested.
+BOUNDS = (('broad', 'SSB'), ('fine', 'LSB'), ('slope', 'Slope'),
+          ('depth', 'Depth'))
+# bumped when the format of the cached compiled classes changes
+CACHE_VERSION = 1
+# relative costs per cell of testing one bound of one class with masks,
+# and of finding the classes accepting an input's value from the index
+MASK_COST = 1.0
+INDEX_COST = 15.0
 
 
 class NoValidClasses(Exception):
@@ -32,37 +45,531 @@ def run_con(lower_bounds, upper_bounds, in_grid, true_val, true_alt=None):
             lower_bounds, upper_bounds, in_grid, true_val, true_alt))
 
     out_grid = None
+    be = utils.backend()
 
     # if our initial desired output value isn't set, use the backup
     if true_val is None:
         true_val = true_alt
     # calculate our output grid
+    if lower_bounds is not None or upper_bounds is not None:
+        in_grid = be.raster(in_grid)
     if lower_bounds is not None:
         if upper_bounds is not None:
-            out_grid_a = Con(
-                in_grid, true_val, 0, "VALUE < {}".format(upper_bounds))
-            out_grid = Con(
-                in_grid, out_grid_a, 0, "VALUE > {}".format(lower_bounds))
+            out_grid_a = be.con(
+                in_grid < float(upper_bounds), true_val, 0)
+            out_grid = be.con(
+                in_grid > float(lower_bounds), out_grid_a, 0)
         else:
-            out_grid = Con(
-                in_grid, true_val, 0, "VALUE >= {}".format(lower_bounds))
+            out_grid = be.con(
+                in_grid >= float(lower_bounds), true_val, 0)
     elif upper_bounds is not None:
-        out_grid = Con(
-            in_grid, true_val, 0, "VALUE <= {}".format(upper_bounds))
+        out_grid = be.con(
+            in_grid <= float(upper_bounds), true_val, 0)
 
-    if type(out_grid).__name__ == 'NoneType' and \
-       type(true_val) == arcpy.sa.Raster:
+    if out_grid is None and be.is_raster(true_val):
         out_grid = true_val
 
     return out_grid
 
 
+def in_bounds(data, lower=None, upper=None):
+    """
+    Cells of data within the bounds of a class, as run_con tests them:
+    strictly between both bounds, or at or beyond a single bound. NoData
+    cells are never within bounds.
+    """
+    with np.errstate(invalid='ignore'):
+        if lower is not None and upper is not None:
+            return (data > lower) & (data < upper)
+        elif lower is not None:
+            return data >= lower
+        return data <= upper
+
+
+def class_rules(classes):
+    """
+    Numeric rules for the classes of a classification dictionary: a list
+    of (class, name, bounds) in priority order, where bounds is a list of
+    (input, lower, upper) for each input the class tests, in the order
+    BOUNDS. Also returns the classes which test no inputs.
+    """
+    rules = []
+    unbounded = []
+    for item in classes:
+        bounds = []
+        for (name, prefix) in BOUNDS:
+            lower = item["{}_LowerBounds".format(prefix)]
+            upper = item["{}_UpperBounds".format(prefix)]
+            if lower is not None or upper is not None:
+                bounds.append((
+                    name,
+                    float(lower) if lower is not None else None,
+                    float(upper) if upper is not None else None))
+        if bounds:
+            rules.append((int(item["Class"]), str(item["Zone"]), bounds))
+        else:
+            unbounded.append(item)
+    return (rules, unbounded)
+
+
+def used_inputs(rules):
+    """Names of the inputs tested by any of rules, in the order BOUNDS."""
+    tested = set(bound[0] for rule in rules for bound in rule[2])
+    return [name for (name, _) in BOUNDS if name in tested]
+
+
+def classify_block(arrays, rules, method='auto'):
+    """
+    Classify a block, given a dict of input name to array, with NaN for
+    NoData, and the rules of class_rules(). Matches evaluating each class
+    with nested Con calls and merging them in turn: a cell takes the first
+    class which doesn't reject it, and is NoData if that class reaches a
+    NoData input before the cell falls outside its bounds. Cells no class
+    takes are zero. See ClassIndex for the methods.
+    """
+    return ClassIndex.from_rules(rules).classify(arrays, method)
+
+
+def _classify_masks(arrays, rules):
+    """classify_block, testing the classes in turn with boolean masks."""
+    shape = np.shape(next(iter(arrays.values())))
+    result = np.zeros(shape)
+    undecided = np.ones(shape, dtype=bool)
+    # classes often share bounds, each is tested once per block
+    masks = {}
+    nodata = dict((name, np.isnan(data)) for (name, data) in arrays.items())
+    for (value, _, bounds) in rules:
+        candidates = undecided.copy()
+        for bound in bounds:
+            name = bound[0]
+            missing = candidates & nodata[name]
+            result[missing] = np.nan
+            undecided &= ~missing
+            if bound not in masks:
+                masks[bound] = in_bounds(arrays[name], *bound[1:])
+            candidates &= masks[bound]
+        result[candidates] = value
+        undecided &= ~candidates
+        if not undecided.any():
+            break
+    return result
+
+
+def _bit(position):
+    """(word, mask) of a class' bit in a bitset of 64-bit words."""
+    return (position // 64, np.uint64(1) << np.uint64(position % 64))
+
+
+class ClassIndex(object):
+    """
+    A classification dictionary compiled for evaluating its classes a
+    block at a time, with one of two methods:
+        masks -- test the classes in turn, with a boolean mask for each
+                 distinct bound; the cost per cell grows with the number
+                 of bounds the classes test.
+        index -- the distinct bounds of each input split its values into
+                 intervals: the open intervals between bounds, and the
+                 bounds themselves, where strict and inclusive bounds
+                 differ. Each interval, and NoData, has a bitset of the
+                 classes which accept it, so a cell finds its interval
+                 with a binary search, and the classes which accept it by
+                 intersecting the bitsets of its inputs. The cost per cell
+                 grows with the log of the number of bounds, and with the
+                 number of classes only in words of 64 classes.
+        auto -- the cheaper of the two for the dictionary.
+
+    The bounds of class i, in priority order, are lower[name][i] and
+    upper[name][i] for each input name, NaN when not given.
+    """
+    def __init__(self, values, names, lower, upper, zones=None,
+                 unbounded=()):
+        self.values = np.asarray(values, dtype=np.int64)
+        self.names = [str(name) for name in names]
+        self.lower = lower
+        self.upper = upper
+        self.zones = zones if zones is not None else {}
+        self.unbounded = [str(name) for name in unbounded]
+        self.inputs = [name for (name, _) in BOUNDS if name in lower]
+        self.words = max((len(self.values) + 63) // 64, 1)
+        self._rules = None
+        self.breaks = {}
+        self.accepts = {}
+        for name in self.inputs:
+            self._compile(name)
+
+    @classmethod
+    def from_rules(cls, rules, zones=None, unbounded=()):
+        """Compile the rules of class_rules()."""
+        lower = {}
+        upper = {}
+        for name in used_inputs(rules):
+            lower[name] = np.full(len(rules), np.nan)
+            upper[name] = np.full(len(rules), np.nan)
+        for (i, (_, _, bounds)) in enumerate(rules):
+            for (name, low, high) in bounds:
+                if low is not None:
+                    lower[name][i] = low
+                if high is not None:
+                    upper[name][i] = high
+        return cls([rule[0] for rule in rules], [rule[1] for rule in rules],
+                   lower, upper, zones, unbounded)
+
+    @property
+    def rules(self):
+        """The classes as the rules of class_rules()."""
+        if self._rules is not None:
+            return self._rules
+        rules = []
+        for (i, (value, name)) in enumerate(zip(self.values, self.names)):
+            bounds = []
+            for input_name in self.inputs:
+                (low, high) = (self.lower[input_name][i],
+                               self.upper[input_name][i])
+                if not (np.isnan(low) and np.isnan(high)):
+                    bounds.append((
+                        input_name,
+                        None if np.isnan(low) else float(low),
+                        None if np.isnan(high) else float(high)))
+            rules.append((int(value), name, bounds))
+        self._rules = rules
+        return rules
+
+    def method(self):
+        """The cheaper classification method for these classes."""
+        bounds = sum(len(rule[2]) for rule in self.rules)
+        if bounds * MASK_COST > len(self.inputs) * INDEX_COST:
+            return 'index'
+        return 'masks'
+
+    def _compile(self, name):
+        (lower, upper) = (self.lower[name], self.upper[name])
+        bounds = np.concatenate([lower, upper])
+        breaks = np.unique(bounds[~np.isnan(bounds)])
+        # a value in each interval: below, at and between the breaks
+        samples = np.empty(len(breaks) * 2 + 1)
+        samples[1::2] = breaks
+        samples[2:-1:2] = (breaks[:-1] + breaks[1:]) / 2.0
+        samples[0] = np.nextafter(breaks[0], -np.inf)
+        samples[-1] = np.nextafter(breaks[-1], np.inf)
+        # the last interval is NoData, accepted by classes not testing it
+        accepts = np.zeros((len(samples) + 1, self.words), dtype=np.uint64)
+        for i in range(len(self.values)):
+            (word, mask) = _bit(i)
+            (low, high) = (lower[i], upper[i])
+            if np.isnan(low) and np.isnan(high):
+                accepts[:, word] |= mask
+            else:
+                accepted = in_bounds(samples,
+                                     None if np.isnan(low) else low,
+                                     None if np.isnan(high) else high)
+                accepts[:-1, word][accepted] |= mask
+        self.breaks[name] = breaks
+        self.accepts[name] = accepts
+
+    def intervals(self, name, data):
+        """Index of the interval of name holding each value of data."""
+        breaks = self.breaks[name]
+        position = np.searchsorted(breaks, data)
+        exact = np.zeros(np.shape(data), dtype=bool)
+        inside = position < len(breaks)
+        exact[inside] = breaks[position[inside]] == data[inside]
+        intervals = position * 2 + exact
+        intervals[np.isnan(data)] = len(breaks) * 2 + 1
+        return intervals
+
+    def classify(self, arrays, method='auto'):
+        """
+        Classify a block, given a dict of input name to array, as
+        classify_block() does.
+        """
+        if method == 'auto':
+            method = self.method()
+        if method == 'masks':
+            return _classify_masks(arrays, self.rules)
+        shape = np.shape(arrays[self.inputs[0]])
+        cells = int(np.prod(shape))
+        # classes still accepting each cell, and those which reached a
+        # NoData input while accepting it
+        alive = np.full((cells, self.words), ~np.uint64(0), dtype=np.uint64)
+        nodata = np.zeros((cells, self.words), dtype=np.uint64)
+        for name in self.inputs:
+            data = np.ravel(arrays[name])
+            accepted = self.accepts[name][self.intervals(name, data)]
+            missing = np.isnan(data)
+            nodata[missing] |= alive[missing] & ~accepted[missing]
+            alive &= accepted
+
+        # the first class deciding each cell, by its lowest bit
+        result = np.zeros(cells)
+        undecided = np.ones(cells, dtype=bool)
+        for word in range(self.words):
+            deciding = alive[:, word] | nodata[:, word]
+            found = undecided & (deciding != 0)
+            if not found.any():
+                continue
+            lowest = deciding[found] & (~deciding[found] + np.uint64(1))
+            position = np.log2(lowest.astype(np.float64)).astype(np.int64)
+            classes = word * 64 + position
+            matched = (alive[found, word] & lowest) != 0
+            result[found] = np.where(matched, self.values[classes], np.nan)
+            undecided &= ~found
+        return result.reshape(shape)
+
+    def save(self, path):
+        """Store the compiled classes as a NumPy .npz file."""
+        arrays = {
+            'values': self.values,
+            'names': np.array(self.names, dtype=str),
+            'zone_values': np.array(list(self.zones.keys()),
+                                    dtype=str),
+            'zone_names': np.array(list(self.zones.values()),
+                                   dtype=str),
+            'unbounded': np.array(self.unbounded, dtype=str),
+        }
+        for name in self.inputs:
+            arrays['lower_{}'.format(name)] = self.lower[name]
+            arrays['upper_{}'.format(name)] = self.upper[name]
+            arrays['breaks_{}'.format(name)] = self.breaks[name]
+            arrays['accepts_{}'.format(name)] = self.accepts[name]
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Compiled classes stored by save(), or None if unreadable."""
+        try:
+            with np.load(path, allow_pickle=False) as stored:
+                index = cls.__new__(cls)
+                index.values = stored['values']
+                index.names = [str(name) for name in stored['names']]
+                index.zones = dict(zip(
+                    [str(value) for value in stored['zone_values']],
+                    [str(name) for name in stored['zone_names']]))
+                index.unbounded = [str(name) for name in stored['unbounded']]
+                index.inputs = [name for (name, _) in BOUNDS
+                                if 'lower_{}'.format(name) in stored]
+                index.words = max((len(index.values) + 63) // 64, 1)
+                index._rules = None
+                (index.lower, index.upper) = ({}, {})
+                (index.breaks, index.accepts) = ({}, {})
+                for name in index.inputs:
+                    index.lower[name] = stored['lower_{}'.format(name)]
+                    index.upper[name] = stored['upper_{}'.format(name)]
+                    index.breaks[name] = stored['breaks_{}'.format(name)]
+                    index.accepts[name] = stored['accepts_{}'.format(name)]
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        return index
+
+
+def cache_path(classification_file):
+    """
+    Where the compiled classes of a classification dictionary are cached,
+    keyed by a hash of its contents, so an edited file is compiled again.
+    """
+    cache_dir = config.cache_dir
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'btm_cache')
+    digest = hashlib.sha1()
+    with open(classification_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return os.path.join(cache_dir, 'classes_v{}_{}.npz'.format(
+        CACHE_VERSION, digest.hexdigest()))
+
+
+def load_classification(classification_file):
+    """
+    The ClassIndex of a classification dictionary, from the cache when
+    the same dictionary has been compiled before, otherwise parsed from
+    the XML, CSV or Excel document, compiled and cached.
+    """
+    path = cache_path(classification_file)
+    index = ClassIndex.load(path)
+    if index is not None:
+        utils.msg("Using the cached classes of {}... found {} "
+                  "classes.".format(classification_file,
+                                    len(index.values) + len(index.unbounded)))
+        return index
+
+    # Read in the BTM Document; the class handles parsing a variety of inputs.
+    btm_doc = utils.BtmDocument(classification_file)
+    classes = btm_doc.classification()
+    utils.msg("Parsing {} document... found {} classes.".format(
+        btm_doc.doctype, len(classes)))
+
+    key = {'0': 'None'}
+    for item in classes:
+        key[str(item["Class"])] = str(item["Zone"])
+    (rules, unbounded) = class_rules(classes)
+    index = ClassIndex.from_rules(rules, key,
+                                  [item["Zone"] for item in unbounded])
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        index.save(path)
+    except (IOError, OSError) as e:
+        utils.msg("Unable to cache the compiled classes: {}".format(e),
+                  mtype='warning')
+    return index
+
+
+def aligned(georefs):
+    """Test if rasters share their extent and cell size."""
+    first = georefs[0]
+    for georef in georefs[1:]:
+        if georef.shape != first.shape or not np.allclose(
+                (georef.x_min, georef.y_max, georef.cell_width,
+                 georef.cell_height),
+                (first.x_min, first.y_max, first.cell_width,
+                 first.cell_height)):
+            return False
+    return True
+
+
+def classify_rasters(index, inputs, out_raster, memory_budget=None):
+    """
+    Classify aligned rasters with a ClassIndex, reading a tile of every
+    input it tests at a time, and writing the zones to out_raster.
+    inputs maps each input name of BOUNDS to its raster. Returns the
+    ZoneTable of the output, see zone_tiles().
+    """
+    rasters = dict((name, inputs[name]) for name in index.inputs)
+    return zone_tiles(rasters, index.classify, index.values, index.zones,
+                      out_raster, memory_budget)
+
+
+def zone_tiles(inputs, func, values, zones, out_raster, memory_budget=None):
+    """
+    Write a zone raster computed a tile at a time from aligned rasters.
+    func is given a dict of input name to tile, NaN for NoData, for each
+    tile of the dict of input name to raster inputs, and returns its
+    zones, whole numbers among values. The cells of each zone are counted
+    as the tiles are written, for the attribute table, which names the
+    zones with the mapping of value to name zones. Returns the ZoneTable
+    of the output.
+    """
+    return multiple_zone_tiles(inputs, [(func, values, zones)],
+                               [out_raster], memory_budget)[0]
+
+
+def multiple_zone_tiles(inputs, layers, out_rasters, memory_budget=None):
+    """
+    As zone_tiles(), for each (func, values, zones) of layers, written to
+    the matching raster of out_rasters. Each tile of the inputs is read
+    once, and given to every func. Returns the ZoneTable of each output.
+    """
+    be = utils.backend()
+    names = sorted(inputs)
+    georef = be.describe(inputs[names[0]])
+    (tile, _) = memory.tile_size(
+        memory.KERNEL_COSTS['classify'].for_outputs(len(layers)), 1,
+        budget=memory_budget)
+    windows = [(row, col, min(tile, georef.nrows - row),
+                min(tile, georef.ncols - col))
+               for row in range(0, georef.nrows, tile)
+               for col in range(0, georef.ncols, tile)]
+
+    # zone values, offset so each histogram starts at the smallest
+    offsets = [min(int(np.min(values)), 0) for (_, values, _) in layers]
+    histograms = [np.zeros(max(int(np.max(values)), 0) - offset + 1,
+                           dtype=np.int64)
+                  for ((_, values, _), offset) in zip(layers, offsets)]
+
+    def read(window):
+        return dict((name, np.asarray(be.read_array(inputs[name], window)))
+                    for name in names)
+
+    def compute(window, arrays):
+        return [func(arrays) for (func, _, _) in layers]
+
+    def write(window, blocks):
+        for (store, histogram, offset, block) in zip(
+                stores, histograms, offsets, blocks):
+            store.write(window[0], window[1], block)
+            zones = block[~np.isnan(block)].astype(np.int64) - offset
+            histogram[:] += np.bincount(zones, minlength=len(histogram))
+
+    tables = []
+    with TempDir() as d:
+        stores = [utils.TileStore(os.path.join(d, 'zones{}.dat'.format(i)),
+                                  georef.shape) for i in range(len(layers))]
+        try:
+            pipeline(windows, read, compute, write,
+                     threaded=be.threadsafe_io)
+            for ((_, _, zones), histogram, offset, store, out_raster) in zip(
+                    layers, histograms, offsets, stores, out_rasters):
+                table = ZoneTable.from_histogram(
+                    histogram, zones,
+                    georef.cell_width * georef.cell_height, offset)
+                utils.msg("Saving Output to {}".format(out_raster))
+                store.save(be, georef, out_raster, integer=True,
+                           zones=table)
+                tables.append(table)
+        finally:
+            for store in stores:
+                store.close()
+    return tables
+
+
+def _classify_con(rules, inputs, out_raster, key):
+    """
+    Classify with a Con for each bound of each class, then merge the
+    classes with further Con calls. Used for inputs on different grids,
+    which Con resamples.
+    """
+    be = utils.backend()
+    grids = []
+    con_paths = []
+    try:
+        for (value, name, bounds) in rules:
+            cur_class = str(value)
+            utils.msg("Calculating grid for {}...".format(name))
+            # here come the CONs, the last input innermost:
+            out_con = None
+            for (input_name, lower, upper) in reversed(bounds):
+                out_con = run_con(lower, upper, inputs[input_name], out_con,
+                                  cur_class)
+            con_path = utils.validate_path("con_{}.tif".format(name))
+            rast = utils.save_raster(out_con, con_path)
+            grids.append(rast)
+            con_paths.append(con_path)
+
+        utils.msg("Creating Benthic Terrain Classification Dataset...")
+        merge_grid = grids[0]
+        for i in range(1, len(grids)):
+            utils.msg("{} of {}".format(i, len(grids)-1))
+            merge_grid = be.con(merge_grid == 0, grids[i], merge_grid)
+        be.add_zone_names(merge_grid, key)
+
+        utils.msg("Saving Output to {}".format(out_raster))
+        be.copy_raster(merge_grid, out_raster)
+    finally:
+        try:
+            utils.msg("Deleting intermediate data...")
+            # Delete all intermediate raster data sets
+            del grids
+            for con_path in con_paths:
+                be.delete(con_path)
+        except Exception as e:
+            # hack -- swallowing this exception, because sometimes
+            # refs are left around for these files.
+            utils.msg("Failed to delete all intermediate data.",
+                      mtype='warning')
+
+
 def main(classification_file, bpi_broad_std, bpi_fine_std,
-         slope, bathy, out_raster=None):
+         slope, bathy, out_raster=None, out_summary=None):
     """
     Perform raster classification, based on classification mappings
     and provided raster derivatives (fine- and broad- scale BPI,
     slope, and the original raster). Outputs a classified raster.
+
+    Inputs sharing a grid are classified in one pass, a tile at a time,
+    with all the classes evaluated together (see ClassIndex). The
+    attribute table of the zones, with their cell counts, areas and
+    percent cover, is also written to out_summary if given, as CSV when
+    it ends in .csv and JSON otherwise.
     """
     try:
         # set up scratch workspace
@@ -73,94 +580,50 @@ def main(classification_file, bpi_broad_std, bpi_fine_std,
         out_workspace = os.path.dirname(out_raster)
         # make sure workspace exists
         utils.workspace_exists(out_workspace)
-        arcpy.env.scratchWorkspace = out_workspace
-        arcpy.env.workspace = out_workspace
+        be = utils.backend()
+        be.env.scratchWorkspace = out_workspace
+        be.env.workspace = out_workspace
 
-        arcpy.env.overwriteOutput = True
+        be.env.overwriteOutput = True
         # Create the broad-scale Bathymetric Position Index (BPI) raster
         msg_text = ("Generating the classified grid, based on the provided"
                     " classes in '{}'.".format(classification_file))
         utils.msg(msg_text)
 
-        # Read in the BTM Document; the class handles parsing a variety of inputs.
-        btm_doc = utils.BtmDocument(classification_file)
-        classes = btm_doc.classification()
-        utils.msg("Parsing {} document... found {} classes.".format(
-            btm_doc.doctype, len(classes)))
-
-        grids = []
-        key = {'0': 'None'}
-        for item in classes:
-            cur_class = str(item["Class"])
-            cur_name = str(item["Zone"])
-            utils.msg("Calculating grid for {}...".format(cur_name))
-            key[cur_class] = cur_name
-            out_con = None
-            # here come the CONs:
-            out_con = run_con(item["Depth_LowerBounds"],
-                              item["Depth_UpperBounds"],
-                              bathy, cur_class)
-            out_con2 = run_con(item["Slope_LowerBounds"],
-                               item["Slope_UpperBounds"],
-                               slope, out_con, cur_class)
-            out_con3 = run_con(item["LSB_LowerBounds"],
-                               item["LSB_UpperBounds"],
-                               bpi_fine_std, out_con2, cur_class)
-            out_con4 = run_con(item["SSB_LowerBounds"],
-                               item["SSB_UpperBounds"],
-                               bpi_broad_std, out_con3, cur_class)
-
-            if type(out_con4) == arcpy.sa.Raster:
-                rast = utils.save_raster(out_con4, "con_{}.tif".format(cur_name))
-                grids.append(rast)
-            else:
-                # fall-through: no valid values detected for this class.
-                warn_msg = ("WARNING, no valid locations found for class"
-                            " {}:\n".format(cur_name))
-                classifications = {
-                    'depth': (item["Depth_LowerBounds"], item["Depth_UpperBounds"]),
-                    'slope': (item["Slope_LowerBounds"], item["Slope_UpperBounds"]),
-                    'broad': (item["SSB_LowerBounds"], item["SSB_UpperBounds"]),
-                    'fine': (item["LSB_LowerBounds"], item["LSB_UpperBounds"])
-                }
-                for (name, vrange) in classifications.items():
-                    (vmin, vmax) = vrange
-                    if vmin or vmax is not None:
-                        if vmin is None:
-                            vmin = ""
-                        if vmax is None:
-                            vmax = ""
-                        warn_msg += "  {}: {{{}:{}}}\n".format(name, vmin, vmax)
-
-                utils.msg(textwrap.dedent(warn_msg))
-
-        if len(grids) == 0:
-            raise NoValidClasses
+        index = load_classification(classification_file)
+        for name in index.unbounded:
+            # fall-through: no valid values detected for this class.
+            utils.msg("WARNING, no valid locations found for class"
+                      " {}, as it has no bounds.".format(name))
 
-        utils.msg("Creating Benthic Terrain Classification Dataset...")
-        merge_grid = grids[0]
-        for i in range(1, len(grids)):
-            utils.msg("{} of {}".format(i, len(grids)-1))
-            merge_grid = Con(merge_grid, grids[i], merge_grid, "VALUE = 0")
-        arcpy.AddField_management(merge_grid, 'Zone', 'TEXT')
-        cursor = arcpy.UpdateCursor(merge_grid)
-        for row in cursor:
-            val = str(row.getValue('VALUE'))
-            if val in key:
-                row.setValue('Zone', key[val])
-                cursor.updateRow(row)
-            else:
-                row.setValue('Zone', 'No Matching Zone')
-                cursor.updateRow(row)
-        del(cursor)
-        del(row)
+        if len(index.values) == 0:
+            raise NoValidClasses
 
-        arcpy.env.rasterStatistics = "STATISTICS"
-        arcpy.env.compression = "LZW"
+        be.env.rasterStatistics = "STATISTICS"
+        be.env.compression = "LZW"
         # validate the output raster path
         out_raster = utils.validate_path(out_raster)
-        utils.msg("Saving Output to {}".format(out_raster))
-        arcpy.CopyRaster_management(merge_grid, out_raster)
+        inputs = {'broad': bpi_broad_std, 'fine': bpi_fine_std,
+                  'slope': slope, 'depth': bathy}
+        if aligned([be.describe(inputs[name]) for name in index.inputs]):
+            utils.msg("Classifying {} classes in one pass, using the {} "
+                      "method...".format(len(index.values), index.method()))
+            table = classify_rasters(index, inputs, out_raster)
+        else:
+            utils.msg("The input rasters have different extents or cell "
+                      "sizes, classifying each class in turn...")
+            _classify_con(index.rules, inputs, out_raster, index.zones)
+            table = None
+
+        if out_summary:
+            if table is None:
+                zones = be.read_array(out_raster)
+                georef = zones.georef
+                table = ZoneTable.from_array(
+                    zones, index.zones,
+                    georef.cell_width * georef.cell_height)
+            utils.msg("Saving zone summary to {}".format(out_summary))
+            table.save(out_summary)
 
         utils.msg("Complete.")
 
@@ -171,15 +634,100 @@ def main(classification_file, bpi_broad_std, bpi_fine_std,
             raise e
         utils.msg(e, mtype='error')
 
+
+def batch_outputs(classification_files, out_workspace):
+    """
+    The (zones raster, zone summary) paths in out_workspace for each of
+    classification_files, named for the dictionary. Dictionaries sharing
+    a name, such as classes.csv and classes.xml, add their extension.
+    """
+    bases = [os.path.splitext(os.path.basename(path))
+             for path in classification_files]
+    names = [base for (base, _) in bases]
+    outputs = []
+    for (base, ext) in bases:
+        if names.count(base) > 1:
+            base = "{}_{}".format(base, ext.lstrip('.'))
+        outputs.append(
+            (os.path.join(out_workspace, "{}_classified.tif".format(base)),
+             os.path.join(out_workspace, "{}_zones.csv".format(base))))
+    return outputs
+
+
+def batch(classification_files, bpi_broad_std, bpi_fine_std, slope, bathy,
+          out_workspace, memory_budget=None):
+    """
+    Classify the same derivative rasters with each of several
+    classification dictionaries, a list or a semicolon separated string
+    of them. Each dictionary writes a zones raster and a CSV summary of
+    the area of each zone to out_workspace, named by batch_outputs().
+
+    Inputs sharing a grid are read a tile at a time, once for all the
+    dictionaries, rather than once each as separate runs of main() do.
+    """
+    if not isinstance(classification_files, (list, tuple)):
+        classification_files = classification_files.replace(
+            "'", '').split(";")
     try:
-        utils.msg("Deleting intermediate data...")
-        # Delete all intermediate raster data sets
-        for grid in grids:
-            arcpy.Delete_management(grid.catalogPath)
+        utils.workspace_exists(out_workspace)
+        be = utils.backend()
+        be.env.scratchWorkspace = out_workspace
+        be.env.workspace = out_workspace
+        be.env.overwriteOutput = True
+        be.env.rasterStatistics = "STATISTICS"
+        be.env.compression = "LZW"
+
+        inputs = {'broad': bpi_broad_std, 'fine': bpi_fine_std,
+                  'slope': slope, 'depth': bathy}
+        outputs = batch_outputs(classification_files, out_workspace)
+        runs = []
+        for (classification_file, (out_raster, out_summary)) in zip(
+                classification_files, outputs):
+            index = load_classification(classification_file)
+            for name in index.unbounded:
+                utils.msg("WARNING, no valid locations found for class"
+                          " {} of '{}', as it has no bounds.".format(
+                              name, classification_file))
+            if len(index.values) == 0:
+                utils.msg("No valid output classes found in '{}', "
+                          "skipping it.".format(classification_file),
+                          mtype='warning')
+                continue
+            runs.append((classification_file, index,
+                         utils.validate_path(out_raster), out_summary))
+        if not runs:
+            raise NoValidClasses
+
+        used = sorted(set(name for (_, index, _, _) in runs
+                          for name in index.inputs))
+        if not aligned([be.describe(inputs[name]) for name in used]):
+            utils.msg("The input rasters have different extents or cell "
+                      "sizes, classifying each dictionary in turn...")
+            for (classification_file, _, out_raster, out_summary) in runs:
+                main(classification_file, bpi_broad_std, bpi_fine_std,
+                     slope, bathy, out_raster, out_summary)
+            return
+
+        utils.msg("Classifying {} dictionaries in one pass...".format(
+            len(runs)))
+        tables = multiple_zone_tiles(
+            dict((name, inputs[name]) for name in used),
+            [(index.classify, index.values, index.zones)
+             for (_, index, _, _) in runs],
+            [out_raster for (_, _, out_raster, _) in runs], memory_budget)
+        for ((classification_file, _, _, out_summary), table) in zip(
+                runs, tables):
+            utils.msg("Saving zone summary of '{}' to {}".format(
+                classification_file, out_summary))
+            table.save(out_summary)
+
+        utils.msg("Complete.")
+
+    except NoValidClasses as e:
+        utils.msg(e, mtype='error')
     except Exception as e:
-        # hack -- swallowing this exception, because sometimes
-        # refs are left around for these files.
-        utils.msg("Failed to delete all intermediate data.", mtype='warning')
+        utils.msg(e, mtype='error')
+
 
 # when executing as a standalone script get parameters from sys
 if __name__ == '__main__':
@@ -190,4 +738,5 @@ if __name__ == '__main__':
         bpi_fine_std=sys.argv[3],
         slope=sys.argv[4],
         bathy=sys.argv[5],
-        out_raster=sys.argv[6])
+        out_raster=sys.argv[6],
+        out_summary=sys.argv[7] if len(sys.argv) >= 8 else None)
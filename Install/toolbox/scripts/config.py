@@ -9,3 +9,36 @@ mode = 'toolbox'
 
 # debug mode, enables extra logging
 debug = False
+
+# raster backend used by the tools: 'arcpy' for ArcGIS and Spatial Analyst,
+# 'numpy' for NumPy with GDAL raster I/O, which runs without ArcGIS. None
+# picks arcpy when it's available. Set per run here, or with the
+# BTM_BACKEND environment variable.
+backend = os.environ.get('BTM_BACKEND', None)
+
+# bin width, in raster units, used by the histogram based percentile
+# filters (interquartile range over large windows, scale comparison).
+# 0.01 is 1 cm for rasters in meters.
+percentile_resolution = 0.01
+
+# worker processes used for block processing: 1 processes blocks one at a
+# time in the calling process, 0 uses one process per CPU. Set per run
+# here, or with the BTM_WORKERS environment variable.
+workers = int(os.environ.get('BTM_WORKERS', 1))
+
+# memory the tiled tools may use, in bytes or with a unit such as '8GB'.
+# None uses half the memory available to the process. Set per run here,
+# or with the BTM_MEMORY_BUDGET environment variable.
+memory_budget = os.environ.get('BTM_MEMORY_BUDGET', None)
+
+# how BPI computes its annulus mean: 'direct' uses the backend's focal
+# statistics (Spatial Analyst FocalStatistics with ArcGIS), 'runlength'
+# sums rows of cells, 'fft' uses FFT convolution, and 'auto' picks the
+# faster of 'runlength' and 'fft' for the annulus. Set per run here, or
+# with the BTM_BPI_METHOD environment variable.
+bpi_method = os.environ.get('BTM_BPI_METHOD', 'auto')
+
+# folder caching the compiled classification dictionaries, keyed by a
+# hash of each file. None uses 'btm_cache' in the system temporary folder.
+# Set per run here, or with the BTM_CACHE_DIR environment variable.
+cache_dir = os.environ.get('BTM_CACHE_DIR', None)
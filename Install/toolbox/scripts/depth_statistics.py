@@ -1,5 +1,5 @@
 # depth_statistics.py: compute depth statistics
-# Requirements: Spatial Analyst
+# Requirements: NumPy
 # Author: Shaun Walbridge
 # Date: 9/1/2012
 
@@ -7,45 +7,79 @@
 from __future__ import absolute_import
 import os
 import sys
+import functools
 import numpy as np
-try:
-    import scipy.stats
-except ImportError:
-    pass    # error generated inline
-import arcpy
-from arcpy.sa import FocalStatistics, Power
 
 # local imports
+from . import focal
+from . import memory
 from . import utils
 from . import config
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
+# window size from which the interquartile range uses sliding histograms,
+# binned to config.percentile_resolution, rather than sorting each window
+HISTOGRAM_WINDOW_SIZE = 11
 
 
-def iqr(in_array, overlap):
-    s = in_array.shape
-    nbh_list = []
-    for r in range(0, (overlap * 2) + 1):
-        for c in range(0, (overlap * 2) + 1):
-            nbh_list.append(in_array[r:(s[0] - (overlap * 2) + r),
-                                     c:(s[1] - (overlap * 2) + c)])
-    iqr_array = np.array(nbh_list)
-    iqr_array = (np.percentile(iqr_array, 75, axis=0) -
-                 np.percentile(iqr_array, 25, axis=0))
+def iqr(in_array, overlap, memory_budget=None):
+    """
+    Interquartile range of each (2 * overlap + 1) square window, for the
+    cells at least overlap cells from the block edge. memory_budget is
+    the bytes available for working space beyond the block itself.
+    """
+    size = overlap * 2 + 1
+    memory_budget = memory.memory_budget(memory_budget)
+    if size >= HISTOGRAM_WINDOW_SIZE:
+        (lower, upper) = focal.percentile_filter(
+            in_array, size, [25, 75], config.percentile_resolution,
+            memory_budget=memory_budget)
+        return upper - lower
+
+    in_array = np.ascontiguousarray(in_array, dtype=np.float64)
+    windows = focal.window_view(in_array, (size, size))
+    (out_rows, out_cols) = windows.shape[:2]
+    iqr_array = np.empty((out_rows, out_cols))
+    # the percentile calculation copies the windows it sorts, so only
+    # reduce as many rows at once as fit within the memory budget.
+    row_bytes = out_cols * size * size * 8 * 3
+    chunk = max(1, int(memory_budget // row_bytes))
+    for row in range(0, out_rows, chunk):
+        (lower, upper) = np.percentile(windows[row:row + chunk], [25, 75],
+                                       axis=(2, 3))
+        iqr_array[row:row + chunk] = upper - lower
     return iqr_array
 
 
-def kurtosis(in_array, overlap):
-    s = in_array.shape
-    nbh_list = []
-    for r in range(0, (overlap * 2) + 1):
-        for c in range(0, (overlap * 2) + 1):
-            nbh_list.append(in_array[r:(s[0] - (overlap * 2) + r),
-                                     c:(s[1] - (overlap * 2) + c)])
-    kurt_array = np.array(nbh_list)
-    kurt_array = scipy.stats.kurtosis(kurt_array, axis=0)
-    return kurt_array
+def kurtosis(in_array, overlap, memory_budget=None):
+    """
+    Kurtosis of each (2 * overlap + 1) square window, for the cells at
+    least overlap cells from the block edge.
+    """
+    size = overlap * 2 + 1
+    kurt_array = focal.kurtosis(in_array, size)
+    (rows, cols) = kurt_array.shape
+    return kurt_array[overlap:rows - overlap, overlap:cols - overlap]
+
+
+def moments(in_array, halo, neighborhood, outputs):
+    """
+    Focal moments of a block, with its (above, below, left, right) halo
+    removed. outputs lists the moments to return, from MEAN, STD,
+    VARIANCE and MEAN_DIFF, the difference to the mean relative to the
+    range. Windows holding NoData are NoData.
+    """
+    stats = set(outputs) - set(['MEAN_DIFF'])
+    if 'MEAN_DIFF' in outputs:
+        stats.update(['MEAN', 'RANGE'])
+    results = focal.focal_moments(in_array, neighborhood, stats, False)
+    if 'MEAN_DIFF' in outputs:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results['MEAN_DIFF'] = -(results['MEAN'] - in_array) / \
+                results['RANGE']
+    (above, below, left, right) = halo
+    (rows, cols) = in_array.shape
+    return [results[stat][above:rows - below, left:cols - right]
+            for stat in outputs]
 
 
 def output_parts(in_raster, out_workspace, n_size):
@@ -53,8 +87,7 @@ def output_parts(in_raster, out_workspace, n_size):
     in_base = os.path.splitext(os.path.basename(in_raster))[0]
     prefix = os.path.join(out_workspace, in_base)
 
-    ws = arcpy.Describe(out_workspace)
-    ws_type = set([ws.workspaceType])
+    ws_type = set([utils.backend().workspace_type(out_workspace)])
     db_types = ['LocalDatabase', 'RemoteDatabase']
     if ws_type.intersection(db_types):
         ext = ""
@@ -74,22 +107,28 @@ def output_name(parts, label):
 
 
 def main(in_raster=None, neighborhood_size=None, out_workspace=None,
-         out_stats_raw=None, verbose=True, window_type='Rectangle'):
+         out_stats_raw=None, verbose=True, window_type='Rectangle',
+         memory_budget=None):
     """
     Compute depth statisitcs, averaging values over a defined neighborhood
     of cells. Can compute mean, standard deviation, and variance.
+
+    The memory_budget, in bytes or a string such as '8GB', bounds the
+    blocks used for the interquartile range and kurtosis. By default it
+    comes from config.memory_budget, or the memory available.
     """
     out_stats = out_stats_raw.replace("'", '').split(";")
-    out_stats = list(set(out_stats) - set(['Terrain Ruggedness (VRM)']))
-    arcpy.env.rasterStatistics = "STATISTICS"
-    arcpy.env.compression = 'LZW'  # compress output rasters
+    out_stats = list(set(out_stats) - set(['Terrain Ruggedness (VRM)',
+                                           'Surface Area to Planar Area',
+                                           'Arc-Chord Ratio (ACR)']))
+    be = utils.backend()
+    be.env.rasterStatistics = "STATISTICS"
+    be.env.compression = 'LZW'  # compress output rasters
 
     # neighborhood is integer
     n_size = int(neighborhood_size)
 
     # convert our data to sets for easy comparison
-    mean_set = set(['Mean Depth', 'Difference to Mean'])
-    std_dev_set = set(['Standard Deviation', 'Variance'])
     iqr_set = set(['Interquartile Range'])
     kurt_set = set(['Kurtosis'])
 
@@ -98,27 +137,13 @@ def main(in_raster=None, neighborhood_size=None, out_workspace=None,
         utils.msg("The following stats will be computed: " +
                   "{}".format(";".join(out_stats)))
 
-    # these two tools both use block processing which requires NetCDF4
-    if 'Interquartile Range' in out_stats or 'Kurtosis' in out_stats:
-        if not utils.NETCDF4_EXISTS:
-            utils.msg("The interquartile range and kurtosis tools require "
-                      "the NetCDF4 Python library is installed. NetCDF4 "
-                      "is included in ArcGIS 10.3 and later.", "error")
-            return
-
-        if 'Kurtosis' in out_stats and not utils.SCIPY_EXISTS:
-            utils.msg("The kurtosis calculation requires the SciPy library "
-                      "is installed. SciPy is included in ArcGIS 10.4 and "
-                      "later versions.", "error")
-            return
-
     # get output name prefix and suffix
     parts = output_parts(in_raster, out_workspace, n_size)
 
     utils.workspace_exists(out_workspace)
     # set geoprocessing environments
-    arcpy.env.scratchWorkspace = out_workspace
-    arcpy.env.workspace = out_workspace
+    be.env.scratchWorkspace = out_workspace
+    be.env.workspace = out_workspace
 
     # validate nbr type
     if window_type not in ('Rectangle', 'Circle'):
@@ -130,87 +155,55 @@ def main(in_raster=None, neighborhood_size=None, out_workspace=None,
             utils.msg("Calculating neighborhood...")
 
         if window_type == 'Circle':
-            neighborhood = arcpy.sa.NbrCircle(n_size, "CELL")
+            neighborhood = focal.Neighborhood.circle(n_size)
         else:
-            neighborhood = arcpy.sa.NbrRectangle(n_size, n_size, "CELL")
+            neighborhood = focal.Neighborhood.rectangle(n_size, n_size)
 
         overlap = int((n_size / 2.0) - 0.5)
 
-        if mean_set.intersection(out_stats):
-            mean_requested = 'Mean Depth' in out_stats
-            if verbose and mean_requested:
-                utils.msg("Calculating mean depth...")
-            mean_depth = FocalStatistics(in_raster, neighborhood,
-                                         "MEAN", "NODATA")
-            mean_raster = output_name(parts, 'mean')
-
-            if verbose and mean_requested:
-                utils.msg("saving mean depth to {}".format(mean_raster))
-            arcpy.CopyRaster_management(mean_depth, mean_raster)
-
-            if 'Difference to Mean' in out_stats:
-                if verbose:
-                    utils.msg("Calculating relative difference to mean...")
-                range_depth = FocalStatistics(in_raster, neighborhood,
-                                              "RANGE", "NODATA")
-
-                mean_diff = -(mean_depth - in_raster) / range_depth
-                mean_diff_raster = output_name(parts, 'mean_diff')
-
-                if verbose:
-                    utils.msg("saving relative different to mean to {}".format(
-                        mean_diff_raster))
-                arcpy.CopyRaster_management(mean_diff, mean_diff_raster)
-                if not mean_requested:
-                    arcpy.Delete_management(mean_raster)
-
-        # compute stdev in ths case
-        if std_dev_set.intersection(out_stats):
-            std_dev_requested = 'Standard Deviation' in out_stats
-            if verbose and std_dev_requested:
-                utils.msg("Calculating depth standard deviation...")
-            std_dev_depth = FocalStatistics(in_raster, neighborhood,
-                                            "STD", "NODATA")
-            std_dev_raster = output_name(parts, 'sdev')
-
-            if verbose and std_dev_requested:
-                utils.msg("saving standard deviation depth to \
-                          {}".format(std_dev_raster))
-            arcpy.CopyRaster_management(std_dev_depth, std_dev_raster)
-
-            # no direct variance focal stat, have to stdev^2
-            if 'Variance' in out_stats:
-                if verbose:
-                    utils.msg("Calculating depth variance...")
-                var_depth = Power(std_dev_depth, 2)
-                var_raster = output_name(parts, 'var')
-
-                if verbose:
-                    utils.msg("saving depth variance to {}".format(var_raster))
-                arcpy.CopyRaster_management(var_depth, var_raster)
-                if not std_dev_requested:
-                    arcpy.Delete_management(std_dev_raster)
-
-        # limit 3D blocksize to 10^8 elements (.4GB) on 32-bit, 10^10 on 64-bit
-        if utils.ARCH == '32-bit':
-            limit = 10**8
-        else:
-            limit = 10**10
+        # mean, difference to mean, standard deviation and variance all
+        # come from a single focal moments pass over the bathymetry,
+        # circles summed a row of cells at a time.
+        moment_outputs = (
+            ('Mean Depth', 'MEAN', 'mean'),
+            ('Difference to Mean', 'MEAN_DIFF', 'mean_diff'),
+            ('Standard Deviation', 'STD', 'sdev'),
+            ('Variance', 'VARIANCE', 'var'))
+        moment_stats = [(stat, output_name(parts, out_label))
+                        for (stat_name, stat, out_label) in moment_outputs
+                        if stat_name in out_stats]
+        if moment_stats:
+            if verbose:
+                utils.msg("Calculating depth moments...")
+            (stats, out_rasters) = zip(*moment_stats)
+            bp = utils.BlockProcessor(in_raster)
+            halo = max(neighborhood.extent)
+            (blocksize, _) = bp.blockSize(
+                memory.KERNEL_COSTS['moments'], neighborhood.shape[0], halo,
+                memory_budget)
+            bp.computeBlockStatistics(
+                functools.partial(moments, neighborhood=neighborhood,
+                                  outputs=list(stats)),
+                blocksize, list(out_rasters), halo, edges=True)
 
-        blocksize = int(np.sqrt((limit) / (n_size**2)) - overlap * 2)
         # define numpy-based calculations
-        np_sets = ((iqr_set, "interquartile range", "iqr", iqr),
-                   (kurt_set, "kurtosis", "kurt", kurtosis))
+        np_sets = ((iqr_set, "interquartile range", "iqr", iqr, 'iqr'),
+                   (kurt_set, "kurtosis", "kurt", kurtosis, 'kurtosis'))
 
         for np_set in np_sets:
-            (in_set, label, out_label, funct) = np_set
+            (in_set, label, out_label, funct, kernel) = np_set
             if in_set.intersection(out_stats):
                 if verbose:
                     utils.msg("Calculating depth {}...".format(label))
 
                 out_raster = output_name(parts, out_label)
                 bp = utils.BlockProcessor(in_raster)
-                bp.computeBlockStatistics(funct, blocksize, out_raster, overlap)
+                (blocksize, kernel_budget) = bp.blockSize(
+                    memory.KERNEL_COSTS[kernel], n_size, overlap,
+                    memory_budget)
+                bp.computeBlockStatistics(
+                    functools.partial(funct, memory_budget=kernel_budget),
+                    blocksize, out_raster, overlap)
 
     except Exception as e:
         utils.msg(e, mtype='error')
@@ -0,0 +1,812 @@
+# focal.py
+# Description: NumPy implementations of the neighborhood (focal) operations
+#              used by the BTM tools. These back the NumPy raster backend,
+#              and allow the tools to run without Spatial Analyst.
+#
+#              Arrays use NaN to represent NoData. Cells which fall outside
+#              the raster extent are excluded from a neighborhood, so edge
+#              cells are computed from partial windows, as in Spatial Analyst.
+
+from __future__ import absolute_import
+import functools
+
+import numpy as np
+
+# conversion factor used by Spatial Analyst for radians to degrees
+DEGREES = 57.29578
+
+FOCAL_STATISTICS = ('MEAN', 'SUM', 'STD', 'VARIANCE',
+                    'MINIMUM', 'MAXIMUM', 'RANGE')
+
+# FFT lengths for overlap-add convolution, see fft_shape()
+FFT_MIN_LENGTH = 128
+FFT_KERNEL_RATIO = 4
+# relative cost per cell of the focal mean methods, see mean_method():
+# a fixed cost, each run of a run length sum, and each unit of n log n
+# in the transforms of an FFT
+MEAN_COST = 45.0
+RUN_COST = 8.5
+FFT_COST = 7.5
+
+
+class Neighborhood(object):
+    """
+    A neighborhood measured in cells, mirroring the Spatial Analyst
+    NbrRectangle, NbrCircle and NbrAnnulus classes. The footprint is a
+    boolean array marking the cells which take part in the neighborhood.
+    """
+    def __init__(self, kind, footprint, **params):
+        self.kind = kind
+        self.footprint = np.asarray(footprint, dtype=bool)
+        self.params = params
+
+    @classmethod
+    def rectangle(cls, width, height=None):
+        """A rectangle of width x height cells."""
+        width = int(width)
+        height = width if height is None else int(height)
+        return cls('rectangle', np.ones((height, width), dtype=bool),
+                   width=width, height=height)
+
+    @classmethod
+    def circle(cls, radius):
+        """All cells whose centers fall within radius cells."""
+        radius = int(radius)
+        (y, x) = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+        footprint = (x**2 + y**2) <= radius**2
+        return cls('circle', footprint, radius=radius)
+
+    @classmethod
+    def annulus(cls, inner_radius, outer_radius):
+        """Cells within the outer radius, but not within the inner radius."""
+        inner = int(inner_radius)
+        outer = int(outer_radius)
+        (y, x) = np.ogrid[-outer:outer + 1, -outer:outer + 1]
+        dist = x**2 + y**2
+        footprint = (dist > inner**2) & (dist <= outer**2)
+        return cls('annulus', footprint, inner=inner, outer=outer)
+
+    @property
+    def shape(self):
+        return self.footprint.shape
+
+    @property
+    def extent(self):
+        """
+        Cells the neighborhood reaches (above, below, left, right) of the
+        processing cell. Even sized windows place the processing cell
+        above and left of the true center.
+        """
+        (rows, cols) = self.footprint.shape
+        return ((rows - 1) // 2, rows // 2, (cols - 1) // 2, cols // 2)
+
+    @property
+    def offsets(self):
+        """(row, col) offsets of each cell relative to the processing cell."""
+        (above, _, left, _) = self.extent
+        (rows, cols) = np.nonzero(self.footprint)
+        return list(zip(rows - above, cols - left))
+
+    @property
+    def runs(self):
+        """
+        The footprint as horizontal runs of cells, each a (row, first, last)
+        offset relative to the processing cell. A circle has one run per
+        row, an annulus up to two.
+        """
+        (above, _, left, _) = self.extent
+        runs = []
+        for (row, cells) in enumerate(self.footprint):
+            edges = np.diff(np.concatenate(([0], cells.astype(np.int8), [0])))
+            starts = np.nonzero(edges == 1)[0]
+            ends = np.nonzero(edges == -1)[0] - 1
+            runs.extend((row - above, first - left, last - left)
+                        for (first, last) in zip(starts, ends))
+        return runs
+
+
+def _padded(array, extent, fill):
+    (above, below, left, right) = extent
+    return np.pad(array, ((above, below), (left, right)),
+                  mode='constant', constant_values=fill)
+
+
+def window_view(array, shape):
+    """
+    Zero-copy view of every window of the given (rows, cols) shape which
+    lies fully within array, indexed as [row, col, window_row, window_col].
+    """
+    array = np.asarray(array)
+    (rows, cols) = shape
+    (row_stride, col_stride) = array.strides
+    view_shape = (array.shape[0] - rows + 1, array.shape[1] - cols + 1,
+                  rows, cols)
+    return np.lib.stride_tricks.as_strided(
+        array, shape=view_shape,
+        strides=(row_stride, col_stride, row_stride, col_stride),
+        writeable=False)
+
+
+def _running_reduce(array, before, after, axis, func, fill):
+    """
+    Running sum, minimum or maximum along an axis over windows reaching
+    before and after cells, using the van Herk / Gil-Werman algorithm.
+    The axis is cut into blocks of the window length, and each window
+    combines the suffix of one block with the prefix of the next: a
+    constant cost per cell, whatever the window length. Cells outside
+    the array take the fill value.
+    """
+    array = np.moveaxis(array, axis, -1)
+    size = before + after + 1
+    length = array.shape[-1]
+    # pad so every window lies within the array, then to whole blocks
+    blocks = -(-(length + size - 1) // size)
+    pad = ((0, 0),) * (array.ndim - 1) + \
+        ((before, blocks * size - length - before),)
+    padded = np.pad(array, pad, mode='constant', constant_values=fill)
+    shape = padded.shape[:-1] + (blocks, size)
+    prefix = func.accumulate(padded.reshape(shape), axis=-1)
+    suffix = func.accumulate(padded.reshape(shape)[..., ::-1], axis=-1)
+    prefix = prefix.reshape(padded.shape)[..., size - 1:size - 1 + length]
+    suffix = suffix[..., ::-1].reshape(padded.shape)[..., :length]
+    if func is np.add:
+        # a window starting a block is that block's suffix alone
+        prefix = np.where(np.arange(length) % size == 0, 0.0, prefix)
+    result = func(suffix, prefix)
+    return np.moveaxis(result, -1, axis)
+
+
+def box_sum(array, extent):
+    """
+    Sum over the rectangle reaching extent (above, below, left, right) cells
+    from every cell, clipped to the raster. Sums are separable running
+    sums, so the cost per cell is constant whatever the window size, and
+    unlike a whole raster integral image, the partial sums only span
+    two windows, keeping the round off independent of the raster size.
+    """
+    (above, below, left, right) = extent
+    row_sums = _running_reduce(np.asarray(array, dtype=np.float64),
+                               left, right, 1, np.add, 0.0)
+    return _running_reduce(row_sums, above, below, 0, np.add, 0.0)
+
+
+def row_prefix(array, extent):
+    """
+    Prefix sums along each row of array, padded with zeros by extent
+    (above, below, left, right) cells and with a leading zero column, for
+    the run sums of any neighborhood reaching no further than extent.
+    """
+    padded = _padded(np.asarray(array, dtype=np.float64), extent, 0.0)
+    prefix = np.zeros((padded.shape[0], padded.shape[1] + 1))
+    np.cumsum(padded, axis=1, out=prefix[:, 1:])
+    return prefix
+
+
+def prefix_run_sum(prefix, runs, extent):
+    """
+    Sum over runs from the row_prefix of a raster padded by extent, as
+    the difference of the prefix sums at the ends of each run.
+    """
+    (above, below, left, right) = extent
+    nrows = prefix.shape[0] - above - below
+    ncols = prefix.shape[1] - 1 - left - right
+    total = np.zeros((nrows, ncols))
+    for (dy, first, last) in runs:
+        rows = slice(above + dy, above + dy + nrows)
+        end = left + last + 1
+        start = left + first
+        np.add(total, prefix[rows, end:end + ncols], out=total)
+        np.subtract(total, prefix[rows, start:start + ncols], out=total)
+    return total
+
+
+def run_sum(array, runs, extent):
+    """
+    Sum over the runs of a neighborhood reaching extent (above, below,
+    left, right) cells, from the prefix sums of each row of the array.
+    Cells outside the raster count as zero.
+    """
+    return prefix_run_sum(row_prefix(array, extent), runs, extent)
+
+
+def _run_reduce(array, runs, extent, func, fill):
+    """
+    Minimum or maximum over the runs of a neighborhood, from the running
+    extremes along the rows for each distinct run length.
+    """
+    (nrows, ncols) = np.shape(array)
+    (above, _, left, _) = extent
+    padded = _padded(array, extent, fill)
+    result = np.full((nrows, ncols), fill)
+    for length in sorted(set(last - first + 1 for (_, first, last) in runs)):
+        # extreme of the length cells starting at each cell
+        running = _running_reduce(padded, 0, length - 1, 1, func, fill)
+        for (dy, first, last) in runs:
+            if last - first + 1 == length:
+                start = left + first
+                func(result, running[above + dy:above + dy + nrows,
+                                     start:start + ncols], out=result)
+    return result
+
+
+def _fast_length(n):
+    """Smallest length of at least n with no prime factor above 5."""
+    length = n
+    while True:
+        remainder = length
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return length
+        length += 1
+
+
+def enclosing_extent(neighborhoods):
+    """The (above, below, left, right) extent reaching every neighborhood."""
+    return tuple(max(reach) for reach in
+                 zip(*[neighborhood.extent for neighborhood in neighborhoods]))
+
+
+def _as_list(neighborhoods):
+    if isinstance(neighborhoods, Neighborhood):
+        return [neighborhoods]
+    return list(neighborhoods)
+
+
+def fft_shape(neighborhoods, shape):
+    """
+    FFT shape used for overlap-add convolution of a raster of the given
+    shape with the neighborhoods. Tiles are transformed padded to
+    FFT_KERNEL_RATIO times the kernel width, which keeps the transforms
+    cache sized while wasting little of them on the padding, or to the
+    whole raster when it is smaller.
+    """
+    (above, below, left, right) = enclosing_extent(_as_list(neighborhoods))
+    kernel = (above + below + 1, left + right + 1)
+    length = _fast_length(max(FFT_MIN_LENGTH, FFT_KERNEL_RATIO * max(kernel)))
+    return tuple(min(length, _fast_length(cells + width - 1))
+                 for (cells, width) in zip(shape, kernel))
+
+
+def fft_sums(array, neighborhoods):
+    """
+    Sum and count of the valid cells over each neighborhood of every
+    cell, by FFT convolution, as a list of (sum, count) pairs. The raster
+    is cut into tiles whose convolutions are added into the result
+    (overlap-add), and the values and the validity mask are convolved
+    together, as the real and imaginary parts of one complex transform.
+    Each tile is transformed once for all the neighborhoods. Cells outside
+    the raster count as NoData. The cost per cell grows with the log of
+    the kernel size, rather than its radius or area.
+    """
+    neighborhoods = _as_list(neighborhoods)
+    array = np.asarray(array, dtype=np.float64)
+    valid = ~np.isnan(array)
+    data = np.where(valid, array, 0.0) + 1j * valid
+    (nrows, ncols) = array.shape
+    extent = enclosing_extent(neighborhoods)
+    (above, below, left, right) = extent
+    (kernel_rows, kernel_cols) = (above + below + 1, left + right + 1)
+    shape = fft_shape(neighborhoods, array.shape)
+    tile_shape = (shape[0] - kernel_rows + 1, shape[1] - kernel_cols + 1)
+
+    kernels = []
+    for neighborhood in neighborhoods:
+        # center each footprint within the enclosing extent, and flip it,
+        # as convolving with the flipped footprint correlates with it
+        (nbr_above, _, nbr_left, _) = neighborhood.extent
+        footprint = np.zeros((kernel_rows, kernel_cols))
+        (rows, cols) = neighborhood.shape
+        footprint[above - nbr_above:above - nbr_above + rows,
+                  left - nbr_left:left - nbr_left + cols] = \
+            neighborhood.footprint
+        kernels.append(np.fft.fft2(footprint[::-1, ::-1], shape))
+
+    fulls = [np.zeros((nrows + kernel_rows - 1, ncols + kernel_cols - 1),
+                      dtype=complex) for _ in neighborhoods]
+    for row in range(0, nrows, tile_shape[0]):
+        for col in range(0, ncols, tile_shape[1]):
+            block = data[row:row + tile_shape[0], col:col + tile_shape[1]]
+            transform = np.fft.fft2(block, shape)
+            (out_rows, out_cols) = (block.shape[0] + kernel_rows - 1,
+                                    block.shape[1] + kernel_cols - 1)
+            for (kernel, full) in zip(kernels, fulls):
+                conv = np.fft.ifft2(transform * kernel)
+                full[row:row + out_rows, col:col + out_cols] += \
+                    conv[:out_rows, :out_cols]
+    results = []
+    for full in fulls:
+        same = full[below:below + nrows, right:right + ncols]
+        # counts are whole numbers, rounding removes the round off
+        results.append((same.real, np.rint(same.imag)))
+    return results
+
+
+def mean_method(neighborhoods, shape):
+    """
+    The cheaper way to compute the focal means over one or a list of
+    neighborhoods of a raster of the given shape: 'runlength', whose cost
+    grows with the rows of the neighborhoods, or 'fft', whose cost grows
+    with the log of their size. Several neighborhoods share the prefix
+    sums, or the forward transforms, of the raster.
+    """
+    neighborhoods = _as_list(neighborhoods)
+    (above, below, left, right) = enclosing_extent(neighborhoods)
+    kernel = (above + below + 1, left + right + 1)
+    transform = fft_shape(neighborhoods, shape)
+    outputs = [cells - width + 1 for (cells, width) in zip(transform, kernel)]
+    size = float(transform[0] * transform[1])
+    # FFT_COST covers a forward and an inverse transform
+    fft_cost = (FFT_COST * size * np.log2(size) / (outputs[0] * outputs[1]) *
+                (1 + len(neighborhoods)) / 2.0)
+    run_cost = MEAN_COST + RUN_COST * sum(len(neighborhood.runs)
+                                          for neighborhood in neighborhoods)
+    return 'fft' if fft_cost < run_cost else 'runlength'
+
+
+def focal_mean(array, neighborhood, method='auto'):
+    """
+    Mean of the valid cells over the neighborhood of every cell, NaN where
+    there are none. See focal_means.
+    """
+    return focal_means(array, [neighborhood], method)[0]
+
+
+def focal_means(array, neighborhoods, method='auto'):
+    """
+    Means of the valid cells over each of the neighborhoods of every
+    cell, NaN where there are none. method is 'runlength' (row prefix sums
+    of the runs of each neighborhood), 'fft' (fft_sums) or 'auto',
+    choosing the cheaper of the two. Either way, the work on the raster
+    itself is shared by all the neighborhoods.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    if method == 'auto':
+        method = mean_method(neighborhoods, array.shape)
+    if method not in ('runlength', 'fft'):
+        raise ValueError("Unknown focal mean method `{}`".format(method))
+
+    valid = ~np.isnan(array)
+    # shift values towards zero to limit the round off of the sums
+    offset = np.nanmean(array) if valid.any() else 0.0
+    values = np.where(valid, array - offset, 0.0)
+    if method == 'runlength':
+        extent = enclosing_extent(neighborhoods)
+        counts = row_prefix(valid, extent)
+        totals = row_prefix(values, extent)
+        sums = [(prefix_run_sum(totals, neighborhood.runs, extent),
+                 prefix_run_sum(counts, neighborhood.runs, extent))
+                for neighborhood in neighborhoods]
+    else:
+        sums = fft_sums(np.where(valid, values, np.nan), neighborhoods)
+
+    results = []
+    for (total, count) in sums:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = total / count + offset
+        result[count == 0] = np.nan
+        results.append(result)
+    return results
+
+
+def _is_rectangle(neighborhood):
+    return neighborhood.footprint.all()
+
+
+def focal_moments(array, neighborhood, stats=('MEAN', 'STD'),
+                  ignore_nodata=True):
+    """
+    Compute several focal statistics from a single pass over the raster.
+
+    For rectangular neighborhoods the sums come from running box sums of
+    the values and their squares, and minimum and maximum from running
+    extremes, so the cost per cell is independent of the window size.
+    Other neighborhoods are split into horizontal runs of cells (see
+    Neighborhood.runs): each run's sum is the difference of two row
+    prefix sums, and its extremes a lookup into running extremes of the
+    run's length, so the cost per cell grows with the radius, rather than
+    the area, of a circle or annulus.
+
+    Arguments:
+        array -- 2D array, NaN for NoData.
+        neighborhood -- a Neighborhood instance.
+        stats -- sequence of statistics from FOCAL_STATISTICS.
+        ignore_nodata -- when False, any NoData cell within the
+                         neighborhood sets the output cell to NoData
+                         (the "NODATA" option in Spatial Analyst).
+
+    Returns:
+        dict mapping each requested statistic to a 2D float64 array, NaN
+        for NoData.
+    """
+    stats = [stat.upper() for stat in stats]
+    for stat in stats:
+        if stat not in FOCAL_STATISTICS:
+            raise ValueError("Unsupported focal statistic `{}`".format(stat))
+    need_sums = bool(set(stats) & set(('MEAN', 'SUM', 'STD', 'VARIANCE')))
+    need_squares = bool(set(stats) & set(('STD', 'VARIANCE')))
+    need_extremes = bool(set(stats) & set(('MINIMUM', 'MAXIMUM', 'RANGE')))
+
+    array = np.asarray(array, dtype=np.float64)
+    valid = ~np.isnan(array)
+    # shift values towards zero to limit cancellation in the variance
+    offset = np.nanmean(array) if valid.any() else 0.0
+    values = np.where(valid, array - offset, 0.0)
+    extent = neighborhood.extent
+
+    if _is_rectangle(neighborhood):
+        footprint_sum = functools.partial(box_sum, extent=extent)
+    else:
+        runs = neighborhood.runs
+        footprint_sum = functools.partial(run_sum, runs=runs, extent=extent)
+
+    count = footprint_sum(valid)
+    if need_sums:
+        total = footprint_sum(values)
+    if need_squares:
+        total_sq = footprint_sum(values * values)
+    if need_extremes:
+        if _is_rectangle(neighborhood):
+            (above, below, left, right) = extent
+            low = np.where(valid, values, np.inf)
+            high = np.where(valid, values, -np.inf)
+            for (axis, before, after) in ((0, above, below),
+                                          (1, left, right)):
+                low = _running_reduce(low, before, after, axis,
+                                      np.minimum, np.inf)
+                high = _running_reduce(high, before, after, axis,
+                                       np.maximum, -np.inf)
+        else:
+            low = _run_reduce(np.where(valid, values, np.inf), runs, extent,
+                              np.minimum, np.inf)
+            high = _run_reduce(np.where(valid, values, -np.inf), runs,
+                               extent, np.maximum, -np.inf)
+
+    empty = count == 0
+    if not ignore_nodata:
+        empty |= footprint_sum(~valid) > 0
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for stat in stats:
+            if stat == 'SUM':
+                result = total + offset * count
+            elif stat == 'MEAN':
+                result = total / count + offset
+            elif stat in ('STD', 'VARIANCE'):
+                mean = total / count
+                result = np.maximum(total_sq / count - mean**2, 0.0)
+                if stat == 'STD':
+                    result = np.sqrt(result)
+            elif stat == 'MINIMUM':
+                result = low + offset
+            elif stat == 'MAXIMUM':
+                result = high + offset
+            else:
+                result = high - low
+            result[empty] = np.nan
+            results[stat] = result
+    return results
+
+
+def focal_statistics(array, neighborhood, stat='MEAN', ignore_nodata=True):
+    """
+    Compute a statistic over the neighborhood of every cell.
+
+    Arguments:
+        array -- 2D array, NaN for NoData.
+        neighborhood -- a Neighborhood instance.
+        stat -- one of FOCAL_STATISTICS.
+        ignore_nodata -- when False, any NoData cell within the
+                         neighborhood sets the output cell to NoData
+                         (the "NODATA" option in Spatial Analyst).
+
+    Returns:
+        2D float64 array of the statistic, NaN for NoData.
+    """
+    stat = stat.upper()
+    return focal_moments(array, neighborhood, [stat], ignore_nodata)[stat]
+
+
+def kurtosis(array, size):
+    """
+    Excess (Fisher) kurtosis of each size x size window, matching
+    scipy.stats.kurtosis. Windows which hold NoData, or fall partially
+    outside the raster, are NoData.
+
+    The window sums of the first four powers come from running box sums,
+    and are expanded into central moments, so the cost per cell does not
+    depend on the window size.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    neighborhood = Neighborhood.rectangle(size)
+    extent = neighborhood.extent
+    valid = ~np.isnan(array)
+    # center on the raster mean to limit cancellation in the expansion
+    offset = np.nanmean(array) if valid.any() else 0.0
+    values = np.where(valid, array - offset, 0.0)
+
+    count = box_sum(valid, extent)
+    sums = [box_sum(values**power, extent) for power in (1, 2, 3, 4)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        (m1, m2, m3, m4) = [total / count for total in sums]
+        variance = m2 - m1**2
+        fourth = m4 - 4 * m1 * m3 + 6 * m1**2 * m2 - 3 * m1**4
+        result = fourth / variance**2 - 3.0
+    # constant windows have no defined kurtosis; allow for round off
+    flat = variance <= 1e-12 * np.maximum(m2, np.finfo(np.float64).tiny)
+    result[flat | (count != size * size)] = np.nan
+    return result
+
+
+def percentile_filter(array, size, percentiles, resolution=0.01,
+                      interpolation='linear', memory_budget=None):
+    """
+    Running percentiles of every size x size window lying fully within
+    array, from sliding histograms (Huang, 1979; Perreault and Hebert,
+    2007). Values are binned to the given resolution, and each output
+    column keeps a histogram of its window, updated by the row leaving
+    and the row entering the window as it moves down the array. Finding
+    a percentile searches a coarse histogram and then one of its fine
+    bins, so the cost per cell grows with the square root of the number
+    of bins rather than with the window area.
+
+    Arguments:
+        array -- 2D array, NaN for NoData.
+        size -- window width and height, in cells.
+        percentiles -- sequence of percentiles, 0-100, computed together.
+        resolution -- bin width, in raster units. Results are exact to
+                      within half a bin.
+        interpolation -- 'linear' interpolates between order statistics
+                         as numpy.percentile does, 'rank' picks a single
+                         order statistic as scipy.ndimage does.
+        memory_budget -- bytes available for the histograms; wide arrays
+                         are processed in column strips to fit.
+
+    Returns:
+        list of 2D float64 arrays, one per percentile, with the shape of
+        the windows; windows containing NoData are NaN.
+    """
+    if interpolation not in ('linear', 'rank'):
+        raise ValueError("Unknown interpolation `{}`".format(interpolation))
+    array = np.asarray(array, dtype=np.float64)
+    size = int(size)
+    (rows, cols) = array.shape
+    out_shape = (rows - size + 1, cols - size + 1)
+    results = [np.full(out_shape, np.nan) for _ in percentiles]
+    valid = ~np.isnan(array)
+    if min(out_shape) < 1 or not valid.any():
+        return results
+
+    low = array[valid].min()
+    bins = np.zeros(array.shape, dtype=np.int64)
+    bins[valid] = np.round((array[valid] - low) / resolution)
+    nbins = int(bins.max()) + 1
+
+    # one histogram of nbins counts per output column, and a strip
+    # holds as many columns as fit in the memory budget
+    if memory_budget:
+        strip = max(1, int(memory_budget // (nbins * 4 * 2)))
+    else:
+        strip = out_shape[1]
+    for start in range(0, out_shape[1], strip):
+        stop = min(start + strip, out_shape[1])
+        columns = slice(start, stop + size - 1)
+        strip_results = _histogram_percentiles(
+            bins[:, columns], valid[:, columns], size, percentiles,
+            interpolation)
+        for (result, strip_result) in zip(results, strip_results):
+            result[:, start:stop] = low + strip_result * resolution
+    return results
+
+
+def _histogram_percentiles(bins, valid, size, percentiles, interpolation):
+    """Sliding histogram percentiles of binned values, in bin units."""
+    (rows, cols) = bins.shape
+    (out_rows, out_cols) = (rows - size + 1, cols - size + 1)
+    nbins = int(bins[valid].max()) + 1 if valid.any() else 1
+    # two tiers of bins: coarse bins of `fine` fine bins each
+    fine = int(np.ceil(np.sqrt(nbins)))
+    ncoarse = -(-nbins // fine)
+    hist = np.zeros((out_cols, ncoarse, fine), dtype=np.int32)
+    coarse = np.zeros((out_cols, ncoarse), dtype=np.int32)
+    # the cells of one array row in each output column's window
+    window_cols = (np.arange(out_cols)[:, np.newaxis] +
+                   np.arange(size)).ravel()
+    owner = np.repeat(np.arange(out_cols), size)
+    columns = np.arange(out_cols)
+
+    # scatter into flat views with a matching step type, which
+    # numpy.add.at handles far faster than tuples of indices
+    hist_flat = hist.reshape(-1)
+    coarse_flat = coarse.reshape(-1)
+
+    def update(row, step):
+        step = np.int32(step)
+        keep = valid[row, window_cols]
+        cell_bins = bins[row, window_cols][keep]
+        cell_owner = owner[keep]
+        np.add.at(hist_flat, cell_owner * (ncoarse * fine) + cell_bins, step)
+        np.add.at(coarse_flat, cell_owner * ncoarse + cell_bins // fine,
+                  step)
+
+    def order_statistic(rank):
+        """Bin of the rank-th smallest value (0 based) in each window."""
+        cumulative = np.cumsum(coarse, axis=1)
+        coarse_bin = np.minimum((cumulative <= rank[:, np.newaxis]).sum(1),
+                                ncoarse - 1)
+        below = np.where(coarse_bin > 0,
+                         cumulative[columns, coarse_bin - 1], 0)
+        fine_cumulative = np.cumsum(hist[columns, coarse_bin], axis=1)
+        fine_bin = np.minimum(
+            (fine_cumulative <= (rank - below)[:, np.newaxis]).sum(1),
+            fine - 1)
+        return coarse_bin * fine + fine_bin
+
+    nodata = box_sum(~valid, (0, size - 1, 0, size - 1))[:out_rows, :out_cols]
+    results = [np.empty((out_rows, out_cols)) for _ in percentiles]
+    for row in range(size):
+        update(row, 1)
+    for out_row in range(out_rows):
+        if out_row:
+            update(out_row - 1, -1)
+            update(out_row + size - 1, 1)
+        count = coarse.sum(axis=1)
+        empty = (count == 0) | (nodata[out_row] > 0)
+        last = np.maximum(count - 1, 0)
+        for (result, percentile) in zip(results, percentiles):
+            if interpolation == 'rank':
+                rank = np.minimum((count * percentile / 100.0).astype(int),
+                                  last)
+                value = order_statistic(rank).astype(np.float64)
+            else:
+                position = last * percentile / 100.0
+                lower = np.floor(position).astype(int)
+                upper = np.minimum(lower + 1, last)
+                fraction = position - lower
+                lower_value = order_statistic(lower)
+                upper_value = order_statistic(upper)
+                value = lower_value + (upper_value - lower_value) * fraction
+            value[empty] = np.nan
+            result[out_row] = value
+    return results
+
+
+def horn_gradient(array, cell_width=1.0, cell_height=1.0):
+    """
+    Surface gradient (dz/dx, dz/dy) from the 3x3 Horn (1981) stencil used
+    by the Spatial Analyst Slope and Aspect tools. Neighbors which are
+    NoData or fall outside the raster take the value of the center cell.
+    """
+    array = np.asarray(array, dtype=np.float64)
+    (nrows, ncols) = array.shape
+    padded = _padded(array, (1, 1, 1, 1), np.nan)
+
+    def neighbor(dy, dx):
+        cell = padded[1 + dy:1 + dy + nrows, 1 + dx:1 + dx + ncols]
+        return np.where(np.isnan(cell), array, cell)
+
+    (a, b, c) = (neighbor(-1, -1), neighbor(-1, 0), neighbor(-1, 1))
+    (d, f) = (neighbor(0, -1), neighbor(0, 1))
+    (g, h, i) = (neighbor(1, -1), neighbor(1, 0), neighbor(1, 1))
+
+    dz_dx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8.0 * cell_width)
+    dz_dy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8.0 * cell_height)
+    return (dz_dx, dz_dy)
+
+
+def slope_from_gradient(dz_dx, dz_dy):
+    """Slope in degrees from a surface gradient."""
+    return np.arctan(np.sqrt(dz_dx**2 + dz_dy**2)) * DEGREES
+
+
+def aspect_from_gradient(dz_dx, dz_dy):
+    """
+    Aspect in degrees clockwise from north, with -1 for flat cells, from a
+    surface gradient.
+    """
+    raw = DEGREES * np.arctan2(dz_dy, -dz_dx)
+    aspect = np.where(raw < 0, 90.0 - raw,
+                      np.where(raw > 90.0, 360.0 - raw + 90.0, 90.0 - raw))
+    flat = (dz_dx == 0) & (dz_dy == 0)
+    aspect[flat] = -1
+    return aspect
+
+
+def integral_image(array):
+    """
+    Summed area table of array with a leading row and column of zeros,
+    so the sum of array[r0:r1, c0:c1] is
+
+        I[r1, c1] - I[r0, c1] - I[r1, c0] + I[r0, c0]
+    """
+    (nrows, ncols) = np.shape(array)
+    integral = np.zeros((nrows + 1, ncols + 1))
+    np.cumsum(array, axis=0, dtype=np.float64, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+
+def window_sum(integral, extent):
+    """
+    Sum over the rectangle reaching extent (above, below, left, right) cells
+    from every cell, clipped to the raster, from its integral_image.
+    """
+    (above, below, left, right) = extent
+    (nrows, ncols) = (integral.shape[0] - 1, integral.shape[1] - 1)
+    top = np.clip(np.arange(nrows) - above, 0, nrows)[:, np.newaxis]
+    bottom = np.clip(np.arange(nrows) + below + 1, 0, nrows)[:, np.newaxis]
+    first = np.clip(np.arange(ncols) - left, 0, ncols)
+    last = np.clip(np.arange(ncols) + right + 1, 0, ncols)
+    return (integral[bottom, last] - integral[top, last] -
+            integral[bottom, first] + integral[top, first])
+
+
+def surface_normal(array, cell_width=1.0, cell_height=1.0):
+    """
+    Unit vector normal to the surface, as float32 (x, y, z) components,
+    from the 3x3 Horn stencil. These are the x, y and z rasters of the
+    vector ruggedness measure,
+
+        x = sin(slope) * sin(aspect)
+        y = sin(slope) * cos(aspect)
+        z = cos(slope)
+
+    written in terms of the gradient, so no trigonometry is needed. Flat
+    cells point straight up. NoData cells are NaN.
+    """
+    (dz_dx, dz_dy) = horn_gradient(array, cell_width, cell_height)
+    # 1 / sqrt(1 + tan(slope)^2) is cos(slope)
+    z = 1.0 / np.sqrt(1.0 + dz_dx**2 + dz_dy**2)
+    return ((-dz_dx * z).astype(np.float32),
+            (dz_dy * z).astype(np.float32),
+            z.astype(np.float32))
+
+
+def vrm(array, size, cell_width=1.0, cell_height=1.0):
+    """
+    Vector ruggedness measure (Sappington et al., 2007) over size x size
+    windows: one less the length of the summed surface normals, divided by
+    the cells in a full window. Windows holding NoData are NoData; as with
+    Spatial Analyst, cells outside the raster are left out of the sums.
+
+    The normals are bounded by one, so their sums come from integral
+    images without the round off of unbounded values.
+    """
+    return vrm_scales(array, [size], cell_width, cell_height)[0]
+
+
+def vrm_scales(array, sizes, cell_width=1.0, cell_height=1.0):
+    """
+    Vector ruggedness measure for each window size in sizes, as float32
+    arrays. The normals and their integral images are computed once, so
+    each further size only costs the lookups of its window sums.
+    """
+    normals = surface_normal(array, cell_width, cell_height)
+    nodata = np.isnan(normals[2])
+    integrals = [integral_image(nodata)]
+    for component in normals:
+        component[nodata] = 0.0
+        integrals.append(integral_image(component))
+    del normals
+
+    results = []
+    for size in sizes:
+        extent = Neighborhood.rectangle(size).extent
+        resultant = np.zeros(nodata.shape)
+        for integral in integrals[1:]:
+            resultant += window_sum(integral, extent)**2
+        result = 1.0 - np.sqrt(resultant) / (int(size)**2)
+        result[window_sum(integrals[0], extent) > 0] = np.nan
+        results.append(result.astype(np.float32))
+    return results
+
+
+def slope(array, cell_width=1.0, cell_height=1.0):
+    """Slope in degrees, as computed by Spatial Analyst Slope."""
+    return slope_from_gradient(*horn_gradient(array, cell_width, cell_height))
+
+
+def aspect(array, cell_width=1.0, cell_height=1.0):
+    """Aspect in degrees, as computed by Spatial Analyst Aspect."""
+    return aspect_from_gradient(*horn_gradient(array, cell_width, cell_height))
@@ -0,0 +1,266 @@
+# memory.py
+# Description: memory budgets for the tiled tools. The budget comes from
+#              config.memory_budget when set, otherwise from the memory
+#              available on the machine, and each kernel describes how
+#              many bytes it needs per cell so tiles can be sized to fit.
+
+from __future__ import absolute_import
+import os
+import re
+from platform import architecture
+
+import numpy as np
+try:
+    import psutil
+    PSUTIL_EXISTS = True
+except ImportError:
+    PSUTIL_EXISTS = False
+
+# local imports
+from . import config
+from .pipeline import DEPTH
+
+# share of the available memory used when no budget is configured
+AVAILABLE_FRACTION = 0.5
+# budget used when the available memory can't be detected
+DEFAULT_BUDGET = 2**30
+# a 32-bit process can't address much more than this, whatever is free
+MAX_32BIT_BUDGET = 2**30
+# share of a worker's budget for the tile arrays in the kernel's cost
+# model, and the tiles buffered around it; the rest is the kernel's own
+# working space, such as the window copies sorted for the interquartile
+# range.
+TILE_FRACTION = 0.5
+
+_UNITS = {'': 1, 'B': 1, 'K': 2**10, 'KB': 2**10, 'M': 2**20, 'MB': 2**20,
+          'G': 2**30, 'GB': 2**30, 'T': 2**40, 'TB': 2**40}
+
+
+def parse_size(size):
+    """Bytes from an integer, or a string such as '512MB' or '16 GB'."""
+    if isinstance(size, (int, float, np.integer)):
+        return int(size)
+    match = re.match(r'^\s*([0-9.]+)\s*([A-Za-z]*)\s*$', str(size))
+    if not match or match.group(2).upper() not in _UNITS:
+        raise ValueError("Invalid memory size `{}`".format(size))
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def _read_bytes(path):
+    """A byte count from a cgroup file, or None without one."""
+    try:
+        with open(path) as count_file:
+            count = count_file.read().strip()
+    except (IOError, OSError):
+        return None
+    if count.isdigit():
+        return int(count)
+    return None
+
+
+def _cgroup_available(root='/sys/fs/cgroup'):
+    """
+    Memory left under the limit of the container we're running in, if
+    any: the limit, less what the container already uses.
+    """
+    for (limit_file, usage_file) in (
+            ('memory.max', 'memory.current'),
+            (os.path.join('memory', 'memory.limit_in_bytes'),
+             os.path.join('memory', 'memory.usage_in_bytes'))):
+        limit = _read_bytes(os.path.join(root, limit_file))
+        if limit is None:
+            continue
+        usage = _read_bytes(os.path.join(root, usage_file)) or 0
+        return max(limit - usage, 0)
+    return None
+
+
+def _windows_available():
+    import ctypes
+
+    class MemoryStatus(ctypes.Structure):
+        _fields_ = [('dwLength', ctypes.c_ulong),
+                    ('dwMemoryLoad', ctypes.c_ulong),
+                    ('ullTotalPhys', ctypes.c_ulonglong),
+                    ('ullAvailPhys', ctypes.c_ulonglong),
+                    ('ullTotalPageFile', ctypes.c_ulonglong),
+                    ('ullAvailPageFile', ctypes.c_ulonglong),
+                    ('ullTotalVirtual', ctypes.c_ulonglong),
+                    ('ullAvailVirtual', ctypes.c_ulonglong),
+                    ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+    status = MemoryStatus()
+    status.dwLength = ctypes.sizeof(MemoryStatus)
+    if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+        return None
+    return int(status.ullAvailPhys)
+
+
+def available_memory():
+    """
+    Physical memory available to this process in bytes, or None when it
+    can't be determined. Container limits are respected, less the memory
+    the container already uses.
+    """
+    available = None
+    if PSUTIL_EXISTS:
+        available = int(psutil.virtual_memory().available)
+    elif os.name == 'nt':
+        available = _windows_available()
+    else:
+        try:
+            with open('/proc/meminfo') as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        available = int(line.split()[1]) * 1024
+                        break
+        except (IOError, OSError):
+            pass
+        if available is None:
+            try:
+                available = (os.sysconf('SC_AVPHYS_PAGES') *
+                             os.sysconf('SC_PAGE_SIZE'))
+            except (AttributeError, ValueError, OSError):
+                pass
+    container = _cgroup_available()
+    if container is not None and (available is None or
+                                  container < available):
+        available = container
+    return available
+
+
+def memory_budget(budget=None):
+    """
+    Bytes the tiled tools may use: budget if given, else
+    config.memory_budget, else a share of the available memory.
+    """
+    if budget is None:
+        budget = config.memory_budget
+    if budget is not None:
+        return parse_size(budget)
+
+    available = available_memory()
+    if available is None:
+        budget = DEFAULT_BUDGET
+    else:
+        budget = int(available * AVAILABLE_FRACTION)
+    if architecture()[0] == '32-bit':
+        budget = min(budget, MAX_32BIT_BUDGET)
+    return budget
+
+
+class CostModel(object):
+    """
+    Memory a tiled kernel needs for each cell of its tile: `copies` arrays
+    of dtype the size of the tile, plus `window_copies` per cell of the
+    window, for kernels which hold copies of every window at once. Kernels
+    with several outputs need `output_copies` more for each output after
+    the first, see for_outputs().
+
+    Tiles read and written in a pipeline also hold the `inputs` and
+    `outputs` arrays of the tiles waiting between its stages, see
+    buffered_bytes_per_cell().
+    """
+    def __init__(self, copies, window_copies=0, dtype=np.float64,
+                 output_copies=0, inputs=1, outputs=1):
+        self.copies = copies
+        self.window_copies = window_copies
+        self.dtype = np.dtype(dtype)
+        self.output_copies = output_copies
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def for_outputs(self, outputs):
+        """The cost of the kernel computing outputs results at once."""
+        return CostModel(self.copies + self.output_copies * (outputs - 1),
+                         self.window_copies, self.dtype, self.output_copies,
+                         self.inputs, outputs)
+
+    def bytes_per_cell(self, window):
+        """Bytes per tile cell with a window x window neighborhood."""
+        return self.dtype.itemsize * (self.copies +
+                                      self.window_copies * window**2)
+
+    def buffered_bytes_per_cell(self, depth=DEPTH):
+        """
+        Bytes per tile cell of the float64 inputs and outputs of the tiles
+        a pipeline of depth holds besides the one being computed: up to
+        depth waiting on each side of it, and one more being read or
+        written.
+        """
+        return 8 * (2 * depth + 1) * (self.inputs + self.outputs)
+
+
+# cost models of the NumPy kernels run over tiles
+KERNEL_COSTS = {
+    # input and output, the percentile bounds and their difference; the
+    # window copies are sorted in chunks from the kernel's working space
+    'iqr': CostModel(5),
+    # input, validity, centered values, four power sums and the
+    # temporaries of the running sums
+    'kurtosis': CostModel(14),
+    # input, the Horn stencil's neighbors and gradient, the float32
+    # normals, and an integral image with its window corners; each
+    # further size of a multi-scale VRM adds its float32 result
+    'vrm': CostModel(18, output_copies=0.5),
+    # input, validity, centered values and the row prefix sums of values
+    # and validity; each annulus adds the count and sum of its runs, and
+    # its mean
+    'annulus': CostModel(8, output_copies=3),
+    # input, validity, centered values and their complex transform input;
+    # each annulus adds its complex overlap-add result and its mean. The
+    # transforms of each FFT tile are small beside these.
+    'annulus_fft': CostModel(8, output_copies=3),
+    # the annulus working space, plus squares, extremes and the outputs
+    'moments': CostModel(16),
+    # the inputs of each variable and the zones, with either the boolean
+    # masks of the bounds tested, or the interval index of each cell and
+    # the bitsets of the classes accepting it; each further dictionary
+    # classified from the same inputs holds its zones until written
+    'classify': CostModel(10, output_copies=1, inputs=4),
+    # in float32 units: the input and its float32 copy, the eight edges
+    # from the center and the temporaries of each triangle; the float64
+    # Horn stencil of the slope correction, computed once the edges are
+    # freed, needs more. The surface area output adds a copy.
+    'sapa': CostModel(28, dtype=np.float32, output_copies=1),
+    # the SAPA working space and the float64 block padded to its halo,
+    # the float64 integral images of the surface and planar areas and of
+    # NoData, and the window sums of each size
+    'sapa_scales': CostModel(38, dtype=np.float32, output_copies=4),
+    # in float32 units: the SAPA working space, the float64 bathymetry
+    # and labels, and the 8 neighbor labels and their boundary keys; the
+    # per-area sums are small beside the tile
+    'acr': CostModel(40, dtype=np.float32, output_copies=0, inputs=2,
+                     outputs=0),
+    # the float64 block padded to its halo, its surface areas and the
+    # cell positions, eleven float64 integral images of the areas and
+    # plane fit moments, and the window and ring sums of each size with
+    # the temporaries of their solve; each further size adds its result
+    'acr_scales': CostModel(70, dtype=np.float32, output_copies=1),
+}
+
+
+def tile_size(cost, window, halo=0, budget=None, workers=1, depth=DEPTH):
+    """
+    Choose a square tile size for a kernel.
+
+    Arguments:
+        cost -- the kernel's CostModel.
+        window -- neighborhood size, in cells.
+        halo -- cells of overlap read around each tile.
+        budget -- bytes for the whole job, see memory_budget().
+        workers -- processes running tiles at once, sharing the budget.
+        depth -- tiles the pipeline buffers between its stages, whose
+                 inputs and outputs share the tile budget.
+
+    Returns:
+        (tile, kernel_budget): the tile width and height in cells,
+        excluding the halo, and the bytes left for the kernel's working
+        space in each worker.
+    """
+    worker_budget = memory_budget(budget) // max(int(workers), 1)
+    tile_bytes = worker_budget * TILE_FRACTION
+    side = int(np.sqrt(tile_bytes / (cost.bytes_per_cell(window) +
+                                     cost.buffered_bytes_per_cell(depth))))
+    tile = max(side - halo * 2, int(window))
+    return (tile, int(worker_budget - tile_bytes))
@@ -0,0 +1,105 @@
+# pipeline.py
+# Description: overlap reading, computing and writing tiles. A reader
+#              thread prefetches the next tiles while the calling thread
+#              computes, and a writer thread drains finished tiles, so
+#              disk and CPU are kept busy at the same time.
+
+from __future__ import absolute_import
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+# marks the end of the items passing through a queue
+_DONE = object()
+# items waiting between stages by default: double buffered tiles
+DEPTH = 2
+
+
+def pipeline(items, read, compute, write, depth=DEPTH, threaded=True):
+    """
+    Run read, compute and write over each item in turn:
+
+        write(item, compute(item, read(item)))
+
+    Reads run ahead in a reader thread and writes behind in a writer
+    thread, while compute runs in the calling thread (which can safely
+    report progress to ArcGIS). At most depth items wait between stages,
+    so with the default of two, tiles are double buffered. Items are
+    written in order. An exception raised in any stage stops the pipeline
+    and is raised again in the caller.
+
+    Arguments:
+        items -- sequence of work items, such as tile windows.
+        read -- function of an item, returning its input.
+        compute -- function of an item and its input, returning a result.
+        write -- function of an item and its result.
+        depth -- items buffered between stages.
+        threaded -- False runs all stages in the calling thread, for I/O
+                    which isn't safe to use from other threads.
+    """
+    if not threaded:
+        for item in items:
+            write(item, compute(item, read(item)))
+        return
+
+    read_queue = queue.Queue(depth)
+    write_queue = queue.Queue(depth)
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                read_queue.put((item, read(item)))
+        except Exception:
+            errors.append(sys.exc_info()[1])
+        finally:
+            read_queue.put(_DONE)
+
+    def writer():
+        while True:
+            job = write_queue.get()
+            if job is _DONE:
+                break
+            if errors:
+                # keep draining, so the calling thread never blocks
+                continue
+            try:
+                write(*job)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+                stop.set()
+
+    threads = [threading.Thread(target=reader),
+               threading.Thread(target=writer)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while not errors:
+            job = read_queue.get()
+            if job is _DONE:
+                break
+            (item, data) = job
+            write_queue.put((item, compute(item, data)))
+    finally:
+        stop.set()
+        # unblock the reader if it is waiting on a full queue
+        while threads[0].is_alive():
+            try:
+                read_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        write_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
@@ -5,7 +5,7 @@
 #              Ruggedness for Animal Habitat Analysis: A Case Study Using
 #              Bighorn Sheep in the Mojave Desert. Journal of Wildlife
 #              Management. 71(5): 1419 -1426.
-# Requirements: Spatial Analyst
+# Requirements: NumPy
 # Author: Mark Sappington
 # Date: 2/1/2008
 # Updated 12/1/2010 by Emily C. Huntley of the Massachusetts Office of
@@ -13,22 +13,31 @@
 # Updated 2012-2014 by Shaun Walbridge to improve performance, use idomatic code.
 
 # Import system modules
-import math
+import functools
 import os
 import sys
 
-import arcpy
-from arcpy.sa import Aspect, Cos, Sin, Slope, Con, NbrRectangle, FocalStatistics
-
 # local imports
 from . import utils
 from . import config
+from . import focal
+from . import memory
+
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
+def vrm_block(in_array, halo, sizes, cell_width, cell_height):
+    """
+    VRM of a block for each neighborhood size, with its (above, below,
+    left, right) halo removed.
+    """
+    (above, below, left, right) = halo
+    (nrows, ncols) = in_array.shape
+    return [result[above:nrows - below, left:ncols - right]
+            for result in focal.vrm_scales(in_array, sizes, cell_width,
+                                           cell_height)]
 
 
-def main(in_raster=None, neighborhood_size=None, out_raster=None):
+def main(in_raster=None, neighborhood_size=None, out_raster=None,
+         memory_budget=None):
     """
     Compute terrain ruggedness, using the vector ruggedness measure (VRM),
     as described in:
@@ -36,66 +45,56 @@ def main(in_raster=None, neighborhood_size=None, out_raster=None):
         Sappington et al., 2007. Quantifying Landscape Ruggedness for
         Animal Habitat Analysis: A Case Study Using Bighorn Sheep in the
         Mojave Desert. Journal of Wildlife Management. 71(5): 1419 -1426.
+
+    The slope and aspect, the x, y and z rasters and their neighborhood
+    sums are computed together a block at a time, so the bathymetry is
+    read once and the ruggedness written once. The memory_budget, in
+    bytes or a string such as '8GB', bounds the blocks.
     """
-    hood_size = int(neighborhood_size)
+    multiple_scales(in_raster, [neighborhood_size], [out_raster],
+                    memory_budget)
+
+
+def multiple_scales(in_raster=None, neighborhood_sizes=None,
+                    out_rasters=None, memory_budget=None):
+    """
+    Compute the VRM for each of neighborhood_sizes, saving each to the
+    matching raster of out_rasters. The x, y and z rasters and their
+    integral images are computed once for each block, and shared by all
+    the sizes, so each additional size adds little to the run time.
+    """
+    sizes = [int(size) for size in neighborhood_sizes]
 
     # FIXME: expose this as an option per #18
     w = utils.Workspace()
     if w.exists:
         out_workspace = w.path
     else:
-        out_workspace = os.path.dirname(out_raster)
+        out_workspace = os.path.dirname(out_rasters[0])
     utils.workspace_exists(out_workspace)
-    # force temporary stats to be computed in our output workspace
-    arcpy.env.scratchWorkspace = out_workspace
-    arcpy.env.workspace = out_workspace
+    be = utils.backend()
+    be.env.scratchWorkspace = out_workspace
+    be.env.workspace = out_workspace
 
-    # TODO expose as config
-    pyramid_orig = arcpy.env.pyramid
-    arcpy.env.pyramid = "NONE"
     # TODO: currently set to automatically overwrite, expose this as option
-    arcpy.env.overwriteOutput = True
-    arcpy.env.compression = 'LZW'
+    be.env.overwriteOutput = True
+    be.env.compression = 'LZW'
+    be.env.rasterStatistics = "STATISTICS"
 
     try:
-        # Create Slope and Aspect rasters
-        utils.msg("Calculating aspect...")
-        out_aspect = Aspect(in_raster)
-        utils.msg("Calculating slope...")
-        out_slope = Slope(in_raster, "DEGREE")
-
-        # Convert Slope and Aspect rasters to radians
-        utils.msg("Converting slope and aspect to radians...")
-        slope_rad = out_slope * (math.pi / 180)
-        aspect_rad = out_aspect * (math.pi / 180)
-
-        # Calculate x, y, and z rasters
-        utils.msg("Calculating x, y, and z rasters...")
-        xy_raster_calc = Sin(slope_rad)
-        z_raster_calc = Cos(slope_rad)
-        x_raster_calc = Con(out_aspect == -1, 0, Sin(aspect_rad)) * xy_raster_calc
-        y_raster_calc = Con(out_aspect == -1, 0, Cos(aspect_rad)) * xy_raster_calc
-
-        # Calculate sums of x, y, and z rasters for selected neighborhood size
-        utils.msg("Calculating sums of x, y, and z rasters in neighborhood...")
-        hood = NbrRectangle(hood_size, hood_size, "CELL")
-        x_sum_calc = FocalStatistics(x_raster_calc, hood, "SUM", "NODATA")
-        y_sum_calc = FocalStatistics(y_raster_calc, hood, "SUM", "NODATA")
-        z_sum_calc = FocalStatistics(z_raster_calc, hood, "SUM", "NODATA")
-
-        # Calculate the resultant vector
-        utils.msg("Calculating the resultant vector...")
-        result_vect = (x_sum_calc**2 + y_sum_calc**2 + z_sum_calc**2)**0.5
-
-        arcpy.env.rasterStatistics = "STATISTICS"
-        arcpy.env.pyramid = pyramid_orig
-        # Calculate the Ruggedness raster
-        utils.msg("Calculating the final ruggedness raster...")
-        ruggedness = 1 - (result_vect / hood_size**2)
-
-        out_raster = utils.validate_path(out_raster)
-        utils.msg("Saving ruggedness raster to to {}.".format(out_raster))
-        arcpy.CopyRaster_management(ruggedness, out_raster)
+        out_rasters = [utils.validate_path(path) for path in out_rasters]
+        utils.msg("Calculating the ruggedness raster...")
+        bp = utils.BlockProcessor(in_raster)
+        # the sums reach past the window by the slope's 3x3 stencil
+        window = max(sizes)
+        overlap = max(focal.Neighborhood.rectangle(window).extent) + 1
+        cost = memory.KERNEL_COSTS['vrm'].for_outputs(len(sizes))
+        (blocksize, _) = bp.blockSize(cost, window, overlap, memory_budget)
+        kernel = functools.partial(
+            vrm_block, sizes=sizes, cell_width=bp.georef.cell_width,
+            cell_height=bp.georef.cell_height)
+        bp.computeBlockStatistics(kernel, blocksize, out_rasters, overlap,
+                                  edges=True)
 
     except Exception as e:
         utils.msg(e, mtype='error')
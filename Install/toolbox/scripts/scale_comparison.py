@@ -1,7 +1,8 @@
-import arcpy
 import numpy as np
 import sys
 import scripts.config as config
+import scripts.focal as focal
+import scripts.memory as memory
 import scripts.utils as utils
 from matplotlib import pyplot as plt
 
@@ -13,24 +14,63 @@ if not utils.SCIPY_EXISTS:
 else:
     import scipy.ndimage as nd
 
+# most memory the sliding histograms of a preview may take; a preview
+# whose values span more bins than this holds is filtered by SciPy
+HISTOGRAM_BUDGET = 64 * 2**20
+
+
+def image_filter(in_array, img_filter, size, percentile=None):
+    """
+    Filter in_array with a size x size window. Median and percentile
+    filters use the sliding histogram filter, binned to
+    config.percentile_resolution, unless the histograms of its range of
+    values would exceed HISTOGRAM_BUDGET, or the memory budget if less,
+    when scipy.ndimage is used; edges are reflected, as in scipy.ndimage.
+    """
+    img_filter = img_filter.lower()
+    if img_filter in ('median', 'percentile'):
+        if img_filter == 'median':
+            percentile = 50
+        resolution = config.percentile_resolution
+        values = in_array[~np.isnan(in_array)]
+        nbins = 1
+        if values.size:
+            nbins = (values.max() - values.min()) / resolution + 1
+        budget = min(memory.memory_budget(), HISTOGRAM_BUDGET)
+        # each column keeps a histogram, as focal.percentile_filter counts
+        if nbins * 8 * in_array.shape[1] > budget:
+            return nd.percentile_filter(in_array, float(percentile), size)
+        before = size // 2
+        padded = np.pad(in_array, ((before, size - 1 - before),) * 2,
+                        mode='symmetric')
+        return focal.percentile_filter(
+            padded, size, [float(percentile)], resolution,
+            interpolation='rank', memory_budget=budget)[0]
+    return getattr(nd, "{}_filter".format(img_filter))(in_array, size)
+
 
 def main(in_raster=None, img_filter=None, percentile=None,
          min_nbhs=None, max_nbhs=None, position=None, out_file=True):
 
-    point = None
+    be = utils.backend()
+    georef = be.describe(in_raster)
+    # sample a 200x200 window, with its lower left corner at position
+    (row, col) = (georef.nrows - 1, 0)
     if position:
         try:
             x, y = position.split(" ")
-            point = arcpy.Point(x, y)
+            (row, col) = georef.cell_index(float(x), float(y))
         except Exception as e:
             utils.msg("Invalid point, using lower left corner", "warning")
             utils.msg(e, 'error')
-            point = None
-
-    r = arcpy.RasterToNumPyArray(in_raster, point, 200, 200, 0)
+            (row, col) = (georef.nrows - 1, 0)
 
-    if r.ndim > 2:
-        r = np.squeeze(r[0, :, :])
+    row = min(max(row, 0), georef.nrows - 1)
+    col = min(max(col, 0), georef.ncols - 1)
+    top = max(row - 199, 0)
+    window = (top, col, row - top + 1, min(200, georef.ncols - col))
+    r = be.read_array(in_raster, window).view(np.ndarray)
+    r = np.where(np.isnan(r), 0, r)
     min_nbhs = int(min_nbhs)
     max_nbhs = int(max_nbhs)
 
@@ -41,11 +81,7 @@ def main(in_raster=None, img_filter=None, percentile=None,
                         retstep=False).astype('uint32')
     for size in sizes:
         utils.msg("Processing neighborhood size {}".format(size))
-        perc = ""
-        if percentile is not None:
-            perc = "{},".format(percentile)
-        filterexec = "nd.{}_filter(r,{}{})".format(img_filter.lower(), perc, size)
-        med = eval(filterexec)
+        med = image_filter(r, img_filter, int(size), percentile)
 
         a = fig.add_subplot(5, 5, i+1)
         plt.imshow(med, interpolation='nearest')
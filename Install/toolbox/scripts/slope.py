@@ -8,7 +8,7 @@
 #              classification dictionary gives users the freedom to create
 #              their own classifications and define the relationships that
 #              characterize them.
-# Requirements: Spatial Analyst
+# Requirements: Spatial Analyst, or the NumPy backend
 # Author: Dawn J. Wright, Emily R. Lundblad, Emily M. Larkin, Ronald W. Rinehart
 # Date: 2005
 # Converted 11/5/2010 by Emily C. Huntley of the Massachusetts Office of
@@ -17,28 +17,23 @@
 # Import system modules
 import sys
 
-import arcpy
-from arcpy.sa import Slope
-
 # local imports
 from . import utils
 from . import config
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
-
 
 def main(bathy=None, out_raster=None):
     """Compute raster slope in degrees."""
 
     try:
-        arcpy.env.rasterStatistics = "STATISTICS"
-        arcpy.env.compression = "LZW"
+        be = utils.backend()
+        be.env.rasterStatistics = "STATISTICS"
+        be.env.compression = "LZW"
         # Calculate the slope of the bathymetric raster
         utils.msg("Calculating the slope...")
-        out_slope = Slope(bathy, "DEGREE", 1)
+        out_slope = be.slope(bathy)
         out_raster = utils.validate_path(out_raster)
-        arcpy.CopyRaster_management(out_slope, out_raster)
+        be.copy_raster(out_slope, out_raster)
     except Exception as e:
         utils.msg(e, mtype='error')
 
@@ -8,7 +8,7 @@
 #              terrain classification dictionary gives users the freedom to
 #              create their own classifications and define the relationships
 #              that characterize them.
-# Requirements: Spatial Analyst
+# Requirements: Spatial Analyst, or the NumPy backend
 # Author: Dawn J. Wright, Emily R. Lundblad, Emily M. Larkin, Ronald W. Rinehart
 # Date: 2005
 # Converted 11/5/2010 by Emily C. Huntley of the Massachusetts Office of
@@ -18,19 +18,19 @@
 from __future__ import absolute_import
 import sys
 
-import arcpy
-from arcpy.sa import Int, Plus, Divide, Minus, Times
-
 # local imports
 from . import utils
 from . import config
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
-
 
 def main(bpi_raster=None, out_raster=None):
-    arcpy.env.compression = "LZW"
+    """
+    Standardize a BPI raster to a mean of zero and a standard deviation
+    of 100. The mean and standard deviation stored by the BPI tool are
+    used when present, otherwise they come from the raster statistics.
+    """
+    be = utils.backend()
+    be.env.compression = "LZW"
     try:
         # Get raster properties
         message = ("Calculating properties of the Bathymetric "
@@ -39,22 +39,25 @@ def main(bpi_raster=None, out_raster=None):
         utils.msg("  input raster: {}\n   output: {}".format(
             bpi_raster, out_raster))
         # convert to a path
-        desc = arcpy.Describe(bpi_raster)
-        bpi_raster_path = desc.catalogPath
+        bpi_raster_path = be.catalog_path(bpi_raster)
 
-        bpi_mean = utils.raster_properties(bpi_raster_path, "MEAN")
+        moments = utils.Moments.load(bpi_raster_path)
+        if moments is not None and moments.count:
+            (bpi_mean, bpi_std_dev) = (moments.mean, moments.std)
+        else:
+            bpi_mean = utils.raster_properties(bpi_raster_path, "MEAN")
+            bpi_std_dev = utils.raster_properties(bpi_raster_path, "STD")
         utils.msg("BPI raster mean: {}.".format(bpi_mean))
-        bpi_std_dev = utils.raster_properties(bpi_raster_path, "STD")
         utils.msg("BPI raster standard deviation: {}.".format(bpi_std_dev))
 
         # Create the standardized Bathymetric Position Index (BPI) raster
         std_msg = "Standardizing the Bathymetric Position Index (BPI) raster..."
         utils.msg(std_msg)
-        arcpy.env.rasterStatistics = "STATISTICS"
-        outRaster = Int(Plus(Times(Divide(
-            Minus(bpi_raster_path, bpi_mean), bpi_std_dev), 100), 0.5))
+        be.env.rasterStatistics = "STATISTICS"
+        bpi = be.raster(bpi_raster_path)
+        outRaster = be.int_((bpi - bpi_mean) / bpi_std_dev * 100 + 0.5)
         out_raster = utils.validate_path(out_raster)
-        arcpy.CopyRaster_management(outRaster, out_raster)
+        be.copy_raster(outRaster, out_raster)
 
     except Exception as e:
         utils.msg(e, mtype='error')
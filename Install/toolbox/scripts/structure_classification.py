@@ -0,0 +1,171 @@
+# structure_classification.py
+# Description: The Benthic Terrain Modeler (BTM) functions as a toolbox
+#              within ArcMap, and relies on a methodology to analyze benthic
+#              terrain from input multibeam bathymetry in ESRI's GRID (raster)
+#              format. The BTM toolbox contains a set of tools that allow users
+#              to create grids of slope, bathymetric position index and
+#              rugosity from an input data set.
+#
+#              Structure classification assigns one of thirteen structures,
+#              from narrow depressions to steep slopes, using breaks in the
+#              standardized BPI rasters, slope and depth.
+# Requirements: NumPy
+# Author: Dawn J. Wright, Emily R. Lundblad, Emily M. Larkin, Ronald W. Rinehart
+# Date: 2005
+# Converted 11/5/2010 by Emily C. Huntley of the Massachusetts Office of
+# Coastal Zone Management to a Python Script that runs in ArcGIS 10.
+
+# Import system modules
+from __future__ import absolute_import
+import sys
+
+import numpy as np
+
+# local imports
+from . import utils
+from . import config
+from . import classify
+
+# structure of each class value, in the order the classes are tested
+STRUCTURES = [
+    'Narrow depression',
+    'Local depression on flat',
+    'Lateral midslope depression',
+    'Depression on crest',
+    'Broad depression with an open bottom',
+    'Broad flat',
+    'Shelf',
+    'Open slopes',
+    'Local crest in depression',
+    'Local crest on flat',
+    'Lateral midslope crest',
+    'Narrow crest',
+    'Steep slope',
+]
+
+
+def structure_block(arrays, breaks):
+    """
+    Classify a block into STRUCTURES, given a dict of 'broad', 'fine',
+    'slope' and 'depth' arrays with NaN for NoData, and the breaks
+    between them: broad and fine, the BPI below which is a depression
+    and above which is a crest, gentle and steep slopes, and depth.
+
+    Matches the nested Con of the original tool: the first class whose
+    test holds is taken, but a class testing a NoData input gives NoData,
+    as do cells no class takes. Each comparison is made once, and shared
+    by the classes which test it.
+    """
+    (broad, fine, slope, depth) = (arrays['broad'], arrays['fine'],
+                                   arrays['slope'], arrays['depth'])
+    with np.errstate(invalid='ignore'):
+        broad_dep = broad <= -breaks['broad']
+        broad_cre = broad >= breaks['broad']
+        fine_dep = fine <= -breaks['fine']
+        fine_cre = fine >= breaks['fine']
+        gentle = slope <= breaks['gentle']
+        steep = slope > breaks['steep']
+        shallow = depth < breaks['depth']
+    broad_mid = ~broad_dep & ~broad_cre
+    broad_up = ~broad_dep
+    fine_mid = ~fine_dep & ~fine_cre
+    sloped = ~gentle
+    open_slope = sloped & ~steep
+
+    # the inputs each class tests are NoData when any of them are
+    nodata_bpi = np.isnan(broad) | np.isnan(fine)
+    nodata_slope = nodata_bpi | np.isnan(slope)
+    nodata_depth = nodata_slope | np.isnan(depth)
+
+    tests = [
+        (broad_dep & fine_dep, nodata_bpi),
+        (broad_mid & fine_dep & gentle, nodata_slope),
+        (broad_mid & fine_dep & sloped, nodata_slope),
+        (broad_cre & fine_dep, nodata_bpi),
+        (broad_dep & fine_mid, nodata_bpi),
+        (broad_up & fine_mid & gentle & shallow, nodata_depth),
+        (broad_up & fine_mid & gentle & ~shallow, nodata_depth),
+        (broad_up & fine_mid & open_slope, nodata_slope),
+        (broad_dep & fine_cre, nodata_bpi),
+        (broad_mid & fine_cre & gentle, nodata_slope),
+        (broad_mid & fine_cre & sloped, nodata_slope),
+        (broad_cre & fine_cre, nodata_bpi),
+        (broad_up & fine_mid & steep, nodata_slope),
+    ]
+    conditions = [test | nodata for (test, nodata) in tests]
+    classes = np.select(conditions, list(range(1, len(tests) + 1)), 0)
+    nodata = np.select(conditions, [nodata for (_, nodata) in tests], True)
+    result = classes.astype(np.float64)
+    result[nodata] = np.nan
+    return result
+
+
+def main(bpi_broad_std=None, broad_std_dev_div=None, bpi_fine_std=None,
+         fine_std_dev_div=None, slope=None, gentle_slope_div=None,
+         steep_slope_div=None, bathy=None, depth_div=None, out_raster=None,
+         out_summary=None):
+    """
+    Classify the structures of STRUCTURES from the standardized BPI
+    rasters, slope and bathymetry. The BPI breaks are the given numbers
+    of standard deviations of each BPI raster; the slope breaks are in
+    degrees, and depth_div is the depth dividing shelves from broad
+    flats. The inputs are read a tile at a time, and must share a grid.
+    The attribute table of the structures is also written to out_summary
+    if given, as CSV when it ends in .csv and JSON otherwise.
+    """
+    be = utils.backend()
+    try:
+        breaks = {}
+        for (name, raster, divisions) in (
+                ('broad', bpi_broad_std, broad_std_dev_div),
+                ('fine', bpi_fine_std, fine_std_dev_div)):
+            utils.msg("Calculating properties of the standardized {}-scale "
+                      "Bathymetric Position Index (BPI) raster...".format(
+                          name))
+            std_dev = utils.raster_properties(raster, "STD")
+            utils.msg("The standard deviation of the {}-scale BPI raster "
+                      "is {}.".format(name, std_dev))
+            breaks[name] = float(divisions) * float(std_dev)
+        breaks['gentle'] = float(gentle_slope_div)
+        breaks['steep'] = float(steep_slope_div)
+        breaks['depth'] = float(depth_div)
+
+        inputs = {'broad': bpi_broad_std, 'fine': bpi_fine_std,
+                  'slope': slope, 'depth': bathy}
+        if not classify.aligned([be.describe(raster)
+                                 for raster in inputs.values()]):
+            raise ValueError("The input rasters must have the same extent "
+                             "and cell size.")
+
+        utils.msg("Classifying the Bathymetric Position Index (BPI) "
+                  "raster...")
+        be.env.rasterStatistics = "STATISTICS"
+        be.env.compression = "LZW"
+        out_raster = utils.validate_path(out_raster)
+        zones = dict((str(value), name) for (value, name) in
+                     enumerate(STRUCTURES, start=1))
+        table = classify.zone_tiles(
+            inputs, lambda arrays: structure_block(arrays, breaks),
+            range(1, len(STRUCTURES) + 1), zones, out_raster)
+        if out_summary:
+            utils.msg("Saving structure summary to {}".format(out_summary))
+            table.save(out_summary)
+
+    except Exception as e:
+        utils.msg(e, mtype='error')
+
+# when executing as a standalone script get parameters from sys
+if __name__ == '__main__':
+    config.mode = 'script'
+    main(
+        bpi_broad_std=sys.argv[1],
+        broad_std_dev_div=sys.argv[2],
+        bpi_fine_std=sys.argv[3],
+        fine_std_dev_div=sys.argv[4],
+        slope=sys.argv[5],
+        gentle_slope_div=sys.argv[6],
+        steep_slope_div=sys.argv[7],
+        bathy=sys.argv[8],
+        depth_div=sys.argv[9],
+        out_raster=sys.argv[10],
+        out_summary=sys.argv[11] if len(sys.argv) >= 12 else None)
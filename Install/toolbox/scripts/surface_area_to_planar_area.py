@@ -5,28 +5,44 @@
 #              Grid (surfgrids.avx) extension for ArcView 3.x, v. 1.2.
 #              Jenness Enterprises. Available at:
 #                http://www.jennessent.com/arcview/surface_areas.htm
-# Requirements: Spatial Analyst
+# Requirements: NumPy
 
 # Import system modules
 from __future__ import absolute_import
 from __future__ import unicode_literals
+import functools
 import math
 import os
 import sys
-import arcpy
-from arcpy.sa import Raster, Divide, Cos, Times
+
+import numpy as np
 
 # local imports
 from . import utils
 from . import config
+from . import focal
+from . import memory
 
 
 # force all to str
 if sys.version_info < (3, 0):
     str = unicode
 
-# Check out any necessary licenses
-arcpy.CheckOutExtension("Spatial")
+# the (x, y) shift, in cells, of each neighbor n from the origin X:
+#
+#        8 | 7 | 6
+#        --|---|---
+#        5 | X | 4
+#        --|---|---
+#        3 | 2 | 1
+POSITIONS = [(1, -1), (0, -1), (-1, -1),
+             (1, 0), (-1, 0),
+             (1, 1), (0, 1), (-1, 1)]
+CORNERS = (1, 3, 6, 8)  # dist * sqrt(2) from the origin
+# the pairs of adjacent neighbors bounding each of the eight triangles;
+# in BTM_v1, their edges are labeled A-H
+ADJACENT_SHIFTS = [(1, 2), (2, 3), (1, 4), (3, 5),
+                   (6, 4), (5, 8), (6, 7), (7, 8)]
 
 
 def compute_edge(raster_1, raster_2, distance):
@@ -53,13 +69,124 @@ def triangle_area(side_a, side_b, side_c):
          / 2)
 
 
-def main(in_raster=None, out_raster=None, acr_correction=True, area_raster=None):
+def surface_areas(in_array, cell_width, cell_height, acr_correction=True):
+    """
+    Surface area and planar area of each cell of an array, less its one
+    cell halo, as float32. The eight triangles joining each cell to its
+    neighbors are computed from slices of the array, and summed in place.
+    With acr_correction, the planar area is corrected for the slope of
+    the cell, otherwise it's the cell's area as a scalar.
+    """
+    # the same cell size as was used in BTM v1: (mean_x + mean_y) / 2
+    cell_size = (cell_width + cell_height) / 2.0
+    bathy = np.asarray(in_array, dtype=np.float32)
+    (nrows, ncols) = (bathy.shape[0] - 2, bathy.shape[1] - 2)
+    center = bathy[1:-1, 1:-1]
+
+    def shift(x_shift, y_shift):
+        # the cell a Shift_management by (x_shift, y_shift) cells moves
+        # to each cell
+        return bathy[1 + y_shift:1 + y_shift + nrows,
+                     1 - x_shift:1 - x_shift + ncols]
+
+    shifts = [None] + [shift(x_shift, y_shift)
+                       for (x_shift, y_shift) in POSITIONS]
+    corner_dist = math.sqrt(2 * cell_size ** 2)
+    edges = [None] + [
+        compute_edge(center, shifts[n],
+                     corner_dist if n in CORNERS else cell_size)
+        for n in range(1, 9)]
+
+    total_area = np.zeros((nrows, ncols), dtype=np.float32)
+    for (i, j) in ADJACENT_SHIFTS:
+        # the third side joins the two shifted cells
+        edge = compute_edge(shifts[i], shifts[j], cell_size)
+        total_area += triangle_area(edges[i], edges[j], edge)
+    del edges
+
+    if acr_correction:
+        slope = focal.slope(in_array, cell_width, cell_height)[1:-1, 1:-1]
+        planar_area = float(cell_size**2) / np.cos(
+            slope.astype(np.float32) * np.float32(0.01745))
+    else:
+        planar_area = np.float32(cell_size**2)
+    return (total_area, planar_area)
+
+
+def sapa_block(in_array, overlap, cell_width, cell_height,
+               acr_correction=True, area=False):
+    """
+    Surface area to planar area ratio of a block with a one cell halo,
+    and with area, the surface area as well.
+    """
+    (total_area, planar_area) = surface_areas(in_array, cell_width,
+                                              cell_height, acr_correction)
+    results = [total_area / planar_area]
+    if area:
+        results.append(total_area)
+    return results
+
+
+def scales_overlap(sizes):
+    """Halo needed for the windows of sizes, and their triangles."""
+    return max(focal.Neighborhood.rectangle(max(sizes)).extent) + 1
+
+
+def sapa_scales_block(in_array, halo, sizes, cell_width, cell_height,
+                      acr_correction=True):
+    """
+    Ratio of the summed surface area to the summed planar area over the
+    size x size window of each cell, for each of sizes, with the block's
+    (above, below, left, right) halo removed. The per cell areas and
+    their integral images are computed once, so each further size only
+    costs the lookups of its window sums. Windows holding a NoData area,
+    or reaching past the raster edge, are NoData.
+    """
+    # pad blocks on the raster edge out to the full halo with NoData
+    overlap = scales_overlap(sizes)
+    (above, below, left, right) = halo
+    in_array = np.pad(np.asarray(in_array, dtype=np.float64),
+                      ((overlap - above, overlap - below),
+                       (overlap - left, overlap - right)),
+                      mode='constant', constant_values=np.nan)
+    (total_area, planar_area) = surface_areas(in_array, cell_width,
+                                              cell_height, acr_correction)
+    planar_area = np.broadcast_to(planar_area, total_area.shape)
+    nodata = np.isnan(total_area) | np.isnan(planar_area)
+    integrals = [focal.integral_image(nodata)]
+    for area in (total_area, planar_area):
+        integrals.append(focal.integral_image(np.where(nodata, 0, area)))
+    del total_area, planar_area
+
+    # the areas already lack the one cell halo of their triangles
+    crop = overlap - 1
+    (nrows, ncols) = nodata.shape
+    results = []
+    for size in sizes:
+        extent = focal.Neighborhood.rectangle(size).extent
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = (focal.window_sum(integrals[1], extent) /
+                      focal.window_sum(integrals[2], extent))
+        result[focal.window_sum(integrals[0], extent) > 0] = np.nan
+        results.append(result[crop:nrows - crop,
+                              crop:ncols - crop].astype(np.float32))
+    return results
+
+
+def main(in_raster=None, out_raster=None, acr_correction=True,
+         area_raster=None, memory_budget=None):
     """
     A calculation of rugosity, based on the difference between surface
     area and planar area, as described in Jenness, J. 2002. Surface Areas
     and Ratios from Elevation Grid (surfgrids.avx) extension for ArcView 3.x,
     v. 1.2. Jenness Enterprises.
 
+    The bathymetry is read a block at a time, and the triangle edges and
+    areas computed on slices of each block, so only the ratio and the
+    optional surface area raster are written. Cells on the edge of the
+    raster lack neighbors, and are NoData. The memory_budget, in bytes or
+    a string such as '8GB', bounds the blocks.
+
     NOTE: the VRM method implemented in ruggeddness is generally considered
           superior to this method.
     """
@@ -76,138 +203,94 @@ def main(in_raster=None, out_raster=None, acr_correction=True, area_raster=None)
     # make sure workspace exists
     utils.workspace_exists(out_workspace)
 
-    utils.msg("Set scratch workspace to {}...".format(out_workspace))
-
-    # force temporary stats to be computed in our output workspace
-    arcpy.env.scratchWorkspace = out_workspace
-    arcpy.env.workspace = out_workspace
-    pyramid_orig = arcpy.env.pyramid
-    arcpy.env.pyramid = "NONE"
+    be = utils.backend()
+    be.env.scratchWorkspace = out_workspace
+    be.env.workspace = out_workspace
     # TODO: currently set to automatically overwrite, expose this as option
-    arcpy.env.overwriteOutput = True
-
-    bathy = Raster(in_raster)
-    # get the cell size of the input raster; use same calculation as was
-    # performed in BTM v1: (mean_x + mean_y) / 2
-    cell_size = (bathy.meanCellWidth + bathy.meanCellHeight) / 2.0
-    corner_dist = math.sqrt(2 * cell_size ** 2)
-    flat_area = cell_size ** 2
-    utils.msg("Cell size: {}\nFlat area: {}".format(cell_size, flat_area))
+    be.env.overwriteOutput = True
+    be.env.rasterStatistics = "STATISTICS"
+    be.env.compression = "LZW"
 
     try:
-        # Create a set of shifted grids, with offets n from the origin X:
-
-        #        8 | 7 | 6
-        #        --|---|---
-        #        5 | X | 4
-        #        --|---|---
-        #        3 | 2 | 1
-
-        positions = [(1, -1), (0, -1), (-1, -1),
-                     (1,  0),          (-1,  0),
-                     (1,  1), (0,  1), (-1,  1)]
-
-        corners = (1, 3, 6, 8)      # dist * sqrt(2), as set in corner_dist
-        orthogonals = (2, 4, 5, 7)  # von Neumann neighbors, straight dist
-        shift_rasts = [None]        # offset to align numbers
-        temp_rasts = []
-
-        for (n, pos) in enumerate(positions, start=1):
-            utils.msg("Creating Shift Grid {} of 8...".format(n))
-            # scale shift grid by cell size
-            (x_shift, y_shift) = map(lambda n: n * cell_size, pos)
-
-            # set explicit path on shift rasters, otherwise suffer
-            # inexplicable 999999 errors.
-            shift_out = os.path.join(out_workspace, "shift_{}.tif".format(n))
-            shift_out = utils.validate_path(shift_out)
-            temp_rasts.append(shift_out)
-            arcpy.Shift_management(bathy, shift_out, x_shift, y_shift)
-            shift_rasts.append(arcpy.sa.Raster(shift_out))
-
-        edge_rasts = [None]
-        # calculate triangle length grids
-
-        # edges 1-8: pairs of bathy:shift[n]
-        for (n, shift) in enumerate(shift_rasts[1:], start=1):
-            utils.msg("Calculating Triangle Edge {} of 16...".format(n))
-            # adjust for corners being sqrt(2) from center
-            if n in corners:
-                dist = corner_dist
-            else:
-                dist = cell_size
-            edge_out = os.path.join(out_workspace, "edge_{}.tif".format(n))
-            edge_out = utils.validate_path(edge_out)
-            temp_rasts.append(edge_out)
-            edge = compute_edge(bathy, shift, dist)
-            edge.save(edge_out)
-            edge_rasts.append(arcpy.sa.Raster(edge_out))
-
-        # edges 9-16: pairs of adjacent shift grids [see layout above]
-        # in BTM_v1, these are labeled A-H
-        adjacent_shift = [(1, 2), (2, 3), (1, 4), (3, 5),
-                          (6, 4), (5, 8), (6, 7), (7, 8)]
-        for (n, pair) in enumerate(adjacent_shift, start=9):
-            utils.msg("Calculating Triangle Edge {} of 16...".format(n))
-            # the two shift rasters for this iteration
-            (i, j) = pair
-            edge_out = os.path.join(out_workspace, "edge_{}.tif".format(n))
-            edge_out = utils.validate_path(edge_out)
-            temp_rasts.append(edge_out)
-            edge = compute_edge(shift_rasts[i], shift_rasts[j], cell_size)
-            edge.save(edge_out)
-            edge_rasts.append(arcpy.sa.Raster(edge_out))
-
-        # areas of each triangle
-        areas = []
-        for (n, pair) in enumerate(adjacent_shift, start=1):
-            utils.msg("Calculating Triangle Area {} of 8...".format(n))
-            # the two shift rasters; n has the third side
-            (i, j) = pair
-            area_out = os.path.join(out_workspace, "area_{}.tif".format(n))
-            area_out = utils.validate_path(area_out)
-            temp_rasts.append(area_out)
-
-            area = triangle_area(edge_rasts[i], edge_rasts[j], edge_rasts[n+8])
-            area.save(area_out)
-            areas.append(arcpy.sa.Raster(area_out))
-
-        utils.msg("Summing Triangle Area...")
-        arcpy.env.pyramid = pyramid_orig
-        arcpy.env.rasterStatistics = "STATISTICS"
-        arcpy.env.compression = "LZW"
-        total_area = (areas[0] + areas[1] + areas[2] + areas[3] +
-                      areas[4] + areas[5] + areas[6] + areas[7])
-        if area_raster:
-            save_msg = "Saving Surface Area Raster to " + \
-                "{}.".format(area_raster)
-            utils.msg(save_msg)
-            arcpy.CopyRaster_management(total_area, area_raster)
-
-        if not acr_correction:
-            utils.msg("Calculating ratio with uncorrected planar area.")
-            area_ratio = total_area / cell_size**2
-        else:
+        bp = utils.BlockProcessor(in_raster)
+        # get the cell size of the input raster; use same calculation as was
+        # performed in BTM v1: (mean_x + mean_y) / 2
+        cell_size = bp.georef.cell_size
+        utils.msg("Cell size: {}\nFlat area: {}".format(
+            cell_size, cell_size ** 2))
+        if acr_correction:
             utils.msg("Calculating ratio with slope-corrected planar area.")
-            slope_raster = arcpy.sa.Slope(in_raster, "DEGREE", "1")
-            planar_area = Divide(float(cell_size**2),
-                                 Cos(Times(slope_raster, 0.01745)))
-            area_ratio = Divide(total_area, planar_area)
+        else:
+            utils.msg("Calculating ratio with uncorrected planar area.")
 
-        out_raster = utils.validate_path(out_raster)
-        save_msg = "Saving Surface Area to Planar Area ratio to " + \
-            "{}.".format(out_raster)
-        utils.msg(save_msg)
-        arcpy.CopyRaster_management(area_ratio, out_raster)
+        out_rasters = [utils.validate_path(out_raster)]
+        if area_raster:
+            out_rasters.append(utils.validate_path(area_raster))
+        cost = memory.KERNEL_COSTS['sapa'].for_outputs(len(out_rasters))
+        (blocksize, _) = bp.blockSize(cost, 3, 1, memory_budget)
+        kernel = functools.partial(
+            sapa_block, cell_width=bp.georef.cell_width,
+            cell_height=bp.georef.cell_height,
+            acr_correction=acr_correction, area=bool(area_raster))
+        utils.msg("Calculating Triangle Areas...")
+        bp.computeBlockStatistics(kernel, blocksize, out_rasters, 1)
+        for path in out_rasters:
+            utils.msg("Saved output as {}".format(path))
 
     except Exception as e:
         utils.msg(e, mtype='error')
 
+
+def multiple_scales(in_raster=None, neighborhood_sizes=None,
+                    out_rasters=None, acr_correction=True,
+                    memory_budget=None):
+    """
+    Compute the surface area to planar area ratio over windows of each of
+    neighborhood_sizes, saving each to the matching raster of
+    out_rasters: the summed surface area of the cells in the window over
+    their summed planar area, slope-corrected with acr_correction. A size
+    of one is the ratio of main(). The per cell areas are computed once
+    for each block, and shared by all the sizes, as with the multi-scale
+    VRM of ruggedness.multiple_scales.
+    """
+    if isinstance(acr_correction, str) and acr_correction.lower() == 'false':
+        acr_correction = False
+    sizes = [int(size) for size in neighborhood_sizes]
+
+    w = utils.Workspace()
+    if w.exists:
+        out_workspace = w.path
+    else:
+        out_workspace = os.path.dirname(out_rasters[0])
+    utils.workspace_exists(out_workspace)
+    be = utils.backend()
+    be.env.scratchWorkspace = out_workspace
+    be.env.workspace = out_workspace
+    # TODO: currently set to automatically overwrite, expose this as option
+    be.env.overwriteOutput = True
+    be.env.rasterStatistics = "STATISTICS"
+    be.env.compression = "LZW"
+
     try:
-        # Delete all intermediate raster data sets
-        utils.msg("Deleting intermediate data...")
-        for path in temp_rasts:
-            arcpy.Delete_management(path)
+        out_rasters = [utils.validate_path(path) for path in out_rasters]
+        utils.msg("Calculating the surface area to planar area ratio for "
+                  "neighborhood sizes {}...".format(
+                      ", ".join(str(size) for size in sizes)))
+        bp = utils.BlockProcessor(in_raster)
+        # the window sums reach past the window by the triangles' halo
+        window = max(sizes)
+        overlap = scales_overlap(sizes)
+        cost = memory.KERNEL_COSTS['sapa_scales'].for_outputs(len(sizes))
+        (blocksize, _) = bp.blockSize(cost, window, overlap, memory_budget)
+        kernel = functools.partial(
+            sapa_scales_block, sizes=sizes,
+            cell_width=bp.georef.cell_width,
+            cell_height=bp.georef.cell_height,
+            acr_correction=acr_correction)
+        bp.computeBlockStatistics(kernel, blocksize, out_rasters, overlap,
+                                  edges=True)
+        for path in out_rasters:
+            utils.msg("Saved output as {}".format(path))
 
     except Exception as e:
         utils.msg(e, mtype='error')
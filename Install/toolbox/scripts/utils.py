@@ -6,6 +6,7 @@ handling BTM classification dictionaries.
 """
 
 from __future__ import absolute_import
+import functools
 import locale
 import sys
 import json
@@ -16,21 +17,23 @@ import csv
 import math
 from platform import architecture
 from xml.dom.minidom import parse
-try:
-    from netCDF4 import Dataset
-    NETCDF4_EXISTS = True
-except ImportError:
-    NETCDF4_EXISTS = False
 try:
     import scipy
     SCIPY_EXISTS = True
 except ImportError:
     SCIPY_EXISTS = False
+try:
+    import arcpy
+    ARCPY_EXISTS = True
+except ImportError:
+    # no ArcGIS, tools run with the NumPy backend.
+    ARCPY_EXISTS = False
 
-import arcpy
-from arcpy import Raster
 from . import config
+from . import memory
+from . import backend as raster_backend
 
+from .pipeline import pipeline
 from .tempdir import TempDir
 
 # register the default locale
@@ -39,9 +42,26 @@ locale.setlocale(locale.LC_ALL, '')
 # What kinds of inputs can we expect to compute statistics on?
 # TODO add Mosaic Dataset, Mosaic Layer
 VALID_RASTER_TYPES = ['RasterDataset', 'RasterLayer']
+# workspaces whose rasters aren't files of their own
+GEODATABASE_EXTENSIONS = ('.gdb', '.mdb', '.sde')
 
 ARCH = architecture()[0]
 
+# active raster backend, created on first use; see backend()
+_backend = None
+
+
+def backend():
+    """
+    The raster backend for this run, as selected by `config.backend`
+    ('arcpy' or 'numpy'). Defaults to ArcPy when it's available.
+    """
+    global _backend
+    if _backend is None or (config.backend and
+                            _backend.name != config.backend.lower()):
+        _backend = raster_backend.get_backend(config.backend)
+    return _backend
+
 
 def msg(output, mtype='message'):
     """
@@ -55,13 +75,16 @@ def msg(output, mtype='message'):
             exception_message = output
         else:
             exception_message = "{}: {}".format(type(output).__name__, output)
-        arcpy_messages = arcpy.GetMessages()
+        if ARCPY_EXISTS:
+            arcpy_messages = arcpy.GetMessages()
+        else:
+            arcpy_messages = '(None)'
         full_traceback = sys.exc_info()[2]
         if full_traceback:
             tbinfo = "".join(traceback.format_tb(full_traceback))
         else:
             tbinfo = '(None)'
-        if config.mode == 'script':
+        if config.mode == 'script' or not ARCPY_EXISTS:
             # print the raw exception
             print(exception_message)
             # Arcpy and Python stuff, hopefully also helpful
@@ -72,7 +95,7 @@ def msg(output, mtype='message'):
             arcpy.AddError(exception_message)
             arcpy.AddError(arcpy_messages)
             arcpy.AddMessage("Python Error: {tbinfo}".format(tbinfo=tbinfo))
-    elif config.mode == 'script':
+    elif config.mode == 'script' or not ARCPY_EXISTS:
         print(output)
     else:
         if mtype == 'message':
@@ -109,11 +132,11 @@ def validate_path(path):
     file_base = os.path.splitext(file_name)[0]
     if dirname == '':
         # a relative path only, relying on the workspace
-        dirname = arcpy.env.workspace
+        dirname = backend().env.workspace or ''
     path_ext = os.path.splitext(dirname)[1].lower()
     if path_ext in ['.mdb', '.gdb', '.sde']:
         # we're working in a database
-        file_name = arcpy.ValidateTableName(file_base)
+        file_name = backend().validate_table_name(file_base)
         if file_name != file_base:
             msg("Warning: renamed output table to {}".format(file_name))
     validated_path = os.path.join(dirname, file_name)
@@ -123,13 +146,15 @@ def validate_path(path):
 def save_raster(raster, path):
     """Save input raster object to path, and return raster reference."""
     path = validate_path(path)
-    raster.save(path)
-    return arcpy.sa.Raster(path)
+    return backend().save(raster, path)
 
 
 def raster_properties(input_raster, attribute='MEAN'):
     """ Wrapper for GetRasterProperties_management which does the right thing."""
 
+    if backend().name == 'numpy':
+        return backend().raster_property(input_raster, attribute)
+
     input_raster_path = None
     if input_raster is not None:
         try:
@@ -294,86 +319,507 @@ class Workspace(object):
         return name
 
 
+class TileStore(object):
+    """
+    A raster held in a raw memory-mapped file, float32 by default, with
+    NaN for NoData. Tiles are read and written in place, so results larger
+    than memory can be assembled a window at a time, and then converted
+    to their final raster format once. Other processes can open the same
+    store from its path.
+
+    Integer stores, used to spill whole numbered results compactly, hold
+    NoData as the smallest value of their type; blocks are still read
+    and written as floats with NaN for NoData. Only float stores can be
+    saved as rasters.
+    """
+    def __init__(self, path, shape, mode='w+', dtype=np.float32):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if np.issubdtype(self.dtype, np.integer):
+            self.nodata = np.iinfo(self.dtype).min
+        else:
+            self.nodata = None
+        self.array = np.memmap(path, dtype=self.dtype, mode=mode,
+                               shape=self.shape)
+
+    def read(self, window):
+        """Read a (row, col, nrows, ncols) window as float64."""
+        (row, col, nrows, ncols) = window
+        block = np.array(self.array[row:row + nrows, col:col + ncols],
+                         dtype=np.float64)
+        if self.nodata is not None:
+            block[block == self.nodata] = np.nan
+        return block
+
+    def write(self, row, col, block):
+        """Write block with its upper left cell at (row, col)."""
+        (nrows, ncols) = np.shape(block)
+        if self.nodata is not None:
+            block = np.where(np.isnan(block), self.nodata, block)
+        self.array[row:row + nrows, col:col + ncols] = block
+
+    def fill_border(self, width, value=np.nan):
+        """Set the cells within width cells of the raster edge."""
+        if self.nodata is not None and np.isnan(value):
+            value = self.nodata
+        if width > 0:
+            self.array[:width, :] = value
+            self.array[-width:, :] = value
+            self.array[:, :width] = value
+            self.array[:, -width:] = value
+
+    def save(self, raster_backend, georef, path, integer=False, zones=None):
+        """
+        Write the store as a raster, via the given backend. Integer
+        rasters can include a zones mapping of values to names.
+        """
+        self.array.flush()
+        return raster_backend.write_array(self.array, georef, path,
+                                          integer=integer, zones=zones)
+
+    def close(self):
+        """Release the memory map, so the file can be removed."""
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+
+class Moments(object):
+    """
+    Count, mean, variance and range of the valid cells of a raster,
+    accumulated a block at a time. Each block's moments are computed
+    directly, and blocks are merged with the pairwise update of Chan et
+    al., so the result is as accurate as a pass over the whole raster,
+    whatever the order the blocks arrive in.
+    """
+    def __init__(self, count=0, mean=0.0, m2=0.0, minimum=None,
+                 maximum=None):
+        self.count = int(count)
+        self.mean = float(mean)
+        # sum of squared deviations from the mean
+        self.m2 = float(m2)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    @classmethod
+    def from_array(cls, array):
+        """Moments of the non-NaN cells of array."""
+        values = np.asarray(array, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return cls()
+        mean = values.mean()
+        return cls(values.size, mean, ((values - mean)**2).sum(),
+                   float(values.min()), float(values.max()))
+
+    def merge(self, other):
+        """Add the cells of other, returning self."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            (self.count, self.mean, self.m2) = (other.count, other.mean,
+                                                other.m2)
+            (self.minimum, self.maximum) = (other.minimum, other.maximum)
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        return self
+
+    @property
+    def variance(self):
+        """Population variance, as reported by raster statistics."""
+        return self.m2 / self.count if self.count else None
+
+    @property
+    def std(self):
+        variance = self.variance
+        return math.sqrt(variance) if variance is not None else None
+
+    def save(self, raster):
+        """
+        Store the moments of raster alongside it, see moments_path(). A
+        geodatabase raster isn't a file of its own, so the time its
+        geodatabase was last modified is stored with them.
+        """
+        stored = {'count': self.count, 'mean': self.mean, 'm2': self.m2,
+                  'minimum': self.minimum, 'maximum': self.maximum}
+        if not os.path.exists(raster):
+            stored['workspace_modified'] = _workspace_modified(raster)
+        with open(moments_path(raster), 'w') as f:
+            json.dump(stored, f)
+
+    @classmethod
+    def load(cls, raster):
+        """
+        The moments stored alongside raster, or None if there are none,
+        or the raster has changed since they were stored. For a
+        geodatabase raster, any change to its geodatabase since counts,
+        and moments which can't be checked are never used.
+        """
+        path = moments_path(raster)
+        if not os.path.exists(path):
+            return None
+        if os.path.exists(raster) and \
+                os.path.getmtime(raster) > os.path.getmtime(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                stored = json.load(f)
+            stored_modified = stored.pop('workspace_modified', None)
+            if not os.path.exists(raster):
+                modified = _workspace_modified(raster)
+                if modified is None or stored_modified is None or \
+                        modified > stored_modified:
+                    return None
+            return cls(**stored)
+        except (ValueError, TypeError):
+            return None
+
+    @staticmethod
+    def discard(raster):
+        """Remove any moments stored for raster, once it's rewritten."""
+        path = moments_path(raster)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _workspace_modified(raster):
+    """
+    Latest modification time of the geodatabase holding raster: of any
+    file in a file geodatabase, or of a personal geodatabase. None when
+    raster isn't in a local geodatabase.
+    """
+    workspace = os.path.dirname(raster)
+    if os.path.splitext(workspace)[1].lower() not in GEODATABASE_EXTENSIONS:
+        return None
+    if os.path.isdir(workspace):
+        return max([os.path.getmtime(workspace)] +
+                   [os.path.getmtime(os.path.join(workspace, name))
+                    for name in os.listdir(workspace)])
+    if os.path.isfile(workspace):
+        return os.path.getmtime(workspace)
+    return None
+
+
+def moments_path(raster):
+    """
+    Path of the file holding the Moments of a raster: beside it, or for a
+    geodatabase raster, beside the geodatabase.
+    """
+    (workspace, name) = os.path.split(raster)
+    if os.path.splitext(workspace)[1].lower() in GEODATABASE_EXTENSIONS:
+        name = "{}_{}".format(os.path.basename(workspace), name)
+        workspace = os.path.dirname(workspace)
+    return os.path.join(workspace, name + '.moments.json')
+
+
+# input and output tile stores of a block processing worker process,
+# opened once per process by _init_block_worker
+_worker_stores = {}
+
+
+def _init_block_worker(in_path, out_stores, shape, in_dtype):
+    # without a dtype, in_path is the source raster, read directly
+    if in_dtype is None:
+        _worker_stores['in'] = in_path
+    else:
+        _worker_stores['in'] = TileStore(in_path, shape, mode='r',
+                                         dtype=in_dtype)
+    _worker_stores['out'] = [TileStore(path, shape, mode='r+', dtype=dtype)
+                             for (path, dtype) in out_stores]
+
+
+def _block_moments(store, block):
+    """
+    Moments of a block written to store. Float stores round the values to
+    their precision; integer stores are given whole numbers, and their
+    moments are of the values given, so overflows can be detected.
+    """
+    if store.nodata is None:
+        block = np.asarray(block, dtype=store.dtype)
+    return Moments.from_array(block)
+
+
+def _as_list(func, block, halo):
+    """Result of a single output kernel, as the list of its outputs."""
+    return [func(block, halo)]
+
+
+def _process_block(job):
+    """
+    Compute one block in a worker process, writing it to the stores.
+    Returns the block's window, and its Moments for each store if asked.
+    """
+    (func, window, halo, origin, moments) = job
+    source = _worker_stores['in']
+    if isinstance(source, TileStore):
+        block = source.read(window)
+    else:
+        block = backend().read_array(source, window).view(np.ndarray)
+    blocks = func(block, halo)
+    results = []
+    for (store, block) in zip(_worker_stores['out'], blocks):
+        store.write(origin[0], origin[1], block)
+        if moments:
+            results.append(_block_moments(store, block))
+    return (window, results)
+
+
+def worker_pool(workers, initializer=None, initargs=()):
+    """A process pool of the given size, which also works inside ArcGIS."""
+    import multiprocessing
+    if os.name == 'nt':
+        # within ArcGIS sys.executable is the application, not Python
+        python = os.path.join(sys.exec_prefix, 'pythonw.exe')
+        if os.path.exists(python):
+            multiprocessing.set_executable(python)
+    return multiprocessing.Pool(workers, initializer, initargs)
+
+
+def worker_count(workers=None):
+    """Number of worker processes: workers, or config.workers if None."""
+    if workers is None:
+        workers = config.workers
+    workers = int(workers)
+    if workers < 1:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    return workers
+
+
 class BlockProcessor:
 
-    def __init__(self, fileIn):
-        self.fileIn = Raster(fileIn)
-        self.width = self.fileIn.width
-        self.height = self.fileIn.height
-        if self.fileIn.noDataValue:
-            self.noData = self.fileIn.noDataValue
+    def __init__(self, fileIn, workers=None):
+        self.backend = backend()
+        if self.backend.name == 'arcpy':
+            self.fileIn = self.backend.raster(fileIn)
+        else:
+            # defer reading cells until the blocks are processed
+            self.fileIn = fileIn
+        self.georef = self.backend.describe(self.fileIn)
+        self.width = self.georef.ncols
+        self.height = self.georef.nrows
+        if self.georef.nodata:
+            self.noData = self.georef.nodata
         else:
             self.noData = -9999
-        arcpy.env.outputCoordinateSystem = self.fileIn
-        arcpy.env.overwriteOutput = True
+        if self.backend.name == 'arcpy':
+            arcpy.env.outputCoordinateSystem = self.fileIn
+        self.backend.env.overwriteOutput = True
+        self.workers = worker_count(workers)
 
-    def computeBlockStatistics(self, func, blockSize, outRast, overlap=0):
-        # immediately fail if we don't have a netCDF4 backend available:
-        if not NETCDF4_EXISTS:
-            return None
+    def blockSize(self, cost, window, overlap=0, memory_budget=None):
+        """
+        Block size, and the working space left for each block's kernel,
+        which fit the memory budget shared by the worker processes, for a
+        kernel with the given memory.CostModel. A single process also
+        holds the blocks its pipeline buffers; worker processes hold only
+        their own.
+        """
+        if self.workers > 1:
+            return memory.tile_size(cost, window, overlap, memory_budget,
+                                    self.workers, depth=0)
+        return memory.tile_size(cost, window, overlap, memory_budget)
 
-        total_blocks = int(math.ceil(float(self.width) / blockSize) *
-                           math.ceil(float(self.height) / blockSize))
-        verbose = total_blocks > 1
-        if verbose:
-            msg("Beginning block analysis...")
+    def computeBlockStatistics(self, func, blockSize, outRast, overlap=0,
+                               edges=False, integer=False, moments=False):
+        """
+        Apply func(block, overlap) to blocks of the input read with overlap
+        cells of halo, saving the results, with the halo removed, to
+        outRast. Cells within overlap of the raster edge are NoData.
+
+        With edges, the blocks along the raster edge are read with only
+        the halo which exists, and func is called with the (above, below,
+        left, right) halo of each block instead, so kernels which handle
+        partial windows can compute every cell.
+
+        When outRast is a list of rasters, func returns a list of blocks,
+        one for each, so several results can come from one pass. With
+        integer, the results are saved as integer rasters.
+
+        With moments, the Moments of each output are accumulated from its
+        blocks as they are written, and returned in a list, sparing a
+        statistics pass over the saved rasters.
+        """
+        if isinstance(outRast, (list, tuple)):
+            outputs = list(outRast)
+        else:
+            outputs = [outRast]
+            func = functools.partial(_as_list, func)
         with TempDir() as d:
-            # generate random integers to prevent decimal place in name
-            # use sampling without replacement to preclude collision
-            rands = np.random.choice(2**16, size=2, replace=False)
-
-            inNetCDF = os.path.join(d, '{}.nc'.format(rands[0]))
-            arcpy.RasterToNetCDF_md(self.fileIn, inNetCDF, r"Band1")
-            inFile = Dataset(inNetCDF, mode="a")
-            inDepth = inFile.variables['Band1']
-
-            outNetCDF = os.path.join(d, '{}.nc'.format(rands[1]))
-            arcpy.RasterToNetCDF_md(self.fileIn, outNetCDF, r"Band1")
-            outFile = Dataset(outNetCDF, mode="a")
-            outDepth = outFile.variables['Band1']
-            # Initialize entire output matrix to the No Data value --
-            # the blocking code will write out the blocks which it
-            # processes, setting these cells as it goes along. Doing this
-            # avoids problems with the edge cells (issue #128).
-            outDepth[:, :] = np.ones((self.width, self.height)) * self.noData
-
-            bnum = 0
-            x = 0
-            while x < self.width:
-                y = 0
-                while y < self.height:
-                    if verbose:
-                        msg("Processing block {} of {} in {}..."
-                            .format(bnum + 1, total_blocks, self.fileIn.name))
+            # blocks are read as windows of the source raster, and their
+            # results written in place to memory-mapped stores, which
+            # are converted to the output rasters once all are done.
+            stores = []
+            try:
+                for i in range(len(outputs)):
+                    path = os.path.join(d, 'blocks{}.dat'.format(i))
+                    store = TileStore(path, (self.height, self.width))
+                    stores.append(store)
+                    # cells within overlap of the edge have no full window,
+                    # the blocks only write the cells inside that border
+                    # (issue #128).
+                    if not edges:
+                        store.fill_border(overlap)
+                totals = self.computeBlocks(func, blockSize, stores, overlap,
+                                            edges, moments)
+                for (store, path) in zip(stores, outputs):
+                    msg("Saving result to {}...".format(path))
+                    store.save(self.backend, self.georef, path, integer)
+            finally:
+                for store in stores:
+                    store.close()
+        return totals
+
+    def computeBlocks(self, func, blockSize, stores, overlap=0, edges=False,
+                      moments=False):
+        """
+        Apply func to blocks of the input, as computeBlockStatistics does,
+        writing the list of blocks func returns into the matching
+        TileStore of stores, rather than saving rasters. Returns the
+        Moments of each store's blocks if moments, otherwise None.
+        """
+        blocks = list(self._blocks(blockSize, overlap, edges))
+        totals = [Moments() for _ in stores] if moments else None
+        for store in stores:
+            store.array.flush()
+        if self.workers > 1 and len(blocks) > 1:
+            with TempDir() as d:
+                self._processBlocksParallel(func, blocks, stores, d, totals)
+        else:
+            self._processBlocks(func, blocks, stores, totals)
+        return totals
+
+    def _blocks(self, blockSize, overlap, edges=False):
+        """
+        Yield (window, halo, origin) for each block: the (row, col, nrows,
+        ncols) window read, including its halo, the halo passed to the
+        kernel, and the (row, col) its result is written to. Blocks tile
+        the raster in steps of blockSize.
+        """
+        x = 0
+        while x < self.width:
+            y = 0
+            while y < self.height:
+                if edges:
+                    (row, col) = (max(y - overlap, 0), max(x - overlap, 0))
+                    bottom = min(y + blockSize, self.height)
+                    right = min(x + blockSize, self.width)
+                    nrows = min(bottom + overlap, self.height) - row
+                    ncols = min(right + overlap, self.width) - col
+                    halo = (y - row, row + nrows - bottom,
+                            x - col, col + ncols - right)
+                    yield ((row, col, nrows, ncols), halo, (y, x))
+                else:
                     ncols = blockSize + overlap * 2
                     nrows = blockSize + overlap * 2
                     if (x + ncols) >= self.width:
                         ncols = self.width - x
                     if (y + nrows) >= self.height:
                         nrows = self.height - y
-                    syh = y + nrows
-                    sxh = x + ncols
-                    iyl = y + overlap
-                    iyh = y + nrows - overlap
-                    ixl = x + overlap
-                    ixh = x + ncols - overlap
-                    block = inDepth[y:syh, x:sxh]
-                    block = func(block, overlap)
-                    outDepth[iyl:iyh, ixl:ixh] = block
-                    bnum += 1
-                    y += blockSize
-                x += blockSize
-
-            outFile.close()
-            inFile.close()
-
-            msg("Creating result raster layer...")
-            layerName = os.path.splitext(os.path.split(outRast)[1])[0]
-
-            arcpy.MakeNetCDFRasterLayer_md(outNetCDF, 'Band1',
-                                           'x', 'y', layerName)
-            msg("Saving result layer to {}...".format(outRast))
-            arcpy.CopyRaster_management(layerName, outRast)
+                    # trailing blocks within the border hold no full window
+                    if nrows > overlap * 2 and ncols > overlap * 2:
+                        yield ((y, x, nrows, ncols), overlap,
+                               (y + overlap, x + overlap))
+                y += blockSize
+            x += blockSize
+
+    def _read(self, window):
+        return self.backend.read_array(self.fileIn, window).view(np.ndarray)
+
+    def _processBlocks(self, func, blocks, stores, totals=None):
+        """
+        Apply func to each block of the input, writing into stores, and
+        merging each block's moments into totals if given. The
+        next block is read, and the last written, while one computes.
+        """
+        total_blocks = len(blocks)
+        verbose = total_blocks > 1
+        if verbose:
+            msg("Beginning block analysis...")
+        numbers = dict((job, bnum) for (bnum, job) in enumerate(blocks))
+
+        def read(job):
+            return self._read(job[0])
+
+        def compute(job, block):
+            if verbose:
+                msg("Processing block {} of {}...".format(
+                    numbers[job] + 1, total_blocks))
+            return func(block, job[1])
+
+        def write(job, results):
+            for (i, (store, block)) in enumerate(zip(stores, results)):
+                store.write(job[2][0], job[2][1], block)
+                if totals is not None:
+                    totals[i].merge(_block_moments(store, block))
+
+        pipeline(blocks, read, compute, write,
+                 threaded=self.backend.threadsafe_io)
+
+    def _processBlocksParallel(self, func, blocks, stores, tempdir,
+                               totals=None):
+        """
+        Apply func to the blocks in worker processes. Each worker writes
+        its results in place to the output stores, so only block windows,
+        and block moments when totals is given, pass between processes.
+
+        Workers read their windows straight from the input when the
+        backend's reads are independent of each other; otherwise the input
+        is first copied to a memory-mapped store which the workers share,
+        as float32 unless the input needs more precision.
+        """
+        # the threadsafe backends are given a path to read, not a raster
+        if self.backend.threadsafe_io:
+            (source_path, source_dtype) = (self.fileIn, None)
+        else:
+            msg("Staging input for {} worker processes...".format(
+                self.workers))
+            dtype = np.promote_types(self._read((0, 0, 1, 1)).dtype,
+                                     np.float32)
+            source = TileStore(os.path.join(tempdir, 'source.dat'),
+                               (self.height, self.width), dtype=dtype)
+            try:
+                strip = raster_backend.WRITE_ROWS
+                strips = [(row, 0, min(strip, self.height - row),
+                           self.width)
+                          for row in range(0, self.height, strip)]
+                pipeline(strips, self._read,
+                         lambda window, data: data,
+                         lambda window, data: source.write(
+                             window[0], window[1], data),
+                         threaded=self.backend.threadsafe_io)
+                source.array.flush()
+            finally:
+                source.close()
+            (source_path, source_dtype) = (source.path, source.dtype.str)
+
+        total_blocks = len(blocks)
+        msg("Beginning block analysis...")
+        pool = worker_pool(self.workers, _init_block_worker,
+                           (source_path,
+                            [(store.path, store.dtype.str) for store in stores],
+                            (self.height, self.width), source_dtype))
+        try:
+            jobs = [(func,) + job + (totals is not None,) for job in blocks]
+            done = pool.imap_unordered(_process_block, jobs)
+            for (bnum, (window, block_moments)) in enumerate(done):
+                for (total, block_total) in zip(totals or [], block_moments):
+                    total.merge(block_total)
+                msg("Processed block {} of {} (rows {}-{}, columns {}-{})"
+                    "...".format(bnum + 1, total_blocks, window[0],
+                                 window[0] + window[2] - 1, window[1],
+                                 window[1] + window[3] - 1))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
 
 class NotTextNodeError(Exception):
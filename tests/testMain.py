@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import functools
 import locale
 import os
 import unittest
@@ -21,7 +22,8 @@ test_utils.add_local_paths(import_paths)
 # now we can import our scripts
 from scripts import bpi, standardize_bpi_grids, btm_model, aspect, \
     slope, ruggedness, depth_statistics, classify, \
-    surface_area_to_planar_area, scale_comparison, utils as su
+    surface_area_to_planar_area, scale_comparison, focal, memory, \
+    backend, structure_classification, acr, utils as su
 
 from scripts.tempdir import TempDir
 
@@ -124,6 +126,200 @@ class TestUtilitiesMethods(unittest.TestCase):
         locale.setlocale(locale.LC_ALL, "")
         sys.path = self.sys_path
 
+
+class TestTileStore(unittest.TestCase):
+
+    def testWindowRoundTrip(self):
+        with TempDir() as d:
+            store = su.TileStore(os.path.join(d, 'tiles.dat'), (6, 8))
+            try:
+                store.fill_border(1)
+                store.write(1, 1, np.arange(24).reshape(4, 6))
+                tile = store.read((0, 0, 3, 3))
+                self.assertTrue(np.isnan(tile[0]).all())
+                self.assertTrue(np.isnan(tile[:, 0]).all())
+                self.assertEqual(tile[1, 1], 0)
+                self.assertEqual(tile[2, 2], 7)
+            finally:
+                store.close()
+
+    def testIntegerStoreKeepsNoData(self):
+        with TempDir() as d:
+            store = su.TileStore(os.path.join(d, 'bpi.dat'), (2, 3),
+                                 dtype=np.int16)
+            try:
+                store.write(0, 0, np.array([[-7, np.nan, 32767],
+                                            [0, 12, -32767]]))
+                tile = store.read((0, 0, 2, 3))
+                self.assertTrue(np.isnan(tile[0, 1]))
+                self.assertEqual(tile[0, 2], 32767)
+                self.assertEqual(tile[1, 2], -32767)
+            finally:
+                store.close()
+
+
+class TestMoments(unittest.TestCase):
+
+    def testMergedBlocksMatchWhole(self):
+        data = np.random.RandomState(8).randn(50, 40) * 5 + 1000
+        data[3, 4] = np.nan
+        total = su.Moments()
+        for rows in (slice(0, 7), slice(7, 30), slice(30, 30), slice(30, 50)):
+            total.merge(su.Moments.from_array(data[rows]))
+        values = data[~np.isnan(data)]
+        self.assertEqual(total.count, values.size)
+        self.assertAlmostEqual(total.mean, values.mean(), places=9)
+        self.assertAlmostEqual(total.std, values.std(), places=9)
+        self.assertEqual(total.maximum, values.max())
+
+    def testStoredBesideRaster(self):
+        with TempDir() as d:
+            raster = os.path.join(d, 'bpi.tif')
+            open(raster, 'w').close()
+            su.Moments(4, 2.0, 8.0, 0.0, 4.0).save(raster)
+            self.assertEqual(su.Moments.load(raster).std, np.sqrt(2.0))
+            self.assertEqual(su.moments_path(os.path.join(d, 'a.gdb', 'bpi')),
+                             os.path.join(d, 'a.gdb_bpi.moments.json'))
+            su.Moments.discard(raster)
+            self.assertIsNone(su.Moments.load(raster))
+
+    def testGeodatabaseChangesInvalidate(self):
+        with TempDir() as d:
+            gdb = os.path.join(d, 'a.gdb')
+            os.mkdir(gdb)
+            table = os.path.join(gdb, 'a00000009.gdbtable')
+            open(table, 'w').close()
+            raster = os.path.join(gdb, 'bpi')
+            su.Moments(4, 2.0, 8.0, 0.0, 4.0).save(raster)
+            self.assertEqual(su.Moments.load(raster).count, 4)
+            # the raster, or another, rewritten in the geodatabase
+            later = os.path.getmtime(table) + 10
+            os.utime(table, (later, later))
+            self.assertIsNone(su.Moments.load(raster))
+            # moments of a raster in a geodatabase we can't see are unused
+            remote = os.path.join(d, 'a.sde', 'bpi')
+            su.Moments(4, 2.0, 8.0, 0.0, 4.0).save(remote)
+            self.assertIsNone(su.Moments.load(remote))
+
+
+class TestMemory(unittest.TestCase):
+
+    def testParseSize(self):
+        self.assertEqual(memory.parse_size('512MB'), 512 * 2**20)
+        self.assertEqual(memory.parse_size('16 GB'), 16 * 2**30)
+        self.assertEqual(memory.parse_size(1000), 1000)
+
+    @raises(ValueError)
+    def testParseSizeInvalid(self):
+        memory.parse_size('lots')
+
+    def testTilesFitBudget(self):
+        cost = memory.KERNEL_COSTS['kurtosis']
+        (small, _) = memory.tile_size(cost, 5, 2, '1GB')
+        (large, _) = memory.tile_size(cost, 5, 2, '64GB')
+        (shared, _) = memory.tile_size(cost, 5, 2, '64GB', workers=16)
+        self.assertTrue(small < large)
+        self.assertTrue(shared < large)
+        tile_bytes = (small + 4)**2 * cost.bytes_per_cell(5)
+        self.assertTrue(tile_bytes <= 2**30 * memory.TILE_FRACTION)
+
+    def testBufferedPeakFitsBudget(self):
+        # the tile computed, the tiles the pipeline buffers around it and
+        # the kernel's working space all fit together
+        cost = memory.KERNEL_COSTS['iqr']
+        (tile, kernel_budget) = memory.tile_size(cost, 5, 2, '1GB')
+        peak = ((tile + 4)**2 * (cost.bytes_per_cell(5) +
+                                 cost.buffered_bytes_per_cell()) +
+                kernel_budget)
+        self.assertTrue(peak <= 2**30)
+        (unbuffered, _) = memory.tile_size(cost, 5, 2, '1GB', depth=0)
+        self.assertTrue(tile < unbuffered)
+
+    def testContainerUsageIsNotAvailable(self):
+        with TempDir() as d:
+            for (name, count) in (('memory.max', 16 * 2**30),
+                                  ('memory.current', 12 * 2**30)):
+                with open(os.path.join(d, name), 'w') as count_file:
+                    count_file.write('{}\n'.format(count))
+            self.assertEqual(memory._cgroup_available(d), 4 * 2**30)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def testResultsWrittenInOrder(self):
+        written = []
+        su.pipeline(range(10), lambda i: i * 2, lambda i, data: data + 1,
+                    lambda i, result: written.append((i, result)))
+        self.assertEqual(written, [(i, i * 2 + 1) for i in range(10)])
+
+    @raises(ValueError)
+    def testStageErrorRaised(self):
+        def read(i):
+            if i == 3:
+                raise ValueError("unreadable tile")
+            return i
+        su.pipeline(range(10), read, lambda i, data: data,
+                    lambda i, result: None)
+
+
+class TestBlockProcessorWorkers(unittest.TestCase):
+    """Blocks computed by worker processes match the serial run."""
+
+    def blockResults(self, workers, edges, moments):
+        bp = su.BlockProcessor(config.bathy_raster, workers=workers)
+        if edges:
+            sizes = [1, 3]
+            kernel = functools.partial(
+                surface_area_to_planar_area.sapa_scales_block, sizes=sizes,
+                cell_width=bp.georef.cell_width,
+                cell_height=bp.georef.cell_height)
+            overlap = surface_area_to_planar_area.scales_overlap(sizes)
+        else:
+            kernel = functools.partial(
+                surface_area_to_planar_area.sapa_block,
+                cell_width=bp.georef.cell_width,
+                cell_height=bp.georef.cell_height, area=True)
+            overlap = 1
+        # several blocks each way, so the pool has work to share
+        blocksize = max(bp.width, bp.height) // 3 + 1
+        with TempDir() as d:
+            out_rasters = [os.path.join(d, 'block{}.tif'.format(i))
+                           for i in range(2)]
+            totals = bp.computeBlockStatistics(
+                kernel, blocksize, out_rasters, overlap, edges=edges,
+                moments=moments)
+            arrays = [np.array(su.backend().read_array(path))
+                      for path in out_rasters]
+        return (arrays, totals)
+
+    def assertWorkersMatchSerial(self, edges, moments):
+        (serial, serial_totals) = self.blockResults(1, edges, moments)
+        (parallel, parallel_totals) = self.blockResults(2, edges, moments)
+        for (expected, result) in zip(serial, parallel):
+            np.testing.assert_array_equal(result, expected)
+        if moments:
+            for (expected, result) in zip(serial_totals, parallel_totals):
+                self.assertEqual(result.count, expected.count)
+                self.assertEqual(result.minimum, expected.minimum)
+                self.assertEqual(result.maximum, expected.maximum)
+                # the blocks are merged in the order they finish
+                self.assertAlmostEqual(result.mean, expected.mean)
+                self.assertAlmostEqual(result.m2 / expected.m2, 1.0)
+        else:
+            self.assertIsNone(parallel_totals)
+
+    def testBlocks(self):
+        self.assertWorkersMatchSerial(edges=False, moments=False)
+
+    def testBlocksWithMoments(self):
+        self.assertWorkersMatchSerial(edges=False, moments=True)
+
+    def testEdgeBlocks(self):
+        self.assertWorkersMatchSerial(edges=True, moments=False)
+
+    def testEdgeBlocksWithMoments(self):
+        self.assertWorkersMatchSerial(edges=True, moments=True)
+
 # test individual scripts
 #
 
@@ -147,6 +343,16 @@ class TestBpi(unittest.TestCase):
             self.assertAlmostEqual(
                 su.raster_properties(bpi_raster, "STD"), 1.65611606614)
 
+    def testStripsShrinkOnWideRasters(self):
+        narrow = bpi.strips(6376, 20000, 10000)
+        wide = bpi.strips(6376, 20000, 100000)
+        self.assertTrue(wide[0][2] < narrow[0][2])
+        for windows in (narrow, wide):
+            self.assertEqual(sum(w[2] for w in windows), 20000)
+            self.assertTrue(windows[0][2] * windows[0][3] <= 6376**2)
+        # a row wider than a block is still read whole
+        self.assertEqual(bpi.strips(10, 3, 1000)[0], (0, 0, 1, 1000))
+
 
 class TestStandardizeBpiGrids(unittest.TestCase):
 
@@ -327,6 +533,32 @@ class TestSaPa(unittest.TestCase):
     def testSaPaImport(self):
         self.assertTrue('main' in vars(surface_area_to_planar_area))
 
+    def testSaPaBlockOfPlane(self):
+        # a plane rising half a cell per cell to the east
+        cols = np.tile(np.arange(6, dtype=np.float64), (5, 1))
+        (ratio, area) = surface_area_to_planar_area.sapa_block(
+            cols * 2.5, 1, 5.0, 5.0, acr_correction=False, area=True)
+        self.assertEqual(ratio.shape, (3, 4))
+        np.testing.assert_allclose(area, 25 * np.sqrt(1.25), rtol=1e-6)
+        np.testing.assert_allclose(ratio, np.sqrt(1.25), rtol=1e-6)
+        (corrected,) = surface_area_to_planar_area.sapa_block(
+            cols * 2.5, 1, 5.0, 5.0)
+        np.testing.assert_allclose(corrected, 1.0, rtol=1e-4)
+
+    def testSaPaScalesBlock(self):
+        bathy = np.random.RandomState(0).normal(0, 2, (9, 10))
+        bathy[4, 8] = np.nan
+        halo = (3, 3, 3, 3)
+        (single, wide) = surface_area_to_planar_area.sapa_scales_block(
+            bathy, halo, [1, 5], 5.0, 5.0)
+        (ratio,) = surface_area_to_planar_area.sapa_block(
+            bathy[2:-2, 2:-2], 1, 5.0, 5.0)
+        np.testing.assert_allclose(single, ratio, rtol=1e-6)
+        self.assertEqual(wide.shape, (3, 4))
+        # windows reaching the triangles of the NoData cell are NoData
+        self.assertTrue(np.isnan(wide[:, 2:]).all())
+        self.assertFalse(np.isnan(wide[:, :2]).any())
+
     def testToolboxImport(self):
         toolbox = arcpy.ImportToolbox(config.pyt_file)
         self.assertTrue('surfacetoplanar' in vars(toolbox))
@@ -540,6 +772,21 @@ class TestRunFullModel(unittest.TestCase):
             # count up the number of cells in the first class
             self.assertEqual(self.sumFirstClass(model_output), 88)
 
+    def testModelExecuteWithoutBpiRasters(self):
+        with TempDir() as d:
+            model_output = os.path.join(d, 'output_zones.tif')
+            arcpy.env.scratchWorkspace = d
+
+            btm_model.main(
+                d, config.bathy_raster, self.broad_inner_rad,
+                self.broad_outer_rad, self.fine_inner_rad, self.fine_outer_rad,
+                config.base_csv, model_output, keep_bpi=False)
+
+            self.assertFalse(arcpy.Exists(os.path.join(d, 'broad_bpi')))
+            self.assertTrue(arcpy.Exists(os.path.join(d, 'broad_std')))
+            self.assertAlmostEqual(
+                su.raster_properties(model_output, "MEAN"), self.true_mean)
+
     def testModelExecuteWithCsvFromToolbox(self):
         with TempDir() as d:
             model_output = os.path.join(d, 'output_zones.tif')
@@ -633,6 +880,134 @@ class TestClassifyFgdb(unittest.TestCase):
             self.assertAlmostEqual(mean, 5.78153846153846)
 
 
+class TestClassifyBatch(unittest.TestCase):
+
+    def testBatchOutputs(self):
+        outputs = classify.batch_outputs(
+            ['a/classes.csv', 'b/classes.xml', 'zones.xml'], 'out')
+        self.assertEqual(outputs, [
+            (os.path.join('out', 'classes_csv_classified.tif'),
+             os.path.join('out', 'classes_csv_zones.csv')),
+            (os.path.join('out', 'classes_xml_classified.tif'),
+             os.path.join('out', 'classes_xml_zones.csv')),
+            (os.path.join('out', 'zones_classified.tif'),
+             os.path.join('out', 'zones_zones.csv'))])
+
+    def testBatchMatchesSingleDictionaries(self):
+        files = [config.base_xml, config.base_csv]
+        with TempDir() as d:
+            classify.batch(
+                ";".join(files), config.broad_std_raster,
+                config.fine_std_raster, config.slope_raster,
+                config.bathy_raster, d)
+            for (out_raster, out_summary) in classify.batch_outputs(
+                    files, d):
+                mean = su.raster_properties(out_raster, "MEAN")
+                self.assertAlmostEqual(mean, 5.78153846153846)
+                self.assertTrue(os.path.exists(out_summary))
+
+
+class TestClassifyBlock(unittest.TestCase):
+
+    def setUp(self):
+        bounds = ['SSB', 'LSB', 'Slope', 'Depth']
+        self.classes = []
+        for (code, broad, slope) in [(1, ('1', None), (None, '5')),
+                                     (2, (None, '2'), (None, None)),
+                                     (3, (None, None), (None, None))]:
+            item = {'Class': str(code), 'Zone': 'zone{}'.format(code)}
+            for prefix in bounds:
+                item[prefix + '_LowerBounds'] = None
+                item[prefix + '_UpperBounds'] = None
+            (item['SSB_LowerBounds'], item['SSB_UpperBounds']) = broad
+            (item['Slope_LowerBounds'], item['Slope_UpperBounds']) = slope
+            self.classes.append(item)
+
+    def testRules(self):
+        (rules, unbounded) = classify.class_rules(self.classes)
+        self.assertEqual(rules[0], (1, 'zone1', [('broad', 1.0, None),
+                                                 ('slope', None, 5.0)]))
+        self.assertEqual([item['Class'] for item in unbounded], ['3'])
+        self.assertEqual(classify.used_inputs(rules), ['broad', 'slope'])
+
+    def testMatchesConSemantics(self):
+        (rules, _) = classify.class_rules(self.classes)
+        broad = np.array([1, 1, 2, np.nan, 0, 3, 2])
+        slope = np.array([5, 6, np.nan, 1, 1, np.nan, 1])
+        zones = classify.classify_block({'broad': broad, 'slope': slope},
+                                        rules)
+        # lower bounds are inclusive, and a NoData input tested by the
+        # deciding class is NoData, though a later class would match
+        np.testing.assert_array_equal(
+            zones, [1, 2, np.nan, np.nan, 2, np.nan, 1])
+        np.testing.assert_array_equal(
+            classify.classify_block({'broad': broad, 'slope': slope},
+                                    rules, method='index'), zones)
+
+    def testCompiledClassesCached(self):
+        (rules, unbounded) = classify.class_rules(self.classes)
+        index = classify.ClassIndex.from_rules(rules, {'1': 'zone1'},
+                                               ['zone3'])
+        with TempDir() as d:
+            path = os.path.join(d, 'classes.npz')
+            index.save(path)
+            cached = classify.ClassIndex.load(path)
+            self.assertEqual(cached.rules, rules)
+            self.assertEqual(cached.zones, {'1': 'zone1'})
+            self.assertEqual(cached.unbounded, ['zone3'])
+            self.assertIsNone(classify.ClassIndex.load(
+                os.path.join(d, 'missing.npz')))
+
+
+class TestZoneTable(unittest.TestCase):
+
+    def testFromArray(self):
+        zones = np.array([[1, 1, 0], [3, np.nan, 1]])
+        table = backend.ZoneTable.from_array(zones, {'1': 'Crests'}, 4.0)
+        self.assertEqual(table.rows(), [
+            (0, 1, 'No Matching Zone', 4.0, 20.0),
+            (1, 3, 'Crests', 12.0, 60.0),
+            (3, 1, 'No Matching Zone', 4.0, 20.0)])
+
+    def testSaveCsv(self):
+        table = backend.ZoneTable([2], [5], {'2': 'Flats'}, 0.5)
+        with TempDir() as d:
+            path = table.save(os.path.join(d, 'zones.csv'))
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(), [
+                    'Value,Count,Zone,Area,Percent', '2,5,Flats,2.5,100.0'])
+
+
+class TestStructureClassification(unittest.TestCase):
+
+    def setUp(self):
+        self.breaks = {'broad': 100, 'fine': 100, 'gentle': 5, 'steep': 70,
+                       'depth': -20}
+
+    def testStructures(self):
+        arrays = {
+            'broad': np.array([-150., 0., 0., 150., 0., np.nan]),
+            'fine': np.array([-150., 0., 0., 150., 150., 0.]),
+            'slope': np.array([10., 1., 1., 90., 10., 1.]),
+            'depth': np.array([-50., -30., -10., -5., np.nan, -30.])}
+        result = structure_classification.structure_block(arrays,
+                                                          self.breaks)
+        # the fifth cell is a lateral midslope crest, but the earlier
+        # classes test its missing depth, so it is NoData as with Con
+        np.testing.assert_array_equal(
+            result, [1, 6, 7, 12, np.nan, np.nan])
+
+    def testNoDataWhereFirstTestIsNoData(self):
+        arrays = {
+            'broad': np.array([0., 0.]),
+            'fine': np.array([-150., 0.]),
+            'slope': np.array([np.nan, np.nan]),
+            'depth': np.array([-50., -50.])}
+        result = structure_classification.structure_block(arrays,
+                                                          self.breaks)
+        self.assertTrue(np.isnan(result).all())
+
+
 class TestRunFullModelKnownZones(unittest.TestCase):
     def setUp(self):
         self.broad_inner_rad = 1
@@ -751,9 +1126,24 @@ class TestScaleComparison(unittest.TestCase):
                                   out_file)
             self.assertTrue(os.path.exists(out_file))
 
+    def testWideRangeFilterFitsBudget(self):
+        # NoData filled with 0 beside depths of -3000 m spans 300k bins
+        preview = np.random.RandomState(4).normal(-3000, 5, (200, 200))
+        preview[::37, ::41] = 0
+        result = scale_comparison.image_filter(preview, 'median', 11)
+        np.testing.assert_array_equal(result, scale_comparison.nd.
+                                      percentile_filter(preview, 50.0, 11))
+
+    def testNarrowRangeFilterMatchesScipy(self):
+        preview = np.round(np.random.RandomState(5).normal(
+            -20, 2, (60, 50)), 2)
+        result = scale_comparison.image_filter(preview, 'percentile', 7,
+                                               75)
+        expected = scale_comparison.nd.percentile_filter(preview, 75.0, 7)
+        np.testing.assert_allclose(result, expected, atol=0.01)
+
 
 class TestMultipleScales(unittest.TestCase):
-    @unittest.skipIf(not su.NETCDF4_EXISTS, "NetCDF4 missing")
     @unittest.skipIf(not su.SCIPY_EXISTS, "SciPy missing")
     def setUp(self):
         self.in_raster = config.bathy_raster
@@ -828,15 +1218,18 @@ class TestACRModel2(unittest.TestCase):
             testaoi = os.path.join(d, 'testaoi.shp')
             arcpy.CopyFeatures_management(self.aoi, testaoi)
             arcpy.arcchordratio_btm(self.in_raster, testaoi, True, d)
-            planarTIN = os.path.join(d, 'bathy5m_clip_planartin')
-            elevTIN = os.path.join(d, 'bathy5m_clip_elevationtin')
-            self.assertTrue(os.path.exists(planarTIN))
-            self.assertTrue(os.path.exists(elevTIN))
+            planes = os.path.join(d, 'bathy5m_clip_planar.tif')
+            self.assertTrue(os.path.exists(planes))
             self.assertEqual(len(arcpy.Describe(testaoi).fields), 8)
             with arcpy.da.SearchCursor(testaoi, '*') as cursor:
+                # computed on the bathymetry grid. The TIN results were
+                # 19972.5978495, 19917.1775893, 1.00278253583,
+                # 2.32867335011 and 246.842790079: the grid counts cells
+                # partly inside the polygon whole, or leaves them out.
                 expected = (0, (358083.9308262255, 4678265.0709908875),
-                            0, 19972.5978495, 19917.1775893,
-                            1.00278253583, 2.32867335011, 246.842790079)
+                            0, 20016.6949634552, 19951.7036057886,
+                            1.00325743399916, 2.30605373991483,
+                            245.770517101820)
                 result = cursor.next()
                 for x in range(2, len(expected)):
                     self.assertAlmostEqual(result[x], expected[x], places=2)
@@ -848,21 +1241,243 @@ class TestACRModel2(unittest.TestCase):
             arcpy.CopyFeatures_management(self.aoi_multipart, testaoi_mp)
             arcpy.arcchordratio_btm(self.in_raster, testaoi_mp, True, d)
 
-            planarTIN = os.path.join(d, 'bathy5m_clip_planartin_4')
-            self.assertTrue(os.path.exists(planarTIN))
+            planes = os.path.join(d, 'bathy5m_clip_planar.tif')
+            self.assertTrue(os.path.exists(planes))
 
             rows = int(arcpy.GetCount_management(testaoi_mp).getOutput(0))
             self.assertEqual(rows, 4)
             self.assertEqual(len(arcpy.Describe(testaoi_mp).fields), 9)
             with arcpy.da.SearchCursor(testaoi_mp, '*') as cursor:
+                # computed on the bathymetry grid. The TIN results were
+                # 1238.64248438, 1236.28701996, 1.00190527311,
+                # 5.3937886264 and 225.726428217; small areas gain or
+                # lose more to cells partly inside the polygon.
                 expected = (0, (358124.62825836154, 4678229.791685243),
-                            0, 0, 1238.64248438, 1236.28701996,
-                            1.00190527311, 5.3937886264, 225.726428217)
+                            0, 0, 1309.16890335083, 1306.20300642462,
+                            1.00227062478928, 5.26691390528743,
+                            222.601919861264)
                 result = cursor.next()
                 for x in range(2, len(expected)):
                     self.assertAlmostEqual(result[x], expected[x], places=2)
 
 
+class TestACRGrid(unittest.TestCase):
+    """Arc-chord ratio computed on the bathymetry grid."""
+
+    def testRasterizeLeavesOutHoles(self):
+        georef = backend.GeoReference(0.0, 10.0, 1.0, 1.0, 10, 10)
+        outer = np.array([[1, 1], [9, 1], [9, 9], [1, 9]], dtype=float)
+        hole = np.array([[4, 4], [6, 4], [6, 6], [4, 6]], dtype=float)
+        mask = acr.rasterize([outer, hole], georef)
+        self.assertEqual(mask.sum(), 64 - 4)
+        self.assertFalse(mask[4:6, 4:6].any())
+        self.assertEqual(acr.boundary_cells(mask).sum(), 36 + 4)
+
+    def testPlaneHasNoRugosity(self):
+        georef = backend.GeoReference(0.0, 100.0, 5.0, 5.0, 20, 20)
+        (y, x) = np.mgrid[0:20, 0:20]
+        bathy = 3 + 0.1 * (x + 0.5) * 5 - 0.05 * (100 - (y + 0.5) * 5)
+        mask = np.zeros(bathy.shape, dtype=bool)
+        mask[5:15, 5:15] = True
+        (surface, planar, plane) = acr.area_acr(bathy, mask, georef)
+        self.assertAlmostEqual(surface / planar, 1.0, places=5)
+        np.testing.assert_allclose(plane[:2], [0.1, -0.05])
+        (slope, aspect) = acr.plane_slope_aspect(plane[0], plane[1])
+        self.assertAlmostEqual(slope[0], np.degrees(np.arctan(
+            np.sqrt(0.0125))), places=5)
+        self.assertAlmostEqual(aspect[0], 296.5650512, places=5)
+
+    def testLabelSumsMatchEachArea(self):
+        georef = backend.GeoReference(0.0, 100.0, 5.0, 5.0, 20, 20)
+        (y, x) = np.mgrid[0:20, 0:20]
+        bathy = np.sin(x / 3.0) * np.cos(y / 4.0) + 0.1 * x
+        labels = np.zeros(bathy.shape, dtype=np.int64)
+        labels[4:12, 3:9] = 1
+        labels[6:16, 9:17] = 2
+        centers = np.array([[0, 0], [30, 60], [65, 45]], dtype=float)
+        sums = acr.label_moments(
+            np.pad(bathy, 1, mode='constant', constant_values=np.nan),
+            np.pad(labels, 1, mode='constant'), georef, centers, 2)
+        planes = acr.solve_planes(sums, centers)
+        for label in (1, 2):
+            (surface, planar, plane) = acr.area_acr(
+                bathy, labels == label, georef)
+            self.assertAlmostEqual(sums[1][label], surface, places=3)
+            np.testing.assert_allclose(
+                [p[label] for p in planes], plane, rtol=1e-8, atol=1e-10)
+
+    def testWindowMatchesSquareArea(self):
+        georef = backend.GeoReference(0.0, 100.0, 5.0, 5.0, 20, 20)
+        (y, x) = np.mgrid[0:20, 0:20]
+        bathy = np.sin(x / 3.0) * np.cos(y / 4.0) + 0.1 * x
+        bathy[12, 7] = np.nan
+        (acr3, acr5) = acr.window_acr_block(bathy, (0, 0, 0, 0), [3, 5],
+                                            5.0, 5.0)
+        for (result, size) in ((acr3, 3), (acr5, 5)):
+            for (row, col) in ((10, 10), (11, 7), (4, 15)):
+                mask = np.zeros(bathy.shape, dtype=bool)
+                half = size // 2
+                mask[row - half:row + half + 1,
+                     col - half:col + half + 1] = True
+                (surface, planar, _) = acr.area_acr(bathy, mask, georef)
+                self.assertAlmostEqual(result[row, col], surface / planar,
+                                       places=5)
+        self.assertTrue(np.isnan(acr3[12, 7]))
+
+
+class TestFocal(unittest.TestCase):
+    """NumPy focal operations used by the numpy backend."""
+
+    def testRectangleMeanMatchesNeighborhood(self):
+        data = np.arange(25, dtype=np.float64).reshape(5, 5)
+        nbr = focal.Neighborhood.rectangle(3)
+        result = focal.focal_statistics(data, nbr, 'MEAN')
+        self.assertAlmostEqual(result[2, 2], data[1:4, 1:4].mean())
+        # edges use a partial window, as Spatial Analyst does
+        self.assertAlmostEqual(result[0, 0], data[0:2, 0:2].mean())
+
+    def testNoDataOption(self):
+        data = np.ones((5, 5))
+        data[2, 2] = np.nan
+        nbr = focal.Neighborhood.rectangle(3)
+        ignored = focal.focal_statistics(data, nbr, 'MEAN', True)
+        kept = focal.focal_statistics(data, nbr, 'MEAN', False)
+        self.assertAlmostEqual(ignored[2, 2], 1.0)
+        self.assertTrue(np.isnan(kept[1, 1]))
+        self.assertAlmostEqual(kept[0, 0], 1.0)
+
+    def testMomentsMatchStatistics(self):
+        """Integral image moments agree with the direct statistics."""
+        data = np.random.RandomState(0).normal(-50, 3, (20, 30))
+        data[4, 7] = np.nan
+        for nbr in (focal.Neighborhood.rectangle(5, 4),
+                    focal.Neighborhood.circle(2)):
+            stats = ('MEAN', 'STD', 'VARIANCE', 'RANGE')
+            moments = focal.focal_moments(data, nbr, stats, False)
+            for stat in stats:
+                direct = np.full(data.shape, np.nan)
+                (above, below, left, right) = nbr.extent
+                for (r, c) in np.ndindex(data.shape):
+                    window = data[max(r - above, 0):r + below + 1,
+                                  max(c - left, 0):c + right + 1]
+                    fp = nbr.footprint[
+                        max(above - r, 0):above + data.shape[0] - r,
+                        max(left - c, 0):left + data.shape[1] - c]
+                    values = window[fp]
+                    if not np.isnan(values).any():
+                        direct[r, c] = {
+                            'MEAN': np.mean, 'STD': np.std,
+                            'VARIANCE': np.var, 'RANGE': np.ptp}[stat](values)
+                np.testing.assert_allclose(moments[stat], direct, atol=1e-9)
+
+    def testKurtosisMatchesScipy(self):
+        import scipy.stats
+        data = np.random.RandomState(1).normal(-20, 0.3, (12, 15))
+        windows = focal.window_view(data, (3, 3))
+        expected = scipy.stats.kurtosis(
+            windows.reshape(windows.shape[:2] + (9,)), axis=2)
+        result = depth_statistics.kurtosis(data, 1)
+        np.testing.assert_allclose(result, expected, atol=1e-8)
+
+    def testPercentileFilterMatchesNumpy(self):
+        """Values on the bin resolution give exact percentiles."""
+        data = np.round(np.random.RandomState(2).normal(-20, 2, (25, 30)), 2)
+        data[3, 4] = np.nan
+        windows = focal.window_view(data, (5, 5))
+        expected = np.percentile(windows, [25, 50, 75], axis=(2, 3))
+        result = focal.percentile_filter(data, 5, [25, 50, 75], 0.01)
+        for (computed, known) in zip(result, expected):
+            np.testing.assert_allclose(computed, known, atol=1e-9)
+
+    def testAnnulusFootprint(self):
+        nbr = focal.Neighborhood.annulus(1, 2)
+        self.assertEqual(nbr.shape, (5, 5))
+        self.assertFalse(nbr.footprint[2, 2])
+        self.assertFalse(nbr.footprint[2, 3])
+        self.assertTrue(nbr.footprint[2, 4])
+
+    def testAnnulusRuns(self):
+        nbr = focal.Neighborhood.annulus(1, 2)
+        runs = nbr.runs
+        self.assertEqual(sum(last - first + 1 for (_, first, last) in runs),
+                         nbr.footprint.sum())
+        # the center row is split either side of the hole
+        self.assertEqual([run for run in runs if run[0] == 0],
+                         [(0, -2, -2), (0, 2, 2)])
+
+    def testAnnulusMomentsMatchFootprint(self):
+        data = np.random.RandomState(5).randn(15, 17)
+        data[4, 6] = np.nan
+        nbr = focal.Neighborhood.annulus(1, 3)
+        result = focal.focal_moments(data, nbr, ['MEAN', 'STD', 'RANGE'])
+        padded = np.pad(data, 3, mode='constant', constant_values=np.nan)
+        for (row, col) in ((0, 0), (7, 8), (4, 9), (14, 16)):
+            cells = padded[row:row + 7, col:col + 7][nbr.footprint]
+            cells = cells[~np.isnan(cells)]
+            self.assertAlmostEqual(result['MEAN'][row, col], cells.mean())
+            self.assertAlmostEqual(result['STD'][row, col], cells.std())
+            self.assertAlmostEqual(result['RANGE'][row, col],
+                                   cells.max() - cells.min())
+
+    def testFftMeanMatchesRunLength(self):
+        data = np.random.RandomState(6).randn(40, 35) * 10 - 50
+        data[10:14, 3:9] = np.nan
+        nbr = focal.Neighborhood.annulus(2, 6)
+        expected = focal.focal_mean(data, nbr, 'runlength')
+        result = focal.focal_mean(data, nbr, 'fft')
+        np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+        np.testing.assert_allclose(result, expected, atol=1e-9)
+
+    def testFocalMeansShareEachMethod(self):
+        data = np.random.RandomState(7).randn(30, 40)
+        data[3:6, 20] = np.nan
+        nbrs = [focal.Neighborhood.annulus(2, 5),
+                focal.Neighborhood.annulus(0, 2)]
+        for method in ('runlength', 'fft'):
+            results = focal.focal_means(data, nbrs, method)
+            for (nbr, result) in zip(nbrs, results):
+                expected = focal.focal_statistics(data, nbr, 'MEAN')
+                np.testing.assert_allclose(result, expected, atol=1e-9)
+
+    def testMeanMethodPrefersFftForLargeAnnuli(self):
+        self.assertEqual(focal.mean_method(
+            focal.Neighborhood.annulus(0, 1), (500, 500)), 'runlength')
+        self.assertEqual(focal.mean_method(
+            focal.Neighborhood.annulus(50, 100), (500, 500)), 'fft')
+
+    def testSlopeOfPlane(self):
+        (_, x) = np.mgrid[0:5, 0:5]
+        plane = x * 5.0
+        result = focal.slope(plane, 5.0, 5.0)
+        self.assertAlmostEqual(result[2, 2], 45.0, places=3)
+        self.assertAlmostEqual(focal.aspect(plane)[2, 2], 270.0, places=3)
+
+    def testVrmMatchesSlopeAspect(self):
+        data = np.cumsum(np.random.RandomState(3).randn(20, 20), axis=0)
+        slope_rad = np.radians(focal.slope(data))
+        aspect = focal.aspect(data)
+        aspect_rad = np.radians(aspect)
+        xyz = [np.where(aspect == -1, 0, np.sin(aspect_rad)) *
+               np.sin(slope_rad),
+               np.where(aspect == -1, 0, np.cos(aspect_rad)) *
+               np.sin(slope_rad),
+               np.cos(slope_rad)]
+        sums = [focal.window_view(v, (5, 5)).sum(axis=(2, 3)) for v in xyz]
+        expected = 1 - np.sqrt(sum(s**2 for s in sums)) / 25
+        result = focal.vrm(data, 5)
+        np.testing.assert_allclose(result[2:-2, 2:-2], expected, atol=1e-6)
+        # a plane is perfectly smooth
+        (_, x) = np.mgrid[0:10, 0:10]
+        self.assertAlmostEqual(focal.vrm(x * 2.0, 3)[5, 5], 0.0, places=6)
+
+    def testVrmScalesMatchSingleScale(self):
+        data = np.cumsum(np.random.RandomState(4).randn(30, 25), axis=1)
+        data[12, 7] = np.nan
+        sizes = [3, 7, 11]
+        for (size, result) in zip(sizes, focal.vrm_scales(data, sizes)):
+            np.testing.assert_array_equal(result, focal.vrm(data, size))
+
+
 class TestSetWorkspace(unittest.TestCase):
 
     def testSetWorkspaceFileIO(self):